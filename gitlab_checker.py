@@ -1,23 +1,40 @@
 import os
 import re
+import shutil
+import tarfile
+import time
 import json
-import chardet
 import gitlab
-import requests
 import base64
+import requests
 import zipfile
 import datetime
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 import pandas as pd
-from bs4 import BeautifulSoup
-from utils.extractor import Extractor, FilePathException
-import psutil
+from pandas.api.types import union_categoricals
+from utils.extractor import Extractor, FilePathException, ResourceLimitException
+from utils.worker_pool import SupervisedPool
+from utils.scheduler import ScanScheduler, WebhookServer, activity_score
+from utils.metrics import ScanMetrics, RUN_PROJECT_ID
+from utils.git_mirror import GitMirror, GitTreeExtractor, GitMirrorException
+from utils.api_index import ApiIndex
+from utils.code_index import CodeIndex, is_indexed
+from utils.gitlab_client import GitLabSession, TokenBucket, AdaptiveLimiter
+from utils.scan_queue import ScanJobQueue
+from utils.api_history import ApiHistory
+from utils.batch_writer import BatchWriter, BatchWriterException
+from utils.archive_cache import ArchiveCache, CachedProject
+from utils.profiler import ProjectProfiler
 import threading
+import contextlib
 from mysql import Mysql
 from glob import glob
 from configparser import ConfigParser
 
+# 合并后的api、数据库链接里大量重复的字符串列，按pandas category(字典编码)存储
+API_CATEGORY_COLUMNS = ['file', 'api', 'type']
+DATABASE_URL_CATEGORY_COLUMNS = ['file', 'database_url']
+
 class NoCommitException(Exception):
     def __init__(self, project_name):
         self.project_name = project_name
@@ -35,22 +52,130 @@ class SameNameException(Exception):
         return (f'{self.project_name} has SameNameException!')
 
 
+class ArchiveTooLargeException(Exception):
+    def __init__(self, project_name, limit_mb):
+        self.project_name = project_name
+        self.limit_mb = limit_mb
+
+    def __str__(self):
+        return (f'too large: {self.project_name} archive exceeds {self.limit_mb}MB')
+
+
+class ArchiveTimeoutException(Exception):
+    def __init__(self, project_name, timeout):
+        self.project_name = project_name
+        self.timeout = timeout
+
+    def __str__(self):
+        return (f'timeout: {self.project_name} archive download exceeds {self.timeout}s')
+
+
+class ArchiveNotCachedException(Exception):
+    def __init__(self, project_name, commit_id):
+        self.project_name = project_name
+        self.commit_id = commit_id
+
+    def __str__(self):
+        return (f'not cached: {self.project_name} archive of {self.commit_id} is not in archive_cache')
+
+
+# 项目本身的问题，换个时间或者换个节点重试也没用
+PROJECT_EXCEPTIONS = (NoCommitException, FilePathException, ResourceLimitException, ArchiveTooLargeException,
+                      ArchiveNotCachedException, zipfile.BadZipFile, UnicodeDecodeError)
+# 扫描循环里只跳过这个项目的异常: 项目本身的问题，加上下载超时、git clone/fetch失败、gitlab内部错误
+SKIP_EXCEPTIONS = PROJECT_EXCEPTIONS + (ArchiveTimeoutException, GitMirrorException,
+                                        gitlab.exceptions.GitlabListError)
+
+
+class ResourceGuard:
+    """
+    解压一个项目时累计解压后的大小和文件数，并检查解压+提取的耗时
+    """
+
+    def __init__(self, checker, project_name, started_at=None):
+        self.checker = checker
+        self.project_name = project_name
+        self.started_at = started_at or time.time()
+        self.files = 0
+        self.bytes = 0
+
+    def check_total(self, files, total_bytes):
+        self.checker.check_limit(self.project_name, 'files', files, self.checker.limit_files)
+        self.checker.check_limit(self.project_name, 'uncompressed_mb', round(total_bytes / 1024 / 1024),
+                                 self.checker.limit_uncompressed_mb)
+
+    def check_time(self):
+        self.checker.check_limit(self.project_name, 'extract_seconds', round(time.time() - self.started_at),
+                                 self.checker.limit_extract_seconds)
+
+    def add(self, size):
+        self.files += 1
+        self.bytes += size
+        self.check_total(self.files, self.bytes)
+        self.check_time()
+
+
 def get_encoding(file):
+    import chardet
+
     with open(file, 'rb') as f:
         data = f.read()
         return chardet.detect(data)['encoding']
 
 
+def _inspect_worker_init(rate_state=None):
+    """
+    SupervisedPool的worker初始化，每个进程自己建gitlab和数据库连接，不从主进程pickle过来
+    :param rate_state: 主进程令牌桶的共享状态，所有worker共用一个限速
+    """
+    return GitLabChecker(worker=True, rate_state=rate_state)
+
+
+def _inspect_worker_task(gitlabchecker, project_id):
+    """
+    返回这个项目的ScanMetrics记录，由主进程合并
+    """
+    gitlabchecker.metrics = ScanMetrics('inspect')
+    gitlabchecker.init_folder_path(ignore=['backend_api_path', 'frontend_api_path', 'data_path',
+                                           'database_url_path', 'fig_path'])
+    try:
+        gitlabchecker.check_project_latest_commit_and_insert(project_id)
+    except SKIP_EXCEPTIONS as e:
+        # 和串行扫描一样记录异常自己的说明，比如 too large: ...
+        gitlabchecker.metrics.skip(project_id, str(e))
+    except Exception as e:
+        gitlabchecker.metrics.skip(project_id, repr(e))
+    return gitlabchecker.metrics.projects
+
+
 class GitLabChecker:
-    def __init__(self):
+    def __init__(self, worker=False, source=None, sync=True, rate_state=None, replay=False):
         """
         入库程序需要用到多进程来避免pylint自身的内存溢出问题(占用内存会随着程序运行时间一直增大)，
         multiprocessing有个比较坑爹的地方就是它会用pickle来序列化一些数据，
         因为要把数据复制到新spawn出来的进程。
         tps://mikolaje.github.io/2019/sqlalchemy_with_multiprocess.html
+        worker: 为True时作为进程池里的worker使用，不拉取全量的project/user/group，不初始化数据表，
+        project按需从gitlab获取，下载目录按进程号隔开
+        source: 代码来源，archive(下载压缩包)或者mirror(本地bare仓库增量fetch)，默认用配置里的
+        sync: 为False时不拉取全量的project/user/group、不同步基础表，project按需获取，
+        命令行里只处理单个项目或者只入库时使用；数据库连接、建表和schema迁移照常执行(只有一个节点时也要能用)
+        rate_state: TokenBucket的共享状态，进程池的worker传入主进程的，None时新建
+        replay: 离线重放，项目列表和压缩包都来自archive_cache，不访问gitlab，也不同步基础表
         """
+        self.worker = worker
+        self.replay = replay
+        self.lazy = worker or not sync
         self.load_config()
+        if source is not None:
+            self.source_backend = source
+        if replay:
+            self.source_backend = 'archive'
+        self.archive_cache = ArchiveCache(self.archive_cache_path, self.archive_cache_max_mb) \
+            if self.archive_cache_enabled or replay else None
         self.download_path = os.path.join(os.path.dirname(__file__), 'download_file')
+        if worker:
+            self.download_path = os.path.join(self.download_path, f'worker-{os.getpid()}')
         self.fig_path = os.path.join(os.path.dirname(__file__), 'fig')
         self.frontend_api_path = os.path.join(os.path.dirname(__file__), 'frontend_api')
         self.backend_api_path = os.path.join(os.path.dirname(__file__), 'backend_api')
@@ -58,9 +183,37 @@ class GitLabChecker:
         self.data_path = os.path.join(os.path.dirname(__file__), 'data')
         self.api_path = os.path.join(self.data_path, 'api.csv')
         self.database_url_file_path = os.path.join(self.data_path, 'database_url.csv')
-        self.init_folder_path(ignore=['backend_api_path', 'frontend_api_path', 'data_path', 'database_url_path'])
-        self.gl = gitlab.Gitlab(self.base_url, oauth_token=self.token)
-        self.gl_upload = gitlab.Gitlab(self.base_url, oauth_token=self.upload_token)
+        if worker:
+            self.init_folder_path(ignore=['backend_api_path', 'frontend_api_path', 'data_path', 'database_url_path',
+                                          'fig_path'])
+        else:
+            self.init_folder_path(ignore=['backend_api_path', 'frontend_api_path', 'data_path', 'database_url_path'])
+        # 所有gitlab请求都经过这个session: 限速、自适应并发、429/5xx退避重试，python-gitlab自己的5xx重试关掉
+        self.session = GitLabSession(
+            bucket=TokenBucket(self.client_rate, self.client_burst, state=rate_state),
+            limiter=AdaptiveLimiter(self.client_concurrency, max_limit=self.client_max_concurrency),
+            max_retries=self.client_max_retries, backoff_base=self.client_backoff_base,
+            backoff_max=self.client_backoff_max)
+        self.gl = gitlab.Gitlab(self.base_url, oauth_token=self.token, session=self.session,
+                                retry_transient_errors=False)
+        self.gl_upload = gitlab.Gitlab(self.base_url, oauth_token=self.upload_token, session=self.session,
+                                       retry_transient_errors=False)
+        self.mirror = GitMirror(self.mirror_path, token=self.token) if self.source_backend == 'mirror' else None
+        self.api_index = None
+        # 全量扫描期间的后台入库线程，{表名: BatchWriter}，streamed是各表已经写进影子表的csv
+        self.writers = {}
+        self.streamed = {}
+        # 同步成员关系时记录gitlab接口返回的access_level，重建闭包表时使用
+        self.member_access_levels = {}
+        self.code_index = CodeIndex(self.code_index_path, self.code_index_max_file_kb * 1024) \
+            if self.code_index_enabled else None
+        if replay:
+            self.projects = [CachedProject(meta) for meta in self.archive_cache.latest(self.archive_format)]
+            print(f'离线重放: archive_cache里有{len(self.projects)}个项目')
+            return
+        if self.lazy:
+            self.projects = []
+            return
         self.projects = sorted(self.gl.projects.list(all=True), key=lambda x: x.id)
         self.users = sorted(self.gl.users.list(all=True), key=lambda x: x.id)
         self.groups = sorted(self.gl.groups.list(all=True), key=lambda x: x.id)
@@ -75,8 +228,84 @@ class GitLabChecker:
         self.base_url = gitlab_cfg['base_url']
         self.token = gitlab_cfg['token']
         self.upload_token = gitlab_cfg['upload_token']
-        mysql_instance = Mysql(mysql_cfg['user'], mysql_cfg['password'], mysql_cfg['host'], mysql_cfg['port'], mysql_cfg['database'])
+        # 搜索结果缓存，t_base_api/t_base_database_url重新入库后自动失效
+        cache_cfg = dict(cfg.items('cache')) if cfg.has_section('cache') else {}
+        mysql_instance = Mysql(mysql_cfg['user'], mysql_cfg['password'], mysql_cfg['host'], mysql_cfg['port'], mysql_cfg['database'],
+                               cache_size=int(cache_cfg.get('max_size') or 1024),
+                               cache_ttl=int(cache_cfg.get('ttl_seconds') or 300),
+                               generation_ttl=float(cache_cfg.get('generation_ttl_seconds') or 5))
         self.mysql = mysql_instance
+        # 审查用的进程池配置，processes为0时在当前进程串行执行
+        worker_cfg = dict(cfg.items('worker')) if cfg.has_section('worker') else {}
+        self.worker_processes = int(worker_cfg.get('processes') or 4)
+        self.worker_max_tasks = int(worker_cfg.get('max_tasks_per_worker') or 50)
+        self.worker_max_rss_mb = int(worker_cfg.get('max_rss_mb') or 2048)
+        self.scheduler_cfg = dict(cfg.items('scheduler')) if cfg.has_section('scheduler') else {}
+        # 压缩包流式下载，超过大小或者时间限制的项目跳过
+        download_cfg = dict(cfg.items('download')) if cfg.has_section('download') else {}
+        self.archive_format = download_cfg.get('format') or 'zip'
+        self.archive_max_mb = int(download_cfg.get('max_archive_mb') or 1024)
+        self.archive_timeout = int(download_cfg.get('timeout') or 600)
+        self.archive_chunk_size = int(download_cfg.get('chunk_kb') or 1024) * 1024
+        self.max_member_mb = int(download_cfg.get('max_member_mb') or 10)
+        # 按(project_id, commit sha)缓存下载的压缩包，重跑和第二遍扫描不用重新下载
+        archive_cache_cfg = dict(cfg.items('archive_cache')) if cfg.has_section('archive_cache') else {}
+        self.archive_cache_enabled = (archive_cache_cfg.get('enabled') or '1') == '1'
+        self.archive_cache_path = archive_cache_cfg.get('path') or os.path.join(os.path.dirname(__file__),
+                                                                                'archive_cache')
+        self.archive_cache_max_mb = int(archive_cache_cfg.get('max_mb') or 20480)
+        # 单个项目的资源限制，超过时只跳过这个项目，0表示不限制
+        limits_cfg = dict(cfg.items('limits')) if cfg.has_section('limits') else {}
+        self.limit_uncompressed_mb = int(limits_cfg.get('max_uncompressed_mb') or 4096)
+        self.limit_files = int(limits_cfg.get('max_files') or 200000)
+        self.limit_line_kb = int(limits_cfg.get('max_line_kb') or 256)
+        self.limit_extract_seconds = int(limits_cfg.get('max_extract_seconds') or 900)
+        # gitlab接口的限速和重试，rate是所有进程合计每秒请求数，0表示不限速
+        client_cfg = dict(cfg.items('gitlab_client')) if cfg.has_section('gitlab_client') else {}
+        self.client_rate = float(client_cfg.get('rate') or 10)
+        self.client_burst = int(client_cfg.get('burst') or 20)
+        self.client_concurrency = int(client_cfg.get('concurrency') or 4)
+        self.client_max_concurrency = int(client_cfg.get('max_concurrency') or 16)
+        self.client_max_retries = int(client_cfg.get('max_retries') or 5)
+        self.client_backoff_base = float(client_cfg.get('backoff_base') or 1)
+        self.client_backoff_max = float(client_cfg.get('backoff_max') or 60)
+        # api生命周期索引每处理这么多个commit保存一次进度
+        api_history_cfg = dict(cfg.items('api_history')) if cfg.has_section('api_history') else {}
+        self.api_history_batch_commits = int(api_history_cfg.get('batch_commits') or 500)
+        # 多节点分片扫描的任务租约
+        self.scan_queue_cfg = dict(cfg.items('scan_queue')) if cfg.has_section('scan_queue') else {}
+        # 全量扫描时边扫描边入库的后台线程
+        batch_writer_cfg = dict(cfg.items('batch_writer')) if cfg.has_section('batch_writer') else {}
+        self.batch_writer_enabled = (batch_writer_cfg.get('enabled') or '1') == '1'
+        self.batch_writer_max_rows = int(batch_writer_cfg.get('max_rows') or 100000)
+        self.batch_writer_batch_rows = int(batch_writer_cfg.get('batch_rows') or 20000)
+        self.batch_writer_flush_seconds = float(batch_writer_cfg.get('flush_seconds') or 5)
+        source_cfg = dict(cfg.items('source')) if cfg.has_section('source') else {}
+        self.source_backend = source_cfg.get('backend') or 'archive'
+        self.mirror_path = source_cfg.get('mirror_path') or os.path.join(os.path.dirname(__file__), 'mirror')
+        # 全量源码的trigram索引，扫描时顺带更新commit有变化的项目
+        code_index_cfg = dict(cfg.items('code_index')) if cfg.has_section('code_index') else {}
+        self.code_index_enabled = (code_index_cfg.get('enabled') or '1') == '1'
+        self.code_index_path = code_index_cfg.get('path') or os.path.join(os.path.dirname(__file__), 'code_index')
+        self.code_index_max_file_kb = int(code_index_cfg.get('max_file_kb') or 1024)
+        metrics_cfg = dict(cfg.items('metrics')) if cfg.has_section('metrics') else {}
+        self.metrics_top_n = int(metrics_cfg.get('top_n') or 10)
+        self.metrics_regression_threshold = float(metrics_cfg.get('regression_threshold') or 0.3)
+        self.metrics_path = metrics_cfg.get('prometheus_path') or os.path.join(os.path.dirname(__file__), 'data',
+                                                                              'metrics')
+        self.metrics = ScanMetrics('adhoc')
+        # scan_shard执行期间的ScanJobQueue，入库前用来确认租约还在
+        self.scan_queue = None
+        # 慢项目自动采样、指定项目全程cProfile，结果放在metrics_path/profiles下
+        profiler_cfg = dict(cfg.items('profiler')) if cfg.has_section('profiler') else {}
+        self.profiler_enabled = (profiler_cfg.get('enabled') or '1') == '1'
+        self.profiler = ProjectProfiler(os.path.join(self.metrics_path, 'profiles'),
+                                        slow_seconds=float(profiler_cfg.get('slow_seconds') or 300),
+                                        interval=int(profiler_cfg.get('interval_ms') or 10) / 1000,
+                                        project_ids=[int(project_id) for project_id in
+                                                     (profiler_cfg.get('project_ids') or '').split(',') if
+                                                     project_id.strip()],
+                                        top_n=int(profiler_cfg.get('top_n') or 20))
 
     def init_folder_path(self, ignore=['backend_api_path', 'frontend_api_path', 'data_path', 'database_url_path']):
 
@@ -93,10 +322,40 @@ class GitLabChecker:
             folder = path_dict[path_name]
             if path_name in ignore:
                 if not os.path.exists(folder):
-                    os.mkdir(folder)
+                    os.makedirs(folder)
             else:
                 os.system(f'rm -rf {folder}')
-                os.mkdir(folder)
+                os.makedirs(folder)
+
+    def profile_project(self, project_id, stage, project_name=''):
+        """
+        剖析单个项目的扫描，同一天同一类扫描的剖析结果放在一个目录下(多进程审查时每个worker的run_id不一样)
+        """
+        if not self.profiler_enabled:
+            return contextlib.nullcontext()
+        return self.profiler.profile(project_id, project_name, stage,
+                                     run=f'{self.metrics.run_kind}-{self.metrics.run_id[:8]}')
+
+    def finish_metrics(self, metrics=None):
+        """
+        扫描结束后输出最慢的项目和阶段，写prometheus文件，入库并和上一次同类扫描对比
+        """
+        metrics = metrics or self.metrics
+        metrics.summary(self.metrics_top_n)
+        stats = self.session.stats
+        print(f"gitlab请求: {stats['requests']}次, 重试{stats['retries']}次, 限流{stats['throttled']}次, "
+              f"连接错误{stats['errors']}次, 限速等待{stats['waited']:.1f}s, 当前并发上限{int(self.session.limiter.limit)}")
+        metrics.write_prometheus(os.path.join(self.metrics_path, f'{metrics.run_kind}.prom'), self.metrics_top_n)
+        try:
+            previous_df = self.mysql.select_last_scan_metrics(metrics.run_kind, metrics.run_id)
+            metrics.compare(previous_df, self.metrics_regression_threshold)
+            self.mysql.insert_t_scan_metrics(metrics.to_dataframe())
+        except Exception as e:
+            # 统计入库失败不影响扫描结果
+            print(f'扫描统计入库失败: {e}')
+        if self.profiler.profiled:
+            print(f'性能剖析了{len(self.profiler.profiled)}个项目, 结果在{os.path.dirname(self.profiler.profiled[-1][2])}')
+            self.profiler.profiled = []
 
     def init_tables(self):
         # 插入数据到基础表
@@ -106,6 +365,7 @@ class GitLabChecker:
         self.insert_t_rel_project_user()
         self.insert_t_rel_project_group()
         self.insert_t_rel_group_user()
+        self.rebuild_t_rel_project_user_closure()
         self.insert_t_base_api()
         self.insert_t_base_database_url()
 
@@ -113,6 +373,11 @@ class GitLabChecker:
         for project in self.projects:
             if project.id == project_id:
                 return project
+        if self.lazy:
+            # worker和sync=False时没有全量的project列表，按需获取后缓存
+            project = self.gl.projects.get(project_id)
+            self.projects.append(project)
+            return project
         raise Exception(f'No project id is {project_id}')
 
     def get_project_by_name(self, project_name):
@@ -139,31 +404,174 @@ class GitLabChecker:
             commit_dict[date] = url
         return commit_dict
 
-    def download_commit(self, project_id, commit_id, output_path):
+    def download_commit(self, project_id, commit_id, output_path, format=None):
+        """
+        流式下载commit的压缩包，分块写到output_path.part，完成后再改名，内存里不会有整个压缩包
+        超过archive_max_mb抛ArchiveTooLargeException，超过archive_timeout秒抛ArchiveTimeoutException
+        响应带Content-Length时先检查大小，每次读之前把socket的读超时缩到剩余时间，卡住的连接不会拖过截止时间
+        :param format: zip或者tar.gz，默认用配置里的
+        """
         project = self.get_project_by_id(project_id)
-        zip = project.repository_archive(sha=commit_id, format='zip')
-        with open(output_path, 'wb') as f:
-            f.write(zip)
+        format = format or self.archive_format
+        max_bytes = self.archive_max_mb * 1024 * 1024
+        deadline = time.time() + self.archive_timeout
+        tmp_path = f'{output_path}.part'
+        size = 0
+
+        with self.metrics.stage(project.id, 'download', project.name):
+            try:
+                # 和project.repository_archive发一样的请求，但拿到response自己读，读完或者出错都关掉连接
+                response = self.gl.http_get(f'/projects/{project.encoded_id}/repository/archive.{format}',
+                                            query_data={'sha': commit_id}, raw=True, streamed=True,
+                                            timeout=self.archive_timeout or None)
+            except gitlab.exceptions.GitlabHttpError as e:
+                raise gitlab.exceptions.GitlabListError(e.error_message, e.response_code, e.response_body) from e
+            try:
+                length = response.headers.get('Content-Length')
+                if self.archive_max_mb and length and length.isdigit() and int(length) > max_bytes:
+                    raise ArchiveTooLargeException(project.name, self.archive_max_mb)
+                chunks = response.iter_content(chunk_size=self.archive_chunk_size)
+                with open(tmp_path, 'wb') as f:
+                    while True:
+                        if self.archive_timeout:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                raise ArchiveTimeoutException(project.name, self.archive_timeout)
+                            self.set_read_timeout(response, min(remaining, self.archive_timeout))
+                        try:
+                            chunk = next(chunks, None)
+                        except (requests.ConnectionError, requests.Timeout) as e:
+                            if self.archive_timeout and time.time() >= deadline:
+                                raise ArchiveTimeoutException(project.name, self.archive_timeout) from e
+                            raise
+                        if chunk is None:
+                            break
+                        size += len(chunk)
+                        if self.archive_max_mb and size > max_bytes:
+                            raise ArchiveTooLargeException(project.name, self.archive_max_mb)
+                        f.write(chunk)
+                os.replace(tmp_path, output_path)
+            finally:
+                response.close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                self.metrics.add(project.id, 'download', bytes=size)
+
+    @staticmethod
+    def set_read_timeout(response, seconds):
+        """
+        requests的timeout只在发请求时设置一次，之后每次读都能再等这么久，这里直接改底层socket的超时
+        http.client收到响应后连接对象可能已经不持有socket，这时从响应的文件对象(SocketIO)上取
+        """
+        sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+        if sock is None:
+            fp = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+            sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+        if sock is not None:
+            sock.settimeout(max(seconds, 0.001))
+
+    def extract_archive(self, archive_path, out_path, selective=False, project_name=None, started_at=None):
+        """
+        解压时检查[limits]里的解压后总大小、文件数和耗时，超过时抛ResourceLimitException
+        """
+        guard = ResourceGuard(self, project_name or os.path.basename(out_path), started_at)
+        if archive_path.endswith('.tar.gz'):
+            return self.untar(archive_path, out_path, selective, guard)
+        return self.unzip(archive_path, out_path, selective, guard)
+
+    def check_limit(self, project_name, limit, value, max_value):
+        if max_value and value > max_value:
+            raise ResourceLimitException(project_name, limit, value, max_value)
+
+    def is_member_needed(self, name, size, selective):
+        """
+        selective为True时只解压Extractor.manifest里的后缀和标记文件(开了代码索引时加上要进索引的配置文件等)，
+        并跳过超过max_member_mb的文件
+        """
+        if not selective:
+            return True
+        if not (Extractor.is_relevant(name) or self.is_indexed(name)):
+            return False
+        if self.max_member_mb and size > self.max_member_mb * 1024 * 1024:
+            return False
+        return True
+
+    def is_indexed(self, name):
+        return self.code_index is not None and is_indexed(name)
+
+    def untar(self, tar_path, out_path, selective=False, guard=None):
+        """
+        tar.gz包里也是一个以commit_id命名的最外层文件夹，解压时直接去掉这一层写到out_path
+        只解压普通文件和文件夹，跳过链接和路径在out_path之外的成员
+        tar是流式读取的，解压后大小和文件数边解压边累计
+        :return: (解压的文件数, 跳过的文件数, 跳过的字节数)
+        """
+        guard = guard or ResourceGuard(self, os.path.basename(out_path))
+        if os.path.exists(out_path):
+            shutil.rmtree(out_path)
+        os.makedirs(out_path)
+        out_root = os.path.abspath(out_path)
+        count, skipped, skipped_bytes = 0, 0, 0
+        with tarfile.open(tar_path, 'r:gz') as tar:
+            for member in tar:
+                guard.add(member.size if member.isfile() else 0)
+                parts = member.name.split('/', 1)
+                if len(parts) < 2 or parts[1] == '':
+                    continue
+                target = os.path.abspath(os.path.join(out_root, parts[1]))
+                if not target.startswith(out_root + os.sep):
+                    continue
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                elif member.isfile():
+                    # 跳过的文件也保留所在的文件夹，判断项目类型时要用到
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    if not self.is_member_needed(parts[1], member.size, selective):
+                        skipped += 1
+                        skipped_bytes += member.size
+                        continue
+                    with tar.extractfile(member) as src, open(target, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    count += 1
+        return count, skipped, skipped_bytes
 
-    def unzip(self, zip_path, out_path):
+    def unzip(self, zip_path, out_path, selective=False, guard=None):
         """
         zip包中是一个最外层以commit_id的命名的文件夹，入库需要简洁的文件路径，所有这里要替换成project_name
         :param zip_path: zip的路径
         :param out_path: 解压后的路径
-        :return:
+        :param selective: 只解压Extractor需要的文件
+        :param guard: ResourceGuard，zip在解压前按中央目录里的大小和数量检查一遍
+        :return: (解压的成员数, 跳过的文件数, 跳过的字节数)
         """
+        guard = guard or ResourceGuard(self, os.path.basename(out_path))
         zip_file = zipfile.ZipFile(zip_path)
-        zip_list = zip_file.namelist()
+        zip_list = zip_file.infolist()
+        try:
+            guard.check_total(len(zip_list), sum(info.file_size for info in zip_list))
+        except ResourceLimitException:
+            zip_file.close()
+            raise
 
         if os.path.exists(out_path):
             os.system(f"rm -rf '{out_path}'")
 
-        commit_dir = os.path.join(self.download_path, zip_list[0])
+        commit_dir = os.path.join(self.download_path, zip_list[0].filename)
 
-        for f in zip_list[1:]:
-            zip_file.extract(f, self.download_path)
+        count, skipped, skipped_bytes = 0, 0, 0
+        for info in zip_list[1:]:
+            guard.check_time()
+            if not info.is_dir() and not self.is_member_needed(info.filename, info.file_size, selective):
+                # 跳过的文件也保留所在的文件夹，判断项目类型时要用到
+                os.makedirs(os.path.dirname(os.path.join(self.download_path, info.filename)), exist_ok=True)
+                skipped += 1
+                skipped_bytes += info.file_size
+                continue
+            zip_file.extract(info, self.download_path)
+            count += 1
         zip_file.close()
         os.system(f"mv '{commit_dir}' '{out_path}'")
+        return count, skipped, skipped_bytes
 
     def unzip_time_dir(self, zip_path, out_path):
         """
@@ -235,7 +643,7 @@ class GitLabChecker:
             raise Exception(f'{project.name} has no commit_id: {commit_id}')
 
         # _, _, _, name, project, _, _, commit_id = commit.web_url.split('/')
-        zip_path = os.path.join(self.download_path, 'tmp.zip')
+        zip_path = os.path.join(self.download_path, f'tmp.{self.archive_format}')
 
         if rename_to_authored_date:
             # 2022-04-12 09:34:10.000+00:00 2022-04-12 18:49:40 两种情况
@@ -243,16 +651,21 @@ class GitLabChecker:
                                                                                                                  ' ')
             dir_path = os.path.join(self.download_path, project.name, commit_time)
             extractor_path = os.path.join(self.download_path, f'{commit_time}.txt')
-            self.download_commit(project_id=project_id, commit_id=commit.id, output_path=zip_path)
-            self.unzip_time_dir(zip_path, dir_path)
+            zip_path = os.path.join(self.download_path, 'tmp.zip')
+            self.download_commit(project_id=project_id, commit_id=commit.id, output_path=zip_path, format='zip')
+            with self.metrics.stage(project.id, 'unzip', project.name):
+                self.unzip_time_dir(zip_path, dir_path)
         else:
             dir_path = os.path.join(self.download_path, project.name)
             extractor_path = os.path.join(self.download_path, f'{project.name}.txt')
-            self.download_commit(project_id=project_id, commit_id=commit.id, output_path=zip_path)
-            self.unzip(zip_path, dir_path)
+            zip_path = self.fetch_archive(project, commit.id)
+            with self.metrics.stage(project.id, 'unzip', project.name):
+                files, _, _ = self.extract_archive(zip_path, dir_path)
+            self.metrics.add(project.id, 'unzip', files=files)
 
-        extractor = Extractor(filepath=dir_path)
-        extractor.check(if_print=False, if_csv=False)
+        with self.metrics.stage(project.id, 'inspect', project.name):
+            extractor = Extractor(filepath=dir_path)
+            extractor.check(if_print=False, if_csv=False)
 
         if upload:
             gitlab_file_path = self.upload_file_to_ysrd_extractor_report(project.name, extractor_path)
@@ -290,19 +703,21 @@ class GitLabChecker:
         """
         审查某个commit并入库
         """
-        with self.mysql.engine.connect() as con:
-            sql = f'select id from t_base_project where git_id="{project_id}"'
-            sql_df = pd.read_sql(sql, con=con)
-            if len(sql_df) != 1:
-                raise Exception(f'The number of "{sql}" result is not 1!')
-
+        # 审查前先确认项目已经入库，查完就归还连接，审查期间不占着数据库连接
+        if self.mysql.select_t_base_project_count(project_id) != 1:
+            raise Exception(f'The number of t_base_project where git_id={project_id} is not 1!')
+        with self.profile_project(project_id, 'inspect'):
             df = self.check_single_commit(project_id, commit_id)
-            if len(df) == 0:
-                # 没有detail就不入库了
-                return
-            batch_id = self.insert_t_inspect_batch(project_id)
-            df['batch_id'] = batch_id
-            self.mysql.insert_t_inspect_details(df)
+        if len(df) == 0:
+            # 没有detail就不入库了
+            return
+        if self.scan_queue is not None:
+            # 分片审查时租约被其他节点接管就不再入库，避免同一个commit入库两次
+            self.scan_queue.check_lease()
+        # batch和details在同一个事务里入库
+        with self.metrics.stage(project_id, 'load'):
+            self.mysql.insert_t_inspect_results({project_id: df})
+        self.metrics.add(project_id, 'load', rows=len(df))
 
     def check_project_latest_commit_and_insert(self, project_id):
         """
@@ -350,28 +765,44 @@ class GitLabChecker:
                 else:
                     self.check_project_commit_and_insert(project_id, latest_commit_id)
 
-    def check_all_project_latest_commit_and_insert(self):
+    def check_all_project_latest_commit_and_insert(self, processes=None):
+        """
+        审查所有项目最新的commit并入库
+        processes大于0时用SupervisedPool多进程执行，worker处理worker_max_tasks个项目
+        或者内存超过worker_max_rss_mb之后会被回收，避免内存一直增长
+        """
+        processes = self.worker_processes if processes is None else processes
+        self.metrics = ScanMetrics('inspect')
+        if processes > 0:
+            pool = SupervisedPool(_inspect_worker_task, initializer=_inspect_worker_init,
+                                  initargs=(self.session.bucket.state,), processes=processes,
+                                  max_tasks=self.worker_max_tasks, max_rss_mb=self.worker_max_rss_mb)
+            progress = tqdm(total=len(self.projects))
+
+            def callback(project_id, status, result):
+                progress.update(1)
+                if status == 'done':
+                    self.metrics.merge(result)
+                else:
+                    print(f'project {project_id} {status}: {result}')
+                    self.metrics.skip(project_id, f'{status}: {result}')
+
+            pool.map([project.id for project in self.projects], callback=callback)
+            progress.close()
+            print(f'worker回收次数: {pool.recycled}, 异常退出次数: {pool.killed}')
+            self.finish_metrics()
+            return
+
         for project in tqdm(self.projects):
             try:
                 self.init_folder_path()
                 print(f'checking {project.name}...')
                 self.check_project_latest_commit_and_insert(project.id)
-                # print('主进程：',os.getpid(),'当前进程的内存使用：%.4f M' % (psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024))
-            except NoCommitException as e:
-                # 这里catch住没有commit的仓库，不报错，不入库
-                print(e)
-            except FilePathException as e:
-                # 路径问题
-                print(e)
-            except zipfile.BadZipFile as e:
-                # 有些zip包是坏的
-                print(e)
-            except UnicodeDecodeError as e:
-                # 文件编码问题
-                print(e)
-            except gitlab.exceptions.GitlabListError as e:
-                # gitlab内部错误
+            except SKIP_EXCEPTIONS as e:
+                # 没有commit、压缩包坏了或者太大、超过资源限制等，只跳过这个项目
                 print(e)
+                self.metrics.skip(project.id, str(e), project.name)
+        self.finish_metrics()
 
     def check_project_commits_and_insert(self, project_id, commit_length):
         """
@@ -397,14 +828,17 @@ class GitLabChecker:
                 # 文件编码问题
                 print(e)
 
-    def parse_line(self, line):
+    @staticmethod
+    def parse_line(line):
         """
         从报告中解析
         """
         if '.py' not in line:
             return None
         if line.count(':') == 2:
+            # file.py:N: message (name) 没有错误码
             file, lineno, info = line.split(':')
+            code = ''
         elif line.count(':') == 3:
             file, lineno, code, info = line.split(':')
         elif line.count(':') == 4:
@@ -425,99 +859,44 @@ class GitLabChecker:
         return data
 
     def plot_from_gitlab(self, project_id, all=False):
-        # 暂时因为self.parse适配新的目录结构，不可用了,后续统一改为从数据库中读取
         """
-        从gitlab下载报告再画图,
-        需要使用
-        gitlabchecker.check_project(project_name, rename_to_authored_date=True, upload=True)
-        先将报告上传至gitlab
+        兼容旧的调用，报告不再从ysrd-extractor-report仓库下载，改为从t_inspect_rollup读取
         """
+        return self.plot_trend(project_id, last_n=None if all else 20)
 
-        def count_mistakes(lines):
-            datas = []
-            for line in lines:
-                data = self.parse_line(line)
-                if data != None:
-                    datas.append(data)
+    def plot_trend(self, project_id, last_n=20):
+        """
+        画项目最近last_n次审查每种error_type的错误数量趋势图
+        数据来自入库时维护的t_inspect_rollup，一次查询拿到全部数据
+        """
+        project = self.get_project_by_id(project_id)
+        df = self.mysql.select_inspect_trend(project_id, last_n=last_n)
+        if len(df) == 0:
+            print(f'{project.name} 没有审查记录')
+            return None
 
-            if len(datas) != 0:
-                df = pd.DataFrame(datas)
-                df_stat = pd.DataFrame()
-                df_stat['error_type'] = list(df['error_type'].value_counts().index)
-                df_stat['time'] = list(df['error_type'].value_counts().values)
-                df_stat['error_code'] = list(df['error_code'].value_counts().index)
-            else:
-                df_stat = pd.DataFrame()
-                df_stat['error_type'] = []
-                df_stat['time'] = []
-                df_stat['error_code'] = []
-            return df_stat
-
-        def get_report_paths(project_id, suffix='.txt', path='', all=False):
-            """
-            获得报告的路径
-            """
-            project = self.get_project_by_id(project_id)
-            files = project.repository_tree(all=all, recursive=True, path=path, as_list=True)
-            report_paths = [file['path'] for file in files if os.path.splitext(file['path'])[-4:][-1] == suffix]
-            return report_paths
-
-        def get_file_content(project_id, file_path):
-            """
-            获取仓库里某个文件的每行文本，返回数组
-            """
-            project = self.get_project_by_id(project_id)
-            blames = project.files.blame(
-                file_path=file_path, ref="master")
-            # 这里之前好想遇到过blames的长度大于1的情况，如果遇到画图情况出问题应该检查这个blames的长度
-            lines = blames[0]['lines']
-            return lines
+        batches = df.drop_duplicates('batch_id').set_index('batch_id')['created_at']
+        result = df.pivot_table(index='batch_id', columns='error_type', values='error_count',
+                                aggfunc='sum', fill_value=0).reindex(batches.index, fill_value=0)
+        commit_times = [str(created_at).split(' ')[0] for created_at in batches]
 
-        project_path = self.get_project_path_by_id(project_id)
-        project = self.get_project_by_id(project_id)
-        ysrd_extractor_report = self.get_project_by_name('ysrd-extractor-report')
-        report_paths = get_report_paths(ysrd_extractor_report.id, path=project_path, all=all)
-        commit_times = [os.path.splitext(os.path.basename(filepath))[0].split(' ')[0] for filepath in report_paths]
-
-        dfs = []
-        for report_path in tqdm(report_paths):
-            lines = get_file_content(ysrd_extractor_report.id, file_path=report_path)
-            df_tmp = count_mistakes(lines)
-            dfs.append(df_tmp)
-
-        error_types = set()
-        for df in dfs:
-            for error_type in df['error_type']:
-                error_types.add(error_type)
-
-        result = {}
-        for df in dfs:
-            for error_type in error_types:
-                df_error = df[df['error_type'] == error_type]
-                if len(df_error) == 0:
-                    error_time = 0
-                elif len(df_error) == 1:
-                    error_time = df_error['time'].iloc[0]
-                else:
-                    raise Exception('count error error!')
-                if error_type not in result.keys():
-                    result[error_type] = [error_time]
-                else:
-                    result[error_type].append(error_time)
+        # matplotlib只有画图时才用到，导入很慢，不放在模块顶部
+        import matplotlib.pyplot as plt
 
         fig = plt.figure(figsize=(24, 12))
-        fig.suptitle(f'{project.name}近{len(report_paths)}次commit ysrd-extractor报告', fontsize=20)
+        fig.suptitle(f'{project.name}近{len(result)}次commit ysrd-extractor报告', fontsize=20)
 
         plt.subplots_adjust(left=None, bottom=None, right=None, top=None, wspace=1, hspace=0.5)
-        for i, key in enumerate(result.keys()):
+        for i, key in enumerate(result.columns[:56]):
             ax1 = plt.subplot(7, 8, i + 1)
-            values = result[key]
+            values = list(result[key])
             ax1.plot(range(len(values)), values, linewidth=2.0, label=key)
-            ax1.set_xticks([0, 19])
+            ax1.set_xticks([0, len(values) - 1])
             ax1.set_xticklabels([commit_times[0], commit_times[-1]])
             ax1.set_title(key)
-        fig_name = os.path.join(self.download_path, f'{project.name}统计.png')
+        fig_name = os.path.join(self.fig_path, f'{project.name}统计.png')
         plt.savefig(fig_name)
+        plt.close(fig)
         return fig_name
 
     def insert_t_base_project(self):
@@ -589,11 +968,12 @@ class GitLabChecker:
         for project in self.projects:
             project_idx = df_project[df_project['git_id'] == project.id].iloc[0]['id']
             headers = {'PRIVATE-TOKEN': self.token}
-            response = requests.get(f'{self.base_url}/api/v4/projects/{str(project.id)}/members',
+            response = self.session.get(f'{self.base_url}/api/v4/projects/{str(project.id)}/members',
                                     headers=headers)
             for user in response.json():
                 user_id = user['id']
                 user_idx = df_user[df_user['git_id'] == user_id].iloc[0]['id']
+                self.member_access_levels[('project', project.id, user_id)] = user.get('access_level')
                 data = {
                     'created_at': now_str,
                     'updated_at': now_str,
@@ -636,11 +1016,12 @@ class GitLabChecker:
             group_id = row['git_id']
 
             headers = {'PRIVATE-TOKEN': self.token}
-            response = requests.get(f'{self.base_url}/api/v4/groups/{str(group_id)}/members/all',
+            response = self.session.get(f'{self.base_url}/api/v4/groups/{str(group_id)}/members/all',
                                     headers=headers)
             for user in response.json():
                 user_id = user['id']
                 user_idx = df_user[df_user['git_id'] == user_id].iloc[0]['id']
+                self.member_access_levels[('group', group_id, user_id)] = user.get('access_level')
                 data = {
                     'created_at': now_str,
                     'updated_at': now_str,
@@ -651,30 +1032,58 @@ class GitLabChecker:
         df = pd.DataFrame(datas)
         self.mysql.insert_t_rel_group_user(df)
 
+    def rebuild_t_rel_project_user_closure(self):
+        self.mysql.rebuild_t_rel_project_user_closure(self.member_access_levels)
+
+    def get_notify_users(self, project_id, min_access_level=None):
+        """
+        项目需要通知的人(直接成员和所属组的成员)
+        :param project_id: project的gitlab id
+        :param min_access_level: gitlab的access_level，比如30(developer)、40(maintainer)
+        """
+        return self.mysql.select_notify_users(project_id, min_access_level)
+
     def insert_t_log_project(self):
         self.mysql.insert_t_log_project(None)
 
-    def insert_t_inspect_batch(self, project_id):
+    def insert_t_inspect_batch(self, project_id, con=None):
         """
         在审查一个项目之前，先查取这个项目的project_id, 向 t_inspect_batch 表插入一条数据
         """
         project = self.get_project_by_id(project_id)
-        batch_id = self.mysql.insert_t_inspect_batch(project.id)
+        batch_id = self.mysql.insert_t_inspect_batch(project.id, con=con)
         return batch_id
 
     def insert_t_base_api(self):
         if not os.path.exists(self.api_path):
             print(f'{self.api_path} 不存在，跳过 insert_t_base_api')
             return
-        df = pd.read_csv(self.api_path, encoding='gb18030', index_col=0)
-        self.mysql.insert_t_base_api(df)
+        with self.metrics.stage(RUN_PROJECT_ID, 'load_api'):
+            df = pd.read_csv(self.api_path, encoding='gb18030', index_col=0,
+                             dtype={column: 'category' for column in API_CATEGORY_COLUMNS})
+            self.mysql.insert_t_base_api(df)
+        self.metrics.add(RUN_PROJECT_ID, 'load_api', rows=len(df))
+        with self.metrics.stage(RUN_PROJECT_ID, 'index_api'):
+            self.api_index = ApiIndex.from_dataframe(df, {project.id: project.name for project in self.projects})
+
+    def search_api(self, query, k=10):
+        """
+        api路径的前缀补全和模糊查找，索引在每次入库t_base_api后重建，还没有入库过时从数据库加载
+        :return: [{api, git_id, project, file, type, distance}]
+        """
+        if self.api_index is None:
+            self.api_index = ApiIndex.from_mysql(self.mysql)
+        return self.api_index.search(query, k)
 
     def insert_t_base_database_url(self):
         if not os.path.exists(self.database_url_file_path):
             print(f'{self.database_url_file_path} 不存在，跳过 insert_t_base_database_url')
             return
-        df = pd.read_csv(self.database_url_file_path, encoding='gb18030', index_col=0)
-        self.mysql.insert_t_base_database_url(df)
+        with self.metrics.stage(RUN_PROJECT_ID, 'load_database_url'):
+            df = pd.read_csv(self.database_url_file_path, encoding='gb18030', index_col=0,
+                             dtype={column: 'category' for column in DATABASE_URL_CATEGORY_COLUMNS})
+            self.mysql.insert_t_base_database_url(df)
+        self.metrics.add(RUN_PROJECT_ID, 'load_database_url', rows=len(df))
 
     def check_project_latest_commit(self, project_id):
         """
@@ -688,118 +1097,511 @@ class GitLabChecker:
         data = self.check_single_commit(project_id, latest_commit_id)
         return data
 
-    def extract_database_url_from_all_project(self):
-        for project in tqdm(self.projects):
-            try:
-                self.init_folder_path()
-                print(f'extract_database_url from {project.name}...')
-                project = self.get_project_by_id(project.id)
-                commits = project.commits.list()
-                if len(commits) == 0:
-                    raise NoCommitException(project.name)
-                latest_commit_id = commits[0].id
-
-                zip_path = os.path.join(self.download_path, 'tmp.zip')
-                dir_path = os.path.join(self.download_path, project.name)
-                self.download_commit(project_id=project.id, commit_id=latest_commit_id, output_path=zip_path)
-                self.unzip(zip_path, dir_path)
+    def get_latest_commit_id(self, project):
+        if self.replay:
+            # 离线重放用缓存里的commit
+            return project.sha
+        with self.metrics.stage(project.id, 'list', project.name):
+            commits = project.commits.list()
+        if len(commits) == 0:
+            raise NoCommitException(project.name)
+        return commits[0].id
 
-                extractor = Extractor(filepath=dir_path)
-                df = extractor.extract_database_url()
-                if len(df) > 0:
-                    df['file'] = df['file'].apply(lambda x: x.replace(os.getcwd(), '').replace('//', '/'))
-                    database_url_file = os.path.join(self.database_url_path, f'{project.name}.csv')
+    def download_latest_commit(self, project, commit_id=None):
+        """
+        下载并解压项目最新的commit，返回解压后的路径
+        zip包和解压目录都带上project.id，多个项目同时扫描时不会互相覆盖
+        """
+        latest_commit_id = commit_id or self.get_latest_commit_id(project)
+        zip_path = self.fetch_archive(project, latest_commit_id)
+        dir_path = os.path.join(self.download_path, f'{project.id}-{project.name}')
+        with self.metrics.stage(project.id, 'unzip', project.name):
+            files, skipped, skipped_bytes = self.extract_archive(zip_path, dir_path, selective=True,
+                                                                 project_name=project.name)
+        self.metrics.add(project.id, 'unzip', files=files)
+        self.metrics.add(project.id, 'unzip_skipped', files=skipped, bytes=skipped_bytes)
+        if skipped:
+            print(f'{project.name} 跳过{skipped}个无关文件, {skipped_bytes / 1024 / 1024:.1f}M')
+        return dir_path
+
+    def fetch_archive(self, project, commit_id):
+        """
+        准备commit的压缩包: 开了archive_cache时先查缓存，没有再下载，下载完放进缓存
+        :return: 压缩包路径，缓存里的压缩包不能删除或者改动
+        """
+        zip_path = os.path.join(self.download_path, f'{project.id}.{self.archive_format}')
+        if self.archive_cache is None:
+            self.download_commit(project_id=project.id, commit_id=commit_id, output_path=zip_path)
+            return zip_path
+        cached = self.archive_cache.get(project.id, commit_id, self.archive_format)
+        if cached is not None:
+            self.metrics.add(project.id, 'download_cached', bytes=os.path.getsize(cached))
+            return cached
+        if self.replay:
+            raise ArchiveNotCachedException(project.name, commit_id)
+        self.download_commit(project_id=project.id, commit_id=commit_id, output_path=zip_path)
+        return self.archive_cache.put(project.id, commit_id, self.archive_format, zip_path,
+                                      {'name': project.name, 'path': getattr(project, 'path', project.name)})
+
+    def sync_mirror(self, project):
+        """
+        增量更新项目的bare仓库，返回默认分支最新的commit sha
+        """
+        with self.metrics.stage(project.id, 'fetch', project.name):
+            self.mirror.sync(project.id, project.http_url_to_repo)
+            sha = self.mirror.resolve(project.id, getattr(project, 'default_branch', None) or 'HEAD')
+        if sha is None:
+            raise NoCommitException(project.name)
+        return sha
 
-                    df['git_id'] = project.id
-                    df.to_csv(database_url_file, encoding='gb18030', index=False)
-            except NoCommitException as e:
-                # 这里catch住没有commit的仓库，不报错，不入库
-                print(e)
-            except extractor.AstNodeException as e:
-                # 这里catch住ast node出问题的仓库，不报错，不入库
-                print(e)
-            except extractor.FilePathException as e:
-                # 路径问题
-                print(e)
-            except zipfile.BadZipFile as e:
-                # 有些zip包是坏的
-                print(e)
-            except UnicodeDecodeError as e:
-                # 文件编码问题
-                print(e)
-            except gitlab.exceptions.GitlabListError as e:
-                # gitlab内部错误
-                print(e)
+    def get_extractor(self, project):
+        """
+        按source_backend准备项目最新commit的Extractor
+        archive: 下载压缩包并解压；mirror: 在本地bare仓库上直接读取，不解压
+        """
+        if self.source_backend == 'mirror':
+            sha = self.sync_mirror(project)
+            started_at = time.time()
+            extractor = GitTreeExtractor(self.mirror, project.id, sha, max_file_bytes=self.max_member_mb * 1024 * 1024,
+                                         keep=self.is_indexed)
+            try:
+                ResourceGuard(self, project.name, started_at).check_total(extractor.total_files,
+                                                                          extractor.total_bytes)
+            except ResourceLimitException:
+                extractor.close()
+                raise
+        else:
+            sha = self.get_latest_commit_id(project)
+            # 下载有单独的archive_timeout，解压和提取各自按max_extract_seconds限制
+            extractor = Extractor(filepath=self.download_latest_commit(project, sha))
+            started_at = time.time()
+        extractor.commit_id = sha
+        extractor.project_name = project.name
+        extractor.started_at = started_at
+        extractor.timeout = self.limit_extract_seconds
+        extractor.max_line_length = self.limit_line_kb * 1024
+        return extractor
+
+    def clean_project_download(self, project):
+        for path in [os.path.join(self.download_path, f'{project.id}.{self.archive_format}'),
+                     os.path.join(self.download_path, f'{project.id}-{project.name}')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def write_csv(self, df, path):
+        # 先写临时文件再替换，合并csv的时候不会读到写了一半的文件
+        tmp_path = f'{path}.tmp'
+        df.to_csv(tmp_path, encoding='gb18030', index=False)
+        os.replace(tmp_path, path)
+
+    def record_detector_metrics(self, project, extractor, parent):
+        """
+        读取解码文件和各检测器的耗时包含在parent阶段里，记成 parent/read、parent/<检测器> 子阶段，不重复计入项目总耗时
+        """
+        for name, stats in getattr(extractor, 'detector_stats', {}).items():
+            self.metrics.add_sub_stage(project.id, parent, name.replace('Detector', ''), seconds=stats['seconds'],
+                                       files=stats['files'], rows=stats.get('rows', 0))
+
+    def write_database_url_csv(self, project, df):
+        database_url_file = os.path.join(self.database_url_path, f'{project.name}.csv')
+        if len(df) > 0:
+            df['file'] = df['file'].apply(lambda x: x.replace(os.getcwd(), '').replace('//', '/'))
+            df['git_id'] = project.id
+            self.write_csv(df, database_url_file)
+            self.stream_rows('t_base_database_url', database_url_file, df)
+        elif os.path.exists(database_url_file):
+            # 最新的commit里已经没有数据库链接了
+            os.remove(database_url_file)
+
+    def write_api_csv(self, project, extractor, df):
+        frontend_api_file = os.path.join(self.frontend_api_path, f'{project.name}.csv')
+        backend_api_file = os.path.join(self.backend_api_path, f'{project.name}.csv')
+        for api_file in [frontend_api_file, backend_api_file]:
+            if os.path.exists(api_file):
+                os.remove(api_file)
+        if len(df) > 0:
+            df['file'] = df['file'].apply(lambda x: x.replace(os.getcwd(), '').replace('//', '/'))
+            if extractor.project_type == 'frontend':
+                api_file, api_type = frontend_api_file, 'frontend'
+            else:
+                api_file, api_type = backend_api_file, 'backend'
+            df['git_id'] = project.id
+            self.write_csv(df, api_file)
+            self.stream_rows('t_base_api', api_file, df.assign(type=api_type))
 
-        df_database_url = pd.DataFrame()
-        for csv in glob(os.path.join(self.database_url_path, '*.csv')):
-            print(csv)
-            df = pd.read_csv(csv, encoding='gb18030')
-            df_database_url = df_database_url.append(df)
+    def extract_database_url_from_project(self, project, extractor=None):
+        """
+        提取单个项目最新commit里的数据库链接，写入database_url_path下的csv
+        """
+        return self.extract_all_from_project(project, extractor, ['database_url']).get('database_url', pd.DataFrame())
 
-        df_database_url.index = range(len(df_database_url))
-        df_database_url.to_csv(self.database_url_file_path, encoding='gb18030')
-        self.insert_t_base_database_url()
+    def extract_api_from_project(self, project, extractor=None):
+        """
+        提取单个项目最新commit里的api，前端和后端分别写入frontend_api_path、backend_api_path下的csv
+        """
+        return self.extract_all_from_project(project, extractor, ['api']).get('api', pd.DataFrame())
 
-    def extract_api_from_all_project(self):
+    def extract_all_from_project(self, project, extractor=None, names=None):
+        """
+        一次遍历同时提取api和数据库链接，每个文件只读一次，代码索引也用这次读到的内容
+        :param names: 只运行这些name的检测器(api、database_url)，也只更新这些name的csv，None为全部
+        :return: {name: DataFrame}
+        """
+        if extractor is None:
+            with self.profile_project(project.id, 'extract', project.name):
+                with self.get_extractor(project) as extractor:
+                    return self.extract_all_from_project(project, extractor, names)
+        if self.code_index is not None and not self.code_index.is_current(project.id,
+                                                                          getattr(extractor, 'commit_id', None)):
+            # 代码索引要重建时，检测器读过的文件留给索引用
+            extractor.read_cache = {}
+        with self.metrics.stage(project.id, 'extract', project.name):
+            results = extractor.extract(names)
+        self.record_detector_metrics(project, extractor, 'extract')
+        self.index_code(project, extractor)
+        api_df = results.get('api', pd.DataFrame())
+        database_url_df = results.get('database_url', pd.DataFrame())
+        self.metrics.add(project.id, 'extract', rows=len(api_df) + len(database_url_df))
+        if names is None or 'api' in names:
+            self.write_api_csv(project, extractor, api_df)
+        if names is None or 'database_url' in names:
+            self.write_database_url_csv(project, database_url_df)
+        return results
+
+    def index_code(self, project, extractor):
+        """
+        更新项目的代码索引，commit没变时跳过，索引失败不影响api的提取结果
+        """
+        if self.code_index is None:
+            return
+        try:
+            with self.metrics.stage(project.id, 'index_code', project.name):
+                files = self.code_index.update(project.id, project.name, getattr(extractor, 'commit_id', None),
+                                               extractor)
+            if files is not None:
+                self.metrics.add(project.id, 'index_code', files=files)
+        except Exception as e:
+            print(f'{project.name} 代码索引更新失败: {e}')
+        finally:
+            extractor.read_cache = None
+
+    def search_code(self, pattern, regex=False, ignore_case=True, max_results=100):
+        """
+        在所有项目最新commit的源码里搜索字面量或正则
+        :return: [{project_id, project, sha, file, line, text}]
+        """
+        if self.code_index is None:
+            return []
+        results, stats = self.code_index.search(pattern, regex=regex, ignore_case=ignore_case,
+                                                max_results=max_results)
+        print(f'代码搜索 {pattern}: 共{stats["files"]}个文件, 候选{stats["candidates"]}个, 打开{stats["opened"]}个')
+        return results
+
+    def scan_project(self, project_id):
+        """
+        扫描单个项目的api和数据库链接，只更新该项目的csv，入库由merge_api/merge_database_url完成
+        给ScanScheduler调用，扫描完删除下载的文件
+        """
+        try:
+            project = self.get_project_by_id(project_id)
+        except Exception:
+            # webhook推过来的新项目
+            project = self.gl.projects.get(project_id)
+            self.projects.append(project)
+        try:
+            self.extract_all_from_project(project)
+        except Exception as e:
+            self.metrics.skip(project.id, repr(e), project.name)
+            raise
+        finally:
+            self.clean_project_download(project)
+
+    def extract_from_all_project(self, names=None):
+        """
+        全量扫描: 每个项目只下载、解压、遍历一次，api和数据库链接的检测器在同一次遍历里运行，
+        两张表同时边扫描边入库，最后合并csv
+        :param names: 只扫描这些name(api、database_url)，None为全部
+        """
+        names = names or ['api', 'database_url']
+        self.metrics = ScanMetrics('extract' if len(names) > 1 else f'extract_{names[0]}')
+        tables = {'api': 't_base_api', 'database_url': 't_base_database_url'}
+        for name in names:
+            self.start_stream_load(tables[name])
         for project in tqdm(self.projects):
             try:
                 self.init_folder_path()
-                print(f'extract_api from {project.name}...')
-                project = self.get_project_by_id(project.id)
-                commits = project.commits.list()
-                if len(commits) == 0:
-                    raise NoCommitException(project.name)
-                latest_commit_id = commits[0].id
-
-                zip_path = os.path.join(self.download_path, 'tmp.zip')
-                dir_path = os.path.join(self.download_path, project.name)
-                self.download_commit(project_id=project.id, commit_id=latest_commit_id, output_path=zip_path)
-                self.unzip(zip_path, dir_path)
-
-                extractor = Extractor(filepath=dir_path)
-                df = extractor.extract_api()
-                if len(df) > 0:
-                    df['file'] = df['file'].apply(lambda x: x.replace(os.getcwd(), '').replace('//', '/'))
-                    if extractor.project_type == 'frontend':
-                        api_file = os.path.join(self.frontend_api_path, f'{project.name}.csv')
-                    else:
-                        api_file = os.path.join(self.backend_api_path, f'{project.name}.csv')
-                    df['git_id'] = project.id
-                    df.to_csv(api_file, encoding='gb18030', index=False)
-            except NoCommitException as e:
-                # 这里catch住没有commit的仓库，不报错，不入库
-                print(e)
-            except FilePathException as e:
-                # 路径问题
-                print(e)
-            except zipfile.BadZipFile as e:
-                # 有些zip包是坏的
-                print(e)
-            except UnicodeDecodeError as e:
-                # 文件编码问题
-                print(e)
-            except gitlab.exceptions.GitlabListError as e:
-                # gitlab内部错误
+                print(f'extract {"、".join(names)} from {project.name}...')
+                self.extract_all_from_project(project, names=names)
+            except SKIP_EXCEPTIONS as e:
+                # 没有commit、压缩包坏了或者太大、超过资源限制等，只跳过这个项目
                 print(e)
+                self.metrics.skip(project.id, str(e), project.name)
+            except Exception as e:
+                # 其他异常只跳过这个项目，不中断整轮扫描
+                print(f'{project.name} 扫描失败: {e!r}')
+                self.metrics.skip(project.id, repr(e), project.name)
+            finally:
+                self.clean_project_download(project)
+
+        if 'api' in names:
+            self.merge_api()
+        if 'database_url' in names:
+            self.merge_database_url()
+        self.finish_metrics()
+
+    def extract_database_url_from_all_project(self):
+        self.extract_from_all_project(['database_url'])
+
+    def start_stream_load(self, table):
+        """
+        全量扫描开始前建好影子表并启动后台入库线程，每个项目扫完结果就写进影子表，扫描和入库同时进行，
+        merge_api/merge_database_url时等剩下的写完再把影子表换上去
+        """
+        if not self.batch_writer_enabled:
+            return
+        self.mysql.create_shadow_table(table)
+        self.streamed[table] = set()
+        self.writers[table] = BatchWriter(self.mysql, max_rows=self.batch_writer_max_rows,
+                                          batch_rows=self.batch_writer_batch_rows,
+                                          flush_seconds=self.batch_writer_flush_seconds)
 
-        df_back = pd.DataFrame()
-        df_front = pd.DataFrame()
-        for csv in glob(os.path.join(self.backend_api_path, '*.csv')):
-            df = pd.read_csv(csv, encoding='gb18030')
-            df_back = df_back.append(df)
-        for csv in glob(os.path.join(self.frontend_api_path, '*.csv')):
-            df = pd.read_csv(csv, encoding='gb18030')
-            df_front = df_front.append(df)
-
-        df_back.index = range(len(df_back))
-        df_front.index = range(len(df_front))
-        # df_front.to_csv('data/前端api.csv', encoding='gb18030')
-        # df_back.to_csv('data/后端api.csv', encoding='gb18030')
-        df_front['type'] = 'frontend'
-        df_back['type'] = 'backend'
-        df = df_front.append(df_back)
-        df = df[['file', 'api', 'line', 'git_id', 'type']]
+    def stream_rows(self, table, csv, df):
+        """
+        把一个项目的结果交给后台入库线程，队列满时在这里等(背压)
+        入库出错时停掉这个表的后台入库，扫描继续，结束时改为合并csv整表入库
+        """
+        writer = self.writers.get(table)
+        if writer is None:
+            return
+        try:
+            writer.put(self.mysql.shadow_table(table), self.mysql.replace_rows(table, df))
+        except BatchWriterException as e:
+            print(f'{e}，{table}改为扫描结束后合并csv入库')
+            self.writers.pop(table)
+            return
+        self.streamed[table].add(csv)
+
+    def finish_stream_load(self, table, groups, stage):
+        """
+        这次没有写进影子表的csv(扫描失败的项目保留着上一次的csv，和merge_csvs一样要入库)补进去，
+        等后台入库写完，再把影子表换上去
+        :param groups: 和merge_csvs一样的[(csv路径列表, {常量列: 值})]
+        :return: 是否换上了影子表，没有启动后台入库或者入库失败时返回False，由调用方整表入库
+        """
+        writer = self.writers.pop(table, None)
+        if writer is None:
+            return False
+        shadow = self.mysql.shadow_table(table)
+        try:
+            # 扫描期间已经写了大部分，这里只剩最后一批和补进去的csv
+            with self.metrics.stage(RUN_PROJECT_ID, stage):
+                with writer:
+                    for paths, constants in groups:
+                        for csv in paths:
+                            if csv not in self.streamed[table]:
+                                df = pd.read_csv(csv, encoding='gb18030').assign(**constants)
+                                writer.put(shadow, self.mysql.replace_rows(table, df))
+                self.mysql.swap_shadow_table(table)
+        except BatchWriterException as e:
+            print(f'{e}，改为合并csv整表入库')
+            return False
+        self.mysql.bump_generation(table)
+        stats = writer.stats
+        self.metrics.add(RUN_PROJECT_ID, stage, rows=stats['rows'])
+        print(f"{table} 入库数量: {stats['rows']}, 事务{stats['batches']}个, 写入{stats['write']:.1f}s, "
+              f"扫描等待入库{stats['blocked']:.1f}s")
+        return True
+
+    def merge_csvs(self, groups, category_columns):
+        """
+        合并各项目的csv，category_columns用pandas category(字典编码)存储，
+        每个csv读进来就是category，再用union_categoricals合并，整个过程不会把重复的路径展开成一个个str对象
+        :param groups: [(csv路径列表, {常量列: 值})]，比如前端api的csv都补上type='frontend'
+        :return: DataFrame
+        """
+        frames = []
+        for paths, constants in groups:
+            for csv in paths:
+                df = pd.read_csv(csv, encoding='gb18030', dtype={column: 'category' for column in category_columns})
+                for column, value in constants.items():
+                    df[column] = pd.Categorical([value] * len(df))
+                for column in category_columns:
+                    if column not in df.columns:
+                        df[column] = pd.Categorical([None] * len(df))
+                if 'count' not in df.columns:
+                    # 旧版本的csv没有去重，每行出现一次
+                    df['count'] = 1
+                frames.append(df)
+        if len(frames) == 0:
+            return pd.DataFrame()
+        categories = {column: union_categoricals([df[column] for df in frames]) for column in category_columns}
+        df = pd.concat([df.drop(columns=category_columns) for df in frames], ignore_index=True)
+        for column, values in categories.items():
+            df[column] = values
+        for column in ['git_id', 'count']:
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+        return df
+
+    def merge_database_url(self):
+        groups = [(glob(os.path.join(self.database_url_path, '*.csv')), {})]
+        loaded = self.finish_stream_load('t_base_database_url', groups, 'load_database_url')
+        df_database_url = self.merge_csvs(groups, DATABASE_URL_CATEGORY_COLUMNS)
+        df_database_url.to_csv(self.database_url_file_path, encoding='gb18030')
+        if not loaded:
+            self.insert_t_base_database_url()
+
+    def extract_api_from_all_project(self):
+        self.extract_from_all_project(['api'])
+
+    def merge_api(self):
+        groups = [(glob(os.path.join(self.frontend_api_path, '*.csv')), {'type': 'frontend'}),
+                  (glob(os.path.join(self.backend_api_path, '*.csv')), {'type': 'backend'})]
+        loaded = self.finish_stream_load('t_base_api', groups, 'load_api')
+        df = self.merge_csvs(groups, API_CATEGORY_COLUMNS)
+        if len(df) > 0:
+            df = df[['file', 'api', 'line', 'git_id', 'type', 'count']]
         df.to_csv(self.api_path, encoding='gb18030')
 
-        self.insert_t_base_api()
+        if not loaded:
+            self.insert_t_base_api()
+            return
+        # 已经边扫描边入库了，只重建内存索引
+        with self.metrics.stage(RUN_PROJECT_ID, 'index_api'):
+            self.api_index = ApiIndex.from_dataframe(df, {project.id: project.name for project in self.projects}) \
+                if len(df) > 0 else None
+
+    def reload(self):
+        # 合并各项目的csv并入库，同时输出这段时间的扫描统计
+        self.merge_api()
+        self.merge_database_url()
+        metrics, self.metrics = self.metrics, ScanMetrics('scheduler')
+        self.finish_metrics(metrics)
+
+    def build_api_history(self, project_id):
+        """
+        增量更新项目的api生命周期索引(t_api_history)，不管source配置都通过本地bare仓库读取git历史
+        从上次处理到的commit继续，沿first-parent只提取每个commit改动的文件；上次的commit不在历史上(强推)时从头重建
+        :return: 这次处理的commit数
+        """
+        if self.mirror is None:
+            self.mirror = GitMirror(self.mirror_path, token=self.token)
+        project = self.get_project_by_id(project_id)
+        sha = self.sync_mirror(project)
+        state = self.mysql.select_t_api_history_state(project.id)
+        if state is not None and state['sha'] == sha:
+            return 0
+        if state is not None and not self.mirror.is_ancestor(project.id, state['sha'], sha):
+            print(f'{project.name} 的历史被改写过，api历史从头重建')
+            self.mysql.delete_t_api_history(project.id)
+            state = None
+        history = ApiHistory(self.mirror, project.id, max_file_bytes=self.max_member_mb * 1024 * 1024,
+                             max_line_length=self.limit_line_kb * 1024)
+        since = state['sha'] if state is not None else None
+        batch = 0
+        try:
+            with self.metrics.stage(project.id, 'api_history', project.name):
+                if state is not None:
+                    history.restore(state['sha'], str(state['committed_at']),
+                                    self.mirror.ls_tree(project.id, state['sha']),
+                                    self.mysql.select_open_t_api_history(project.id))
+                for commit_sha, committed_at, changes in self.mirror.log_changes(project.id, sha,
+                                                                                 since=since):
+                    committed_at = datetime.datetime.fromisoformat(committed_at).astimezone().strftime(
+                        '%Y-%m-%d %H:%M:%S')
+                    history.apply(commit_sha, committed_at, changes)
+                    batch += 1
+                    if batch >= self.api_history_batch_commits:
+                        self.save_api_history(project, history, batch)
+                        batch = 0
+                if batch:
+                    self.save_api_history(project, history, batch)
+        finally:
+            history.close()
+        self.metrics.add(project.id, 'api_history', files=history.files, rows=history.commits)
+        print(f'{project.name} api历史: {history.commits}个commit, 重新提取{history.files}个文件, '
+              f'当前{len(history.intervals)}个api')
+        return history.commits
+
+    def save_api_history(self, project, history, commits):
+        opened, closed = history.pop_changes()
+        self.mysql.save_t_api_history(project.id, opened, closed, history.sha, history.committed_at, commits)
+
+    def api_history(self, api, project_id=None):
+        """
+        查api什么时候出现、什么时候被哪个commit删除
+        """
+        return self.mysql.select_api_history(api.strip(), project_id)
+
+    def scan_shard(self, run_id, kind='scan', enqueue=True, wait=True, load=False):
+        """
+        多节点分片扫描: 各节点用同一个run_id从t_scan_job认领项目，崩溃节点的项目在租约过期后被其他节点接管
+        :param kind: scan(提取api和数据库链接，结果写各项目的csv) / inspect(审查最新commit并入库)
+        :param enqueue: 把gitlab上全部项目加入这一轮，已经加入的跳过
+        :param wait: 认领不到任务时等其他节点扫完，以便接管崩溃节点的任务
+        :param load: kind为scan且这一轮全部完成后合并csv入库，多节点时要求各节点的csv目录是共享的
+        :return: 本节点处理的{status: 任务数}
+        """
+        cfg = self.scan_queue_cfg
+        queue = ScanJobQueue(self.mysql, run_id, kind, self.base_url,
+                             lease_seconds=int(cfg.get('lease_seconds') or 300),
+                             heartbeat_seconds=int(cfg.get('heartbeat_seconds') or 60),
+                             max_attempts=int(cfg.get('max_attempts') or 3),
+                             poll_seconds=int(cfg.get('poll_seconds') or 30))
+        if enqueue:
+            project_ids = [project.id for project in self.gl.projects.list(all=True)]
+            print(f'run {run_id} 新加入{queue.enqueue(project_ids)}个项目，共{len(project_ids)}个')
+        self.metrics = ScanMetrics(f'shard_{kind}')
+
+        def handler(project_id):
+            self.init_folder_path()
+            if kind == 'inspect':
+                self.check_project_latest_commit_and_insert(project_id)
+            else:
+                self.scan_project(project_id)
+
+        def retryable(e):
+            # 项目本身的问题重试也没用，网络、gitlab、数据库的问题换个时间或者换个节点重试
+            return not isinstance(e, PROJECT_EXCEPTIONS)
+
+        self.scan_queue = queue
+        try:
+            counts = queue.run(handler, retryable=retryable, wait=wait)
+        finally:
+            self.scan_queue = None
+        print(f'run {run_id} 本节点: {counts}, 全部: {queue.progress()}')
+        if load and kind == 'scan' and queue.is_finished():
+            self.merge_api()
+            self.merge_database_url()
+        self.finish_metrics()
+        return counts
+
+    def run_scheduler(self):
+        """
+        常驻模式：按活跃度调度扫描，push webhook触发的项目在debounce之后重新扫描，
+        其余项目每sweep_interval_hours轮询一遍
+        """
+        cfg = self.scheduler_cfg
+        self.metrics = ScanMetrics('scheduler')
+        half_life_hours = float(cfg.get('activity_half_life_hours') or 168)
+        scheduler = ScanScheduler(self.scan_project, reload_func=self.reload,
+                                  debounce=float(cfg.get('debounce_seconds') or 60),
+                                  max_delay=float(cfg.get('max_delay_seconds') or 300),
+                                  max_concurrent=int(cfg.get('max_concurrent') or 2),
+                                  sweep_interval=float(cfg.get('sweep_interval_hours') or 24) * 3600,
+                                  reload_interval=float(cfg.get('reload_interval_seconds') or 300),
+                                  half_life_hours=half_life_hours)
+        scheduler.add_projects([(project.id, activity_score(getattr(project, 'last_activity_at', None),
+                                                            half_life_hours))
+                                for project in self.projects])
+        server = WebhookServer(scheduler, host=cfg.get('host') or '127.0.0.1', port=int(cfg.get('port') or 8787),
+                               secret=cfg.get('secret') or '')
+        server.start()
+        print(f'webhook listening on {server.server_address[0]}:{server.server_address[1]}')
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            scheduler.stop()
+        finally:
+            server.shutdown()
@@ -0,0 +1,138 @@
+"""
+数据库结构的版本迁移
+create_tables只负责建表(CREATE TABLE IF NOT EXISTS)，表建好之后的变化(加索引等)按版本号写成迁移步骤，
+t_schema_version记录已经执行过的版本，每次启动只执行没执行过的步骤
+MySQL的DDL会隐式提交，一个步骤不能整体回滚，所以每个步骤都写成可以重复执行的(已有的索引跳过)
+"""
+import re
+import datetime
+from sqlalchemy import text
+
+# 索引: (索引名, 类型, 字段)，字段里可以带前缀长度，比如api(191)
+# 各表的连接字段和搜索字段
+TABLE_INDEXES = {
+    't_base_project': [('idx_git_id', 'KEY', ['git_id']),
+                       ('idx_name', 'KEY', ['name'])],
+    't_base_user': [('idx_git_id', 'KEY', ['git_id']),
+                    ('idx_username', 'KEY', ['username'])],
+    't_base_group': [('idx_git_id', 'KEY', ['git_id'])],
+    't_rel_project_user': [('idx_project_user', 'KEY', ['project_id', 'user_id']),
+                           ('idx_user', 'KEY', ['user_id'])],
+    't_rel_project_group': [('idx_project', 'KEY', ['project_id']),
+                            ('idx_group', 'KEY', ['group_id'])],
+    't_rel_group_user': [('idx_group_user', 'KEY', ['group_id', 'user_id']),
+                         ('idx_user', 'KEY', ['user_id'])],
+    't_inspect_batch': [('idx_project_created', 'KEY', ['project_id', 'created_at'])],
+    't_inspect_details': [('idx_batch', 'KEY', ['batch_id']),
+                          ('idx_error_type', 'KEY', ['error_type'])],
+    't_log_project': [('idx_project', 'KEY', ['project_id'])],
+    't_login_user': [('idx_username', 'KEY', ['username'])],
+}
+
+# 整表重新入库(to_sql建表)的表，to_sql建的表没有主键和索引，每次入库时在影子表上补上再换过去
+REPLACE_TABLE_INDEXES = {
+    't_base_api': [('PRIMARY', 'PRIMARY KEY', ['id']),
+                   ('idx_git_id', 'KEY', ['git_id']),
+                   ('idx_api', 'KEY', ['api(191)'])],
+    't_base_database_url': [('PRIMARY', 'PRIMARY KEY', ['id']),
+                            ('idx_git_id', 'KEY', ['git_id']),
+                            ('idx_database_url', 'KEY', ['database_url(191)'])],
+    't_rel_project_host': [('PRIMARY', 'PRIMARY KEY', ['id'])],
+}
+
+
+def table_exists(con, table):
+    return con.execute(f"SHOW TABLES LIKE '{table}'").fetchone() is not None
+
+
+def ensure_indexes(con, table, indexes):
+    """
+    补上表里还没有的索引，字段不存在的索引跳过(比如to_sql写入空DataFrame建出来的表)
+    :return: 新加的索引名
+    """
+    existing = {row[2] for row in con.execute(f'SHOW INDEX FROM `{table}`').fetchall()}
+    columns = {row[0] for row in con.execute(f'SHOW COLUMNS FROM `{table}`').fetchall()}
+    clauses = []
+    added = []
+    for name, kind, fields in indexes:
+        if name in existing or any(re.sub(r'\(\d+\)$', '', field) not in columns for field in fields):
+            continue
+        definition = ', '.join(re.sub(r'^(\w+)', r'`\1`', field) for field in fields)
+        clauses.append(f'ADD {kind} ({definition})' if kind == 'PRIMARY KEY' else f'ADD {kind} `{name}` ({definition})')
+        added.append(name)
+    if clauses:
+        # 一条ALTER加完一个表的所有索引，只重建一次表
+        con.execute(f'ALTER TABLE `{table}` {", ".join(clauses)}')
+    return added
+
+
+def add_search_indexes(con):
+    for table, indexes in TABLE_INDEXES.items():
+        ensure_indexes(con, table, indexes)
+
+
+def add_replace_table_keys(con):
+    for table, indexes in REPLACE_TABLE_INDEXES.items():
+        if table_exists(con, table):
+            ensure_indexes(con, table, indexes)
+
+
+MIGRATION_LOCK = 'insights_schema_migrate'
+MIGRATION_LOCK_TIMEOUT = 600
+
+
+class MigrationLockException(Exception):
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+
+    def __str__(self):
+        return f'schema迁移: {self.timeout}s内没有拿到命名锁 {self.name}，可能有其他进程正在迁移'
+
+
+# (版本, 名字, 执行函数)，只能在末尾追加，已经发布的步骤不要修改
+MIGRATIONS = [
+    (1, 'add_search_indexes', add_search_indexes),
+    (2, 'add_replace_table_keys', add_replace_table_keys),
+]
+
+
+def migrate(engine, migrations=None):
+    """
+    执行还没执行过的迁移步骤
+    :return: 这次执行的版本号
+    """
+    migrations = MIGRATIONS if migrations is None else migrations
+    applied = []
+    with engine.connect() as con:
+        # 每一段都显式begin/commit，不依赖SQLAlchemy 1.x连接上的自动提交；命名锁属于连接，不受事务提交影响
+        with con.begin():
+            # 进程池的每个worker启动时都会建Mysql，用MySQL的命名锁保证同一时间只有一个进程在迁移
+            locked = con.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                                 {'name': MIGRATION_LOCK, 'timeout': MIGRATION_LOCK_TIMEOUT}).scalar()
+        if locked != 1:
+            # 0是等待超时，NULL是出错，都不能在没有锁的情况下迁移
+            raise MigrationLockException(MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT)
+        try:
+            with con.begin():
+                con.execute(text('CREATE TABLE IF NOT EXISTS t_schema_version('
+                                 '`version` INT NOT NULL PRIMARY KEY,'
+                                 '`name` VARCHAR(128) NOT NULL,'
+                                 '`applied_at` TIMESTAMP NOT NULL)'))
+                done = {row[0] for row in con.execute(text('SELECT version FROM t_schema_version')).fetchall()}
+            for version, name, step in sorted(migrations, key=lambda m: m[0]):
+                if version in done:
+                    continue
+                print(f'schema迁移 {version} {name}...')
+                # 步骤里的DDL会隐式提交，版本号的INSERT在这个事务结束时提交
+                with con.begin():
+                    step(con)
+                    con.execute(text('INSERT INTO t_schema_version (version, name, applied_at) '
+                                     'VALUES (:version, :name, :now)'),
+                                {'version': version, 'name': name,
+                                 'now': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+                applied.append(version)
+        finally:
+            with con.begin():
+                con.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': MIGRATION_LOCK})
+    return applied
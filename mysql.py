@@ -1,22 +1,59 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
 import pandas as pd
 import datetime
 import pymysql
 import numpy as np
+from utils.query_cache import QueryCache
+from migrations import migrate, ensure_indexes, table_exists, REPLACE_TABLE_INDEXES
+
+# 整表重新入库并且可以边扫描边写入的表: [(字段, 类型)]，影子表按这个建，id自增，入库时不用自己分配id
+REPLACE_TABLE_COLUMNS = {
+    't_base_api': [('file', 'TEXT'), ('api', 'TEXT'), ('line', 'VARCHAR(32)'), ('git_id', 'BIGINT'),
+                   ('type', 'VARCHAR(32)'), ('count', 'INT'), ('created_at', 'DATETIME'), ('updated_at', 'DATETIME')],
+    't_base_database_url': [('file', 'TEXT'), ('database_url', 'TEXT'), ('line', 'VARCHAR(32)'), ('text', 'MEDIUMTEXT'),
+                            ('git_id', 'BIGINT'), ('count', 'INT'), ('created_at', 'DATETIME'),
+                            ('updated_at', 'DATETIME')],
+}
 
 class Mysql:
-    def __init__(self, username, password, host, port, database):
+    def __init__(self, username, password, host, port, database, cache_size=1024, cache_ttl=300, generation_ttl=5):
+        """
+        :param cache_size: 搜索结果缓存的条数，0表示不缓存
+        :param cache_ttl: 搜索结果缓存的秒数
+        :param generation_ttl: 表的generation缓存的秒数，其他进程重新入库后最多这么久才发现，
+        0表示每次查询都重新读
+        """
         self.username = username
         self.password = password
         self.host = host
         self.port = port
         self.database = database
         self.create_database()
+        # 后台入库线程每个事务从连接池取连接，pre_ping和recycle避免拿到被服务端断开的空闲连接
         self.engine = create_engine(
-            f'mysql+pymysql://{self.username}:{self.password}@{self.host}:{self.port}/{self.database}?charset=utf8')
+            f'mysql+pymysql://{self.username}:{self.password}@{self.host}:{self.port}/{self.database}?charset=utf8',
+            pool_pre_ping=True, pool_recycle=3600)
+        self.cache = QueryCache(cache_size, cache_ttl)
+        self.generations = QueryCache(64, generation_ttl)
         self.create_tables()
         # self.con = self.engine.connect()
 
+    @classmethod
+    def from_url(cls, url, create_tables=False, cache_size=1024, cache_ttl=300, generation_ttl=5):
+        """
+        不经过create_database，直接用sqlalchemy的url连接，benchmark里用sqlite时使用
+        建表语句是MySQL方言，非MySQL的库create_tables要为False
+        """
+        mysql = cls.__new__(cls)
+        mysql.username = mysql.password = mysql.host = mysql.port = mysql.database = None
+        mysql.engine = create_engine(url)
+        mysql.cache = QueryCache(cache_size, cache_ttl)
+        mysql.generations = QueryCache(64, generation_ttl)
+        if create_tables:
+            mysql.create_tables()
+        return mysql
+
     def create_database(self):
         with pymysql.connect(host=self.host, user=self.username, password=self.password,
                              cursorclass=pymysql.cursors.DictCursor) as con:
@@ -110,6 +147,108 @@ class Mysql:
                             '`location` VARCHAR(128) NOT NULL,' \
                             '`content` VARCHAR(512) NOT NULL)' \
 
+        # 每个batch每种error_type的错误数量，在insert_t_inspect_details时增量维护，画趋势图用
+        t_inspect_rollup = 'CREATE TABLE IF NOT EXISTS t_inspect_rollup(' \
+                           '`id` BIGINT(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,' \
+                           '`created_at` TIMESTAMP NOT NULL,' \
+                           '`updated_at` TIMESTAMP NOT NULL,' \
+                           '`project_id` INT NOT NULL,' \
+                           '`batch_id` INT NOT NULL,' \
+                           '`git_commit_id` VARCHAR(64) NOT NULL,' \
+                           '`error_type` VARCHAR(128) NOT NULL,' \
+                           '`error_count` INT NOT NULL,' \
+                           'UNIQUE KEY `uk_batch_error_type` (`batch_id`, `error_type`),' \
+                           'KEY `idx_project_batch` (`project_id`, `batch_id`))'
+
+        # 每次扫描每个项目每个阶段的耗时，project_id是gitlab的project id，0表示整次扫描的阶段
+        t_scan_metrics = 'CREATE TABLE IF NOT EXISTS t_scan_metrics(' \
+                         '`id` BIGINT(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,' \
+                         '`created_at` TIMESTAMP NOT NULL,' \
+                         '`updated_at` TIMESTAMP NOT NULL,' \
+                         '`run_id` VARCHAR(32) NOT NULL,' \
+                         '`run_kind` VARCHAR(32) NOT NULL,' \
+                         '`project_id` INT NOT NULL,' \
+                         '`project_name` VARCHAR(64),' \
+                         '`stage` VARCHAR(32) NOT NULL,' \
+                         '`seconds` DOUBLE NOT NULL,' \
+                         '`bytes` BIGINT NOT NULL DEFAULT 0,' \
+                         '`files` INT NOT NULL DEFAULT 0,' \
+                         '`row_count` INT NOT NULL DEFAULT 0,' \
+                         '`status` VARCHAR(255),' \
+                         'KEY `idx_run_kind_run_id` (`run_kind`, `run_id`),' \
+                         'KEY `idx_project_stage` (`project_id`, `stage`))'
+
+        # 项目到用户的闭包: 直接成员(source=direct, group_id=0)和通过项目所属组得到的成员(source=group)
+        # 每次同步完gitlab的项目、用户、组和成员关系后全量重建，id都已经换算好，查通知对象只需要读这一张表
+        t_rel_project_user_closure = 'CREATE TABLE IF NOT EXISTS t_rel_project_user_closure(' \
+                                     '`id` BIGINT(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,' \
+                                     '`created_at` TIMESTAMP NOT NULL,' \
+                                     '`updated_at` TIMESTAMP NOT NULL,' \
+                                     '`project_id` INT NOT NULL,' \
+                                     '`project_git_id` INT NOT NULL,' \
+                                     '`user_id` INT NOT NULL,' \
+                                     '`user_git_id` INT NOT NULL,' \
+                                     '`username` VARCHAR(32) NOT NULL,' \
+                                     '`name` VARCHAR(32) NOT NULL,' \
+                                     '`email` VARCHAR(128),' \
+                                     '`source` VARCHAR(16) NOT NULL,' \
+                                     '`group_id` INT NOT NULL DEFAULT 0,' \
+                                     '`access_level` INT,' \
+                                     '`notice` TINYINT(1) DEFAULT 1,' \
+                                     'UNIQUE KEY `uk_project_user_source` (`project_git_id`, `user_id`, `source`, `group_id`),' \
+                                     'KEY `idx_user` (`user_id`))'
+
+        # 整表重新入库的表(t_base_api、t_base_database_url、t_rel_project_user_closure)每入库一次generation加1，搜索缓存以此判断结果是否过时
+        t_meta_generation = 'CREATE TABLE IF NOT EXISTS t_meta_generation(' \
+                            '`table_name` VARCHAR(64) NOT NULL PRIMARY KEY,' \
+                            '`generation` BIGINT NOT NULL,' \
+                            '`updated_at` TIMESTAMP NOT NULL)'
+
+        # 分布式扫描的任务表，一轮(run_id)里每个项目一行，多个节点通过租约(lease_token + lease_expires_at)认领
+        # 节点崩溃后租约过期，其他节点重新认领；kind为scan(提取api和数据库链接)或者inspect(审查入库)
+        t_scan_job = 'CREATE TABLE IF NOT EXISTS t_scan_job(' \
+                     '`id` BIGINT(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,' \
+                     '`created_at` TIMESTAMP NOT NULL,' \
+                     '`updated_at` TIMESTAMP NOT NULL,' \
+                     '`run_id` VARCHAR(32) NOT NULL,' \
+                     '`kind` VARCHAR(16) NOT NULL,' \
+                     '`domain` VARCHAR(256) NOT NULL,' \
+                     '`project_id` INT NOT NULL,' \
+                     '`status` VARCHAR(16) NOT NULL,' \
+                     '`owner` VARCHAR(128),' \
+                     '`lease_token` VARCHAR(64),' \
+                     '`lease_expires_at` DATETIME,' \
+                     '`attempts` INT NOT NULL DEFAULT 0,' \
+                     '`last_error` VARCHAR(512),' \
+                     'UNIQUE KEY `uk_run_kind_domain_project` (`run_id`, `kind`, `domain`, `project_id`),' \
+                     'KEY `idx_run_status` (`run_id`, `kind`, `status`, `lease_expires_at`))'
+
+        # api的生命周期: 每个区间是api在项目默认分支first-parent历史上连续存在的一段
+        # removed_sha为NULL表示到last_seen_sha为止仍然存在；project_id是gitlab的project id
+        t_api_history = 'CREATE TABLE IF NOT EXISTS t_api_history(' \
+                        '`id` BIGINT(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,' \
+                        '`created_at` TIMESTAMP NOT NULL,' \
+                        '`updated_at` TIMESTAMP NOT NULL,' \
+                        '`project_id` INT NOT NULL,' \
+                        '`api` VARCHAR(512) NOT NULL,' \
+                        '`file` VARCHAR(512),' \
+                        '`first_seen_sha` VARCHAR(64) NOT NULL,' \
+                        '`first_seen_at` DATETIME NOT NULL,' \
+                        '`last_seen_sha` VARCHAR(64) NOT NULL,' \
+                        '`last_seen_at` DATETIME NOT NULL,' \
+                        '`removed_sha` VARCHAR(64),' \
+                        '`removed_at` DATETIME,' \
+                        'KEY `idx_api` (`api`(191)),' \
+                        'KEY `idx_project_api` (`project_id`, `api`(191)))'
+
+        # 每个项目的api历史已经处理到哪个commit，下次从这个commit之后继续
+        t_api_history_state = 'CREATE TABLE IF NOT EXISTS t_api_history_state(' \
+                              '`project_id` INT NOT NULL PRIMARY KEY,' \
+                              '`sha` VARCHAR(64) NOT NULL,' \
+                              '`committed_at` DATETIME NOT NULL,' \
+                              '`commits` INT NOT NULL DEFAULT 0,' \
+                              '`updated_at` TIMESTAMP NOT NULL)'
+
         t_login_user = 'CREATE TABLE IF NOT EXISTS t_login_user(' \
                        '`username` VARCHAR(64) NOT NULL,' \
                        '`token` VARCHAR(512) NOT NULL)'
@@ -120,8 +259,15 @@ class Mysql:
                              t_rel_project_user,
                              t_rel_group_user,
                              t_rel_project_group,
+                             t_rel_project_user_closure,
                              t_inspect_batch,
                              t_inspect_details,
+                             t_inspect_rollup,
+                             t_scan_metrics,
+                             t_meta_generation,
+                             t_scan_job,
+                             t_api_history,
+                             t_api_history_state,
                              t_log_project,
                              t_login_user
                              ]
@@ -129,6 +275,64 @@ class Mysql:
         with self.engine.connect() as con:
             for sql in create_table_sqls:
                 con.execute(sql)
+        # 建表之后的结构变化(索引等)由migrations按版本执行
+        migrate(self.engine)
+
+    def shadow_table(self, table):
+        return f'{table}_shadow'
+
+    def create_shadow_table(self, table):
+        """
+        新建空的影子表，REPLACE_TABLE_COLUMNS里没有的表由replace_table用to_sql建
+        :return: 影子表名
+        """
+        shadow = self.shadow_table(table)
+        with self.engine.connect() as con:
+            con.execute(f'DROP TABLE IF EXISTS `{shadow}`')
+            if table in REPLACE_TABLE_COLUMNS:
+                columns = ', '.join(f'`{name}` {kind}' for name, kind in REPLACE_TABLE_COLUMNS[table])
+                con.execute(f'CREATE TABLE `{shadow}` (`id` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, {columns}) '
+                            f'DEFAULT CHARSET=utf8')
+        return shadow
+
+    def replace_rows(self, table, df):
+        """
+        整理成影子表的字段: 补上created_at/updated_at，旧版本csv没有的count补1，多余的列去掉
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        df = df.assign(created_at=now_str, updated_at=now_str)
+        if 'count' not in df.columns:
+            df['count'] = 1
+        return df[[name for name, _ in REPLACE_TABLE_COLUMNS[table] if name in df.columns]]
+
+    def swap_shadow_table(self, table):
+        """
+        影子表写完之后补上索引，再用RENAME TABLE原子地换掉旧表，
+        入库过程中查询读到的一直是完整的旧表，换过来之后索引立刻可用
+        """
+        shadow = self.shadow_table(table)
+        old = f'{table}_old'
+        with self.engine.connect() as con:
+            ensure_indexes(con, shadow, REPLACE_TABLE_INDEXES.get(table, []))
+            con.execute(f'DROP TABLE IF EXISTS `{old}`')
+            if table_exists(con, table):
+                con.execute(f'RENAME TABLE `{table}` TO `{old}`, `{shadow}` TO `{table}`')
+                con.execute(f'DROP TABLE `{old}`')
+            else:
+                con.execute(f'RENAME TABLE `{shadow}` TO `{table}`')
+
+    def replace_table(self, table, df):
+        """
+        整表重新入库: 先写影子表，再换掉旧表
+        """
+        shadow = self.create_shadow_table(table)
+        if table in REPLACE_TABLE_COLUMNS:
+            with self.engine.begin() as con:
+                self.insert_rows(con, shadow, self.replace_rows(table, df))
+        else:
+            with self.engine.connect() as con:
+                df.to_sql(name=shadow, con=con, if_exists='replace', index=False)
+        self.swap_shadow_table(table)
 
     def df_filter(self, df, table, filter_key='id'):
         """
@@ -201,68 +405,543 @@ class Mysql:
             df = self.df_filter(df, table, ['group_id', 'user_id'])
             df.to_sql(name=table, con=con, if_exists='append', index=False)
 
-    def insert_t_inspect_batch(self, project_id):
+    def rebuild_t_rel_project_user_closure(self, access_levels=None):
         """
-        t_inspect_batch表个只允许一次入库一条数据
-        先用用project的git_id查到project_id,
-        拿着project_id入库
-        再用created_at查找刚才入库t_inspect_batch的那条数据自增的id字段,
-        id字段需要作为batch_id提交给insert_t_inspect_detail使用
+        全量重建t_rel_project_user_closure，在内存里用dict做hash join:
+        - 直接成员: t_rel_project_user(内部id)
+        - 组成员: t_rel_project_group(gitlab id) -> t_base_project/t_base_group换算成内部id -> t_rel_group_user(内部id)
+        :param access_levels: {('project', project git_id, user git_id): access_level,
+                               ('group', group git_id, user git_id): access_level}，来自gitlab成员接口，没有时为空
+        :return: 写入的行数
         """
-        table = 't_inspect_batch'
+        table = 't_rel_project_user_closure'
+        access_levels = access_levels or {}
         now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         with self.engine.connect() as con:
-            sql = f'select id from t_base_project where git_id={project_id}'
-            sql_df = pd.read_sql(sql, con=con)
-            if len(sql_df) != 1:
-                raise Exception(f'The number of "{sql}" result is not 1!')
+            projects = con.execute('SELECT id, git_id FROM t_base_project').fetchall()
+            users = con.execute('SELECT id, git_id, username, name, email FROM t_base_user').fetchall()
+            groups = con.execute('SELECT id, git_id FROM t_base_group').fetchall()
+            project_users = con.execute('SELECT project_id, user_id, notice FROM t_rel_project_user').fetchall()
+            project_groups = con.execute('SELECT project_id, group_id FROM t_rel_project_group').fetchall()
+            group_users = con.execute('SELECT group_id, user_id FROM t_rel_group_user').fetchall()
+
+        # 先用小表建hash表
+        project_git_ids = {project_id: git_id for project_id, git_id in projects}
+        project_ids = {git_id: project_id for project_id, git_id in projects}
+        group_ids = {git_id: group_id for group_id, git_id in groups}
+        group_git_ids = {group_id: git_id for group_id, git_id in groups}
+        user_rows = {user_id: (git_id, username, name, email) for user_id, git_id, username, name, email in users}
+        users_of_group = {}
+        for group_id, user_id in group_users:
+            users_of_group.setdefault(group_id, set()).add(user_id)
 
-            project_id = sql_df['id'].iloc[0]
-            data = {
+        # 再逐行扫描关系表去查hash表
+        closure = {}
+
+        def add(project_id, user_id, source, group_id, access_level, notice):
+            project_git_id = project_git_ids.get(project_id)
+            user = user_rows.get(user_id)
+            if project_git_id is None or user is None:
+                return
+            closure[(project_git_id, user_id, source, group_id)] = {
                 'created_at': now_str,
                 'updated_at': now_str,
-                'project_id': project_id
+                'project_id': project_id,
+                'project_git_id': project_git_id,
+                'user_id': user_id,
+                'user_git_id': user[0],
+                'username': user[1],
+                'name': user[2],
+                'email': user[3],
+                'source': source,
+                'group_id': group_id,
+                'access_level': access_level,
+                'notice': notice,
             }
-            df = pd.DataFrame([data])
-            # df = self.df_filter(df, table, 'created_at')
-            df.to_sql(name=table, con=con, if_exists='append', index=False)
-            sql = f'select max(id) from t_inspect_batch where project_id="{project_id}"'
-            sql_df = pd.read_sql(sql, con=con)
-            if len(sql_df) != 1:
-                raise Exception(f'The number of "{sql}" result is not 1!')
 
-            batch_id = sql_df['max(id)'].iloc[0]
+        for project_id, user_id, notice in project_users:
+            user = user_rows.get(user_id)
+            access_level = access_levels.get(('project', project_git_ids.get(project_id), user[0])) if user else None
+            add(project_id, user_id, 'direct', 0, access_level, 1 if notice is None else notice)
+        for project_git_id, group_git_id in project_groups:
+            # t_rel_project_group存的是gitlab id
+            project_id = project_ids.get(project_git_id)
+            group_id = group_ids.get(group_git_id)
+            if project_id is None or group_id is None:
+                continue
+            for user_id in users_of_group.get(group_id, ()):
+                user = user_rows.get(user_id)
+                access_level = access_levels.get(('group', group_git_ids[group_id], user[0])) if user else None
+                add(project_id, user_id, 'group', group_id, access_level, 1)
 
-        return batch_id
+        df = pd.DataFrame(list(closure.values()))
+        with self.engine.begin() as con:
+            con.execute(text(f'DELETE FROM {table}'))
+            count = self.insert_rows(con, table, df)
+        print(table, '入库数量:', count)
+        self.bump_generation(table)
+        return count
 
-    def insert_t_inspect_details(self, df):
+    def select_notify_users(self, project_git_id, min_access_level=None):
+        """
+        查某个项目需要通知的用户，同一个用户有多个来源时取最高的access_level
+        :param project_git_id: project的gitlab id
+        :return: DataFrame[user_id, user_git_id, username, name, email, access_level, sources]
+        """
+        sql = text('SELECT user_id, user_git_id, username, name, email, MAX(access_level) AS access_level, '
+                   'GROUP_CONCAT(DISTINCT source) AS sources '
+                   'FROM t_rel_project_user_closure WHERE project_git_id=:project_git_id AND notice=1 '
+                   'GROUP BY user_id, user_git_id, username, name, email '
+                   'HAVING :min_access_level IS NULL OR MAX(access_level) >= :min_access_level')
+        with self.engine.connect() as con:
+            return pd.read_sql(sql, con=con, params={'project_git_id': int(project_git_id),
+                                                     'min_access_level': min_access_level})
+
+    def insert_rows(self, con, table, df, chunksize=1000):
+        """
+        按chunksize分块，用executemany批量写入，pymysql会把同一条INSERT合并成多行VALUES一次发送
+        :param con: 外部传入的连接/事务，调用方负责提交
+        :param table: 表名
+        :param df: 待写入的DataFrame，列名即字段名
+        :param chunksize: 每次executemany的行数
+        :return: 写入的行数
+        """
+        if len(df) == 0:
+            return 0
+        columns = list(df.columns)
+        sql = text(f'INSERT INTO {table} ({", ".join(f"`{c}`" for c in columns)}) '
+                   f'VALUES ({", ".join(f":{c}" for c in columns)})')
+        # astype(object)把numpy类型转成python原生类型，pymysql才能转义
+        records = df.astype(object).where(pd.notnull(df), None).to_dict('records')
+        for i in range(0, len(records), chunksize):
+            con.execute(sql, records[i:i + chunksize])
+        return len(records)
+
+    def select_t_base_project_count(self, project_id):
+        """
+        :param project_id: project的git_id
+        :return: t_base_project里这个git_id的行数，审查之前用来确认项目已经入库
+        """
+        with self.engine.connect() as con:
+            return con.execute(text('SELECT COUNT(*) FROM t_base_project WHERE git_id=:git_id'),
+                               {'git_id': int(project_id)}).scalar()
+
+    def insert_t_inspect_batch(self, project_id, con=None):
+        """
+        t_inspect_batch表个只允许一次入库一条数据
+        用 INSERT ... SELECT 一次完成git_id到t_base_project.id的转换和入库，
+        再用本连接的lastrowid作为batch_id提交给insert_t_inspect_detail使用，
+        lastrowid只属于当前连接，多个进程同时入库也不会拿错
+        :param project_id: project的git_id
+        :param con: 传入时在调用方的事务里执行，不传则单独开一个事务
+        """
+        if con is None:
+            with self.engine.begin() as con:
+                return self.insert_t_inspect_batch(project_id, con=con)
+
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        sql = text('INSERT INTO t_inspect_batch (created_at, updated_at, project_id) '
+                   'SELECT :now, :now, id FROM t_base_project WHERE git_id=:git_id')
+        result = con.execute(sql, {'now': now_str, 'git_id': int(project_id)})
+        if result.rowcount != 1:
+            # 在事务内抛出，插入会被回滚
+            raise Exception(f'The number of t_base_project where git_id={project_id} is not 1!')
+        return result.lastrowid
+
+    def insert_t_inspect_details(self, df, con=None, chunksize=1000):
         table = 't_inspect_details'
+        if con is None:
+            with self.engine.begin() as con:
+                return self.insert_t_inspect_details(df, con=con, chunksize=chunksize)
+        print(table, '入库数量:', len(df))
+        count = self.insert_rows(con, table, df, chunksize=chunksize)
+        self.insert_t_inspect_rollup(df, con)
+        return count
+
+    def insert_t_inspect_rollup(self, df, con):
+        """
+        按batch_id, git_commit_id, error_type统计刚入库的details，和details在同一个事务里写入t_inspect_rollup
+        project_id从t_inspect_batch里取
+        """
+        if len(df) == 0:
+            return 0
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        df_count = df.groupby(['batch_id', 'git_commit_id', 'error_type']).size().reset_index(name='error_count')
+        sql = text('INSERT INTO t_inspect_rollup '
+                   '(created_at, updated_at, project_id, batch_id, git_commit_id, error_type, error_count) '
+                   'SELECT :now, :now, project_id, id, :git_commit_id, :error_type, :error_count '
+                   'FROM t_inspect_batch WHERE id=:batch_id '
+                   'ON DUPLICATE KEY UPDATE error_count=error_count+VALUES(error_count), updated_at=VALUES(updated_at)')
+        records = [{'now': now_str,
+                    'batch_id': int(row['batch_id']),
+                    'git_commit_id': row['git_commit_id'],
+                    'error_type': row['error_type'],
+                    'error_count': int(row['error_count'])} for row in df_count.to_dict('records')]
+        con.execute(sql, records)
+        return len(records)
+
+    def rebuild_t_inspect_rollup(self):
+        """
+        从t_inspect_details全量重建t_inspect_rollup，只在补历史数据的时候用
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.engine.begin() as con:
+            con.execute(text('DELETE FROM t_inspect_rollup'))
+            con.execute(text('INSERT INTO t_inspect_rollup '
+                             '(created_at, updated_at, project_id, batch_id, git_commit_id, error_type, error_count) '
+                             'SELECT :now, :now, b.project_id, d.batch_id, MIN(d.git_commit_id), d.error_type, COUNT(*) '
+                             'FROM t_inspect_details d JOIN t_inspect_batch b ON d.batch_id=b.id '
+                             'GROUP BY b.project_id, d.batch_id, d.error_type'), {'now': now_str})
+
+    def select_inspect_trend(self, project_id, last_n=20):
+        """
+        查某个项目最近last_n次审查每种error_type的错误数量
+        :param project_id: project的git_id
+        :param last_n: 为None时查全部
+        :return: DataFrame[batch_id, created_at, git_commit_id, error_type, error_count]，按batch_id升序
+        """
+        limit = '' if last_n is None else f'LIMIT {int(last_n)}'
+        sql = text('SELECT r.batch_id, b.created_at, r.git_commit_id, r.error_type, r.error_count '
+                   'FROM (SELECT i.id, i.created_at FROM t_inspect_batch i '
+                   '      JOIN t_base_project p ON i.project_id=p.id '
+                   f'      WHERE p.git_id=:git_id ORDER BY i.id DESC {limit}) b '
+                   'JOIN t_inspect_rollup r ON r.batch_id=b.id '
+                   'ORDER BY r.batch_id')
         with self.engine.connect() as con:
+            return pd.read_sql(sql, con=con, params={'git_id': int(project_id)})
+
+    def insert_t_inspect_results(self, results, chunksize=1000):
+        """
+        多个项目的审查结果放在同一个事务里入库，任何一个失败整体回滚
+        :param results: {project git_id: details DataFrame}
+        :return: {project git_id: batch_id}
+        """
+        batch_ids = {}
+        with self.engine.begin() as con:
+            for project_id, df in results.items():
+                if len(df) == 0:
+                    # 没有detail就不入库了
+                    continue
+                batch_id = self.insert_t_inspect_batch(project_id, con=con)
+                df = df.copy()
+                df['batch_id'] = batch_id
+                self.insert_t_inspect_details(df, con=con, chunksize=chunksize)
+                batch_ids[project_id] = batch_id
+        return batch_ids
+
+    def insert_t_scan_metrics(self, df):
+        table = 't_scan_metrics'
+        with self.engine.begin() as con:
             print(table, '入库数量:', len(df))
-            df.to_sql(name=table, con=con, if_exists='append', index=False)
+            return self.insert_rows(con, table, df)
+
+    def select_last_scan_metrics(self, run_kind, before_run_id):
+        """
+        查上一次同类扫描的耗时记录，用来对比是否变慢
+        """
+        with self.engine.connect() as con:
+            sql = text('SELECT * FROM t_scan_metrics WHERE run_kind=:run_kind AND run_id=('
+                       'SELECT MAX(run_id) FROM t_scan_metrics WHERE run_kind=:run_kind AND run_id<:run_id)')
+            return pd.read_sql(sql, con=con, params={'run_kind': run_kind, 'run_id': before_run_id})
 
     def insert_t_log_project(self, df):
         pass
 
-    def insert_t_base_api(self, df):
-        table = 't_base_api'
+    def insert_t_scan_job(self, run_id, kind, domain, project_ids):
+        """
+        把这一轮要扫描的项目加入任务表，已经存在的项目跳过，多个节点同时调用也只会有一份
+        :return: 新加入的任务数
+        """
         now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        df['id'] = range(len(df))
-        df['created_at'] = now_str
-        df['updated_at'] = now_str
+        params = {'run_id': run_id, 'kind': kind, 'domain': domain}
+        try:
+            with self.engine.begin() as con:
+                rows = con.execute(text('SELECT project_id FROM t_scan_job '
+                                        'WHERE run_id=:run_id AND kind=:kind AND domain=:domain'), params).fetchall()
+                existing = {row[0] for row in rows}
+                df = pd.DataFrame([{'created_at': now_str, 'updated_at': now_str, 'run_id': run_id, 'kind': kind,
+                                    'domain': domain, 'project_id': int(project_id), 'status': 'pending',
+                                    'attempts': 0}
+                                   for project_id in sorted(set(project_ids)) if int(project_id) not in existing])
+                return self.insert_rows(con, 't_scan_job', df)
+        except IntegrityError:
+            # 其他节点同时插入了部分项目，重新查一遍已有的项目
+            return self.insert_t_scan_job(run_id, kind, domain, project_ids)
+
+    def db_now(self, seconds_param=None):
+        """
+        数据库当前时间的SQL表达式，租约的过期时间和过期判断都用数据库时间，不受各节点本地时钟偏差的影响
+        :param seconds_param: 绑定参数名，给出时表达式为当前时间加上这么多秒
+        """
+        if self.engine.dialect.name == 'sqlite':
+            # benchmark里用sqlite模拟
+            if seconds_param is None:
+                return "datetime('now', 'localtime')"
+            return f"datetime('now', 'localtime', '+' || :{seconds_param} || ' seconds')"
+        if seconds_param is None:
+            return 'NOW()'
+        return f'NOW() + INTERVAL :{seconds_param} SECOND'
+
+    def claim_t_scan_job(self, run_id, kind, domain, owner, token, lease_seconds, max_attempts, batch=8):
+        """
+        认领一个待扫描或者租约已过期的任务
+        先查出几个候选，再逐个用带条件的UPDATE抢占，影响行数为1说明抢到了，
+        多个节点同时抢同一个任务时只有一个能成功
+        :param token: 这次租约的唯一标识，续约和完成时用来确认租约还在自己手里
+        :return: (job_id, project_id, attempts)，没有可认领的任务时返回None
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        claimable = (f"attempts<:max_attempts AND (status='pending' OR "
+                     f"(status='running' AND lease_expires_at<{self.db_now()}))")
+        params = {'run_id': run_id, 'kind': kind, 'domain': domain, 'now': now_str, 'max_attempts': max_attempts}
         with self.engine.connect() as con:
-            print(table, '入库数量:', len(df))
-            df.to_sql(name=table, con=con, if_exists='replace', index=False)
+            candidates = con.execute(text(f'SELECT id FROM t_scan_job WHERE run_id=:run_id AND kind=:kind '
+                                          f'AND domain=:domain AND {claimable} ORDER BY id LIMIT {int(batch)}'),
+                                     params).fetchall()
+        for row in candidates:
+            with self.engine.begin() as con:
+                result = con.execute(text(f"UPDATE t_scan_job SET status='running', owner=:owner, "
+                                          f"lease_token=:token, lease_expires_at={self.db_now('lease_seconds')}, "
+                                          f"attempts=attempts+1, updated_at=:now WHERE id=:id AND {claimable}"),
+                                     dict(params, id=row[0], owner=owner, token=token, lease_seconds=lease_seconds))
+                if result.rowcount != 1:
+                    continue
+                job = con.execute(text('SELECT id, project_id, attempts FROM t_scan_job WHERE id=:id'),
+                                  {'id': row[0]}).fetchone()
+                return tuple(job)
+        if candidates:
+            # 候选全被其他节点抢走了，再查一次
+            return self.claim_t_scan_job(run_id, kind, domain, owner, token, lease_seconds, max_attempts, batch)
+        return None
 
-    def insert_t_base_database_url(self, df):
-        table = 't_base_database_url'
+    def renew_t_scan_job(self, job_id, token, lease_seconds):
+        """
+        续约，租约已经被其他节点接管时返回False
+        """
         now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        df['id'] = range(len(df))
-        df['created_at'] = now_str
-        df['updated_at'] = now_str
+        with self.engine.begin() as con:
+            result = con.execute(text(f"UPDATE t_scan_job SET lease_expires_at={self.db_now('lease_seconds')}, "
+                                      f"updated_at=:now WHERE id=:id AND lease_token=:token AND status='running'"),
+                                 {'id': job_id, 'token': token, 'now': now_str, 'lease_seconds': lease_seconds})
+            return result.rowcount == 1
+
+    def finish_t_scan_job(self, job_id, token, status, error=None):
+        """
+        :param status: done / failed / pending(放回去等下次重试)
+        :return: 租约已经被其他节点接管时返回False，这次的结果作废
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.engine.begin() as con:
+            result = con.execute(text('UPDATE t_scan_job SET status=:status, lease_token=NULL, '
+                                      'lease_expires_at=NULL, last_error=:error, updated_at=:now '
+                                      "WHERE id=:id AND lease_token=:token AND status='running'"),
+                                 {'id': job_id, 'token': token, 'status': status,
+                                  'error': error[:512] if error else None, 'now': now_str})
+            return result.rowcount == 1
+
+    def expire_t_scan_job(self, run_id, kind, domain, max_attempts):
+        """
+        用完重试次数、最后一次租约又过期了(节点崩溃)的任务标记为failed，不再被认领
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.engine.begin() as con:
+            result = con.execute(text(f"UPDATE t_scan_job SET status='failed', lease_token=NULL, "
+                                      f"last_error='lease expired', updated_at=:now "
+                                      f'WHERE run_id=:run_id AND kind=:kind AND domain=:domain '
+                                      f"AND status='running' AND lease_expires_at<{self.db_now()} "
+                                      f'AND attempts>=:max_attempts'),
+                                 {'run_id': run_id, 'kind': kind, 'domain': domain, 'now': now_str,
+                                  'max_attempts': max_attempts})
+            return result.rowcount
+
+    def select_t_scan_job_progress(self, run_id, kind, domain):
+        """
+        :return: {status: 任务数}，租约过期的running任务单独记为expired
+        """
         with self.engine.connect() as con:
-            print(table, '入库数量:', len(df))
-            df.to_sql(name=table, con=con, if_exists='replace', index=False)
+            rows = con.execute(text(f"SELECT CASE WHEN status='running' AND lease_expires_at<{self.db_now()} "
+                                    f"THEN 'expired' ELSE status END AS s, COUNT(*) FROM t_scan_job "
+                                    f'WHERE run_id=:run_id AND kind=:kind AND domain=:domain GROUP BY s'),
+                               {'run_id': run_id, 'kind': kind, 'domain': domain}).fetchall()
+        return {status: count for status, count in rows}
+
+    def select_t_api_history_state(self, project_id):
+        """
+        :return: {sha, committed_at, commits}，没有处理过的项目返回None
+        """
+        with self.engine.connect() as con:
+            row = con.execute(text('SELECT sha, committed_at, commits FROM t_api_history_state '
+                                   'WHERE project_id=:project_id'), {'project_id': int(project_id)}).fetchone()
+        return dict(zip(['sha', 'committed_at', 'commits'], row)) if row else None
+
+    def select_open_t_api_history(self, project_id):
+        """
+        :return: 项目里还没结束的区间[{api, file, first_seen_sha, first_seen_at}]
+        """
+        with self.engine.connect() as con:
+            rows = con.execute(text('SELECT api, file, first_seen_sha, first_seen_at FROM t_api_history '
+                                    'WHERE project_id=:project_id AND removed_sha IS NULL'),
+                               {'project_id': int(project_id)}).fetchall()
+        return [dict(zip(['api', 'file', 'first_seen_sha', 'first_seen_at'], row)) for row in rows]
+
+    def delete_t_api_history(self, project_id):
+        """
+        默认分支被强推、上次处理到的commit不在历史上了，只能从头重建
+        """
+        with self.engine.begin() as con:
+            con.execute(text('DELETE FROM t_api_history WHERE project_id=:project_id'), {'project_id': int(project_id)})
+            con.execute(text('DELETE FROM t_api_history_state WHERE project_id=:project_id'),
+                        {'project_id': int(project_id)})
+
+    def save_t_api_history(self, project_id, opened, closed, sha, committed_at, commits):
+        """
+        一个事务里保存一批commit的结果和处理进度，中途失败时下次从上一批的进度继续
+        :param opened: 新开始、还没结束的区间
+        :param closed: 结束了的区间，saved为True的已经在库里(更新)，否则是这一批里开始又结束的(插入)
+        :param sha: 这一批处理到的commit，未结束区间的last_seen更新为它
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        columns = ['api', 'file', 'first_seen_sha', 'first_seen_at', 'last_seen_sha', 'last_seen_at',
+                   'removed_sha', 'removed_at']
+        rows = [dict({'last_seen_sha': sha, 'last_seen_at': committed_at, 'removed_sha': None, 'removed_at': None},
+                     **{k: v for k, v in interval.items() if k in columns}) for interval in opened]
+        rows += [{k: interval[k] for k in columns} for interval in closed if not interval['saved']]
+        df = pd.DataFrame(rows, columns=columns)
+        df.insert(0, 'project_id', int(project_id))
+        df.insert(0, 'updated_at', now_str)
+        df.insert(0, 'created_at', now_str)
+        updates = [{'project_id': int(project_id), 'now': now_str, **{k: interval[k] for k in columns}}
+                   for interval in closed if interval['saved']]
+        with self.engine.begin() as con:
+            self.insert_rows(con, 't_api_history', df)
+            if updates:
+                con.execute(text('UPDATE t_api_history SET last_seen_sha=:last_seen_sha, last_seen_at=:last_seen_at, '
+                                 'removed_sha=:removed_sha, removed_at=:removed_at, updated_at=:now '
+                                 'WHERE project_id=:project_id AND api=:api AND first_seen_sha=:first_seen_sha '
+                                 'AND removed_sha IS NULL'), updates)
+            con.execute(text('UPDATE t_api_history SET last_seen_sha=:sha, last_seen_at=:committed_at, updated_at=:now '
+                             'WHERE project_id=:project_id AND removed_sha IS NULL'),
+                        {'project_id': int(project_id), 'sha': sha, 'committed_at': committed_at, 'now': now_str})
+            con.execute(text('INSERT INTO t_api_history_state (project_id, sha, committed_at, commits, updated_at) '
+                             'VALUES (:project_id, :sha, :committed_at, :commits, :now) '
+                             'ON DUPLICATE KEY UPDATE sha=:sha, committed_at=:committed_at, '
+                             'commits=commits+:commits, updated_at=:now'),
+                        {'project_id': int(project_id), 'sha': sha, 'committed_at': committed_at,
+                         'commits': commits, 'now': now_str})
+
+    def select_api_history(self, api, project_id=None):
+        """
+        api在各项目里出现和删除的区间，按出现时间排序
+        :return: DataFrame[project_id, project_name, api, file, first_seen_sha, first_seen_at, last_seen_sha,
+                 last_seen_at, removed_sha, removed_at]
+        """
+        sql = ('SELECT h.project_id, p.name AS project_name, h.api, h.file, h.first_seen_sha, h.first_seen_at, '
+               'h.last_seen_sha, h.last_seen_at, h.removed_sha, h.removed_at '
+               'FROM t_api_history h LEFT JOIN t_base_project p ON p.git_id=h.project_id WHERE h.api=:api')
+        params = {'api': api}
+        if project_id is not None:
+            sql += ' AND h.project_id=:project_id'
+            params['project_id'] = int(project_id)
+        with self.engine.connect() as con:
+            return pd.read_sql(text(sql + ' ORDER BY h.project_id, h.first_seen_at'), con=con, params=params)
+
+    def bump_generation(self, table):
+        """
+        表重新入库完成后调用，其他进程里的搜索缓存在下一次查询时发现generation变化
+        """
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.engine.begin() as con:
+            con.execute(text('INSERT INTO t_meta_generation (table_name, generation, updated_at) '
+                             'VALUES (:table_name, 1, :now) '
+                             'ON DUPLICATE KEY UPDATE generation=generation+1, updated_at=:now'),
+                        {'table_name': table, 'now': now_str})
+        # 本进程的缓存直接清掉
+        self.cache.clear()
+        self.generations.clear()
+
+    def select_generations(self, tables):
+        """
+        :return: 和tables顺序一致的generation元组，没有入库过的表为0
+        """
+        with self.engine.connect() as con:
+            rows = con.execute(text('SELECT table_name, generation FROM t_meta_generation')).fetchall()
+        generations = {table_name: generation for table_name, generation in rows}
+        return tuple(generations.get(table, 0) for table in tables)
+
+    def cached_query(self, name, tables, params, load):
+        """
+        key = (查询名, 规范化后的参数, 依赖表的generation)
+        generation也缓存generation_ttl秒，命中时不用查库
+        """
+        generations = self.generations.get_or_load(tuple(tables), lambda: self.select_generations(tables))
+        key = (name, tuple(sorted(params.items())), generations)
+        return self.cache.get_or_load(key, load).copy()
+
+    @staticmethod
+    def normalize_keyword(keyword):
+        return ' '.join(str(keyword).split()).lower()
+
+    @staticmethod
+    def like_pattern(keyword):
+        """
+        包含keyword的LIKE模式，keyword里的%和_按字面匹配，配合 ESCAPE '!' 使用
+        (不用反斜杠: MySQL和sqlite对字符串里的反斜杠处理不一样)
+        """
+        escaped = keyword.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+        return f'%{escaped}%'
+
+    def search_api(self, keyword, limit=100):
+        """
+        按api路径模糊搜索，带上项目和项目成员
+        :return: DataFrame[api, file, line, type, git_id, project_name, web_url, users]
+        """
+        params = {'keyword': self.normalize_keyword(keyword), 'limit': int(limit)}
+        sql = text('SELECT a.api, a.file, a.line, a.type, a.git_id, p.name AS project_name, p.web_url, '
+                   'GROUP_CONCAT(DISTINCT c.name) AS users '
+                   'FROM t_base_api a JOIN t_base_project p ON a.git_id=p.git_id '
+                   'LEFT JOIN t_rel_project_user_closure c ON c.project_git_id=p.git_id '
+                   "WHERE LOWER(a.api) LIKE :pattern ESCAPE '!' "
+                   'GROUP BY a.id, p.id LIMIT :limit')
+
+        def load():
+            with self.engine.connect() as con:
+                return pd.read_sql(sql, con=con, params={'pattern': self.like_pattern(params['keyword']),
+                                                         'limit': params['limit']})
+
+        return self.cached_query('search_api', ['t_base_api', 't_rel_project_user_closure'], params, load)
+
+    def search_database_url(self, keyword, limit=100):
+        """
+        按数据库链接(host、库名)模糊搜索，带上项目和项目成员
+        :return: DataFrame[database_url, file, line, git_id, project_name, web_url, users]
+        """
+        params = {'keyword': self.normalize_keyword(keyword), 'limit': int(limit)}
+        sql = text('SELECT d.database_url, d.file, d.line, d.git_id, p.name AS project_name, p.web_url, '
+                   'GROUP_CONCAT(DISTINCT c.name) AS users '
+                   'FROM t_base_database_url d JOIN t_base_project p ON d.git_id=p.git_id '
+                   'LEFT JOIN t_rel_project_user_closure c ON c.project_git_id=p.git_id '
+                   "WHERE LOWER(d.database_url) LIKE :pattern ESCAPE '!' "
+                   'GROUP BY d.id, p.id LIMIT :limit')
+
+        def load():
+            with self.engine.connect() as con:
+                return pd.read_sql(sql, con=con, params={'pattern': self.like_pattern(params['keyword']),
+                                                         'limit': params['limit']})
+
+        return self.cached_query('search_database_url', ['t_base_database_url', 't_rel_project_user_closure'],
+                                 params, load)
+
+    def insert_t_base_api(self, df):
+        table = 't_base_api'
+        print(table, '入库数量:', len(df))
+        self.replace_table(table, df)
+        self.bump_generation(table)
+
+    def insert_t_base_database_url(self, df):
+        table = 't_base_database_url'
+        print(table, '入库数量:', len(df))
+        self.replace_table(table, df)
+        self.bump_generation(table)
 
     def insert_t_rel_project_host(self, df):
         table = 't_rel_project_host'
@@ -270,9 +949,8 @@ class Mysql:
         df['id'] = range(len(df))
         df['created_at'] = now_str
         df['updated_at'] = now_str
-        with self.engine.connect() as con:
-            print(table, '入库数量:', len(df))
-            df.to_sql(name=table, con=con, if_exists='replace', index=False)
+        print(table, '入库数量:', len(df))
+        self.replace_table(table, df)
 
 # mysql = Mysql('root', '19970429', 'localhost', '3306', 'gitlab_checker')
 # mysql.init_tables()
@@ -1,13 +1,189 @@
-from mysql import Mysql
-from gitlab_checker import GitLabChecker
+"""
+命令行入口，gitlab_checker(连带pandas、gitlab、sqlalchemy等)只在子命令真正执行时才导入，
+--help和参数错误不用等这些导入；子命令执行时的导入和建表、schema迁移照常发生
+
+python run.py                          扫描全部项目的api和数据库链接(同scan-all)
+python run.py scan-all [--api-only | --database-url-only]
+python run.py scan-project 12 34 [--load]
+python run.py load-only
+python run.py inspect [12 34] [--processes 4]
+python run.py plot 12 [--last-n 20 | --all]
+python run.py daemon
+python run.py history-build [12 34]
+python run.py history-query /order/refund [--project-id 12]
+python run.py scan-shard [--run-id 20240101] [--kind scan | inspect] [--no-enqueue] [--no-wait] [--load]
+python run.py --replay scan-all        离线重放，只用archive_cache里缓存的压缩包，不访问gitlab
+"""
+import sys
+import argparse
 import datetime
-import time
-from retrying import retry
 
-def run():
-    gitlabchecker = GitLabChecker()
-    gitlabchecker.extract_api_from_all_project()
-    gitlabchecker.extract_database_url_from_all_project()
+
+def get_checker(args, sync=True):
+    from gitlab_checker import GitLabChecker
+
+    return GitLabChecker(source=args.source, sync=sync, replay=args.replay)
+
+
+def scan_all(args):
+    # 不指定时api和数据库链接在同一次遍历里提取，每个项目只下载、解压一次
+    gitlabchecker = get_checker(args)
+    names = ['api'] if args.api_only else ['database_url'] if args.database_url_only else None
+    gitlabchecker.extract_from_all_project(names)
+
+
+def scan_project(args):
+    # 只扫描指定的项目，不拉取全量的project/user/group
+    gitlabchecker = get_checker(args, sync=False)
+    failed = 0
+    for project_id in args.project_ids:
+        try:
+            gitlabchecker.scan_project(project_id)
+            print(f'project {project_id} 扫描完成')
+        except Exception as e:
+            failed += 1
+            print(f'project {project_id} 扫描失败: {e}')
+    if args.load:
+        gitlabchecker.merge_api()
+        gitlabchecker.merge_database_url()
+    gitlabchecker.finish_metrics()
+    return 1 if failed else 0
+
+
+def load_only(args):
+    # 不扫描，只把已有的各项目csv合并入库
+    gitlabchecker = get_checker(args, sync=False)
+    gitlabchecker.merge_api()
+    gitlabchecker.merge_database_url()
+    gitlabchecker.finish_metrics()
+
+
+def inspect(args):
+    if len(args.project_ids) == 0:
+        gitlabchecker = get_checker(args)
+        gitlabchecker.check_all_project_latest_commit_and_insert(processes=args.processes)
+        return
+    gitlabchecker = get_checker(args, sync=False)
+    for project_id in args.project_ids:
+        gitlabchecker.check_project_latest_commit_and_insert(project_id)
+    gitlabchecker.finish_metrics()
+
+
+def plot(args):
+    gitlabchecker = get_checker(args, sync=False)
+    fig_name = gitlabchecker.plot_trend(args.project_id, last_n=None if args.all else args.last_n)
+    if fig_name:
+        print(f'趋势图已保存: {fig_name}')
+
+
+def daemon(args):
+    # 常驻模式，按活跃度和webhook调度扫描
+    gitlabchecker = get_checker(args)
+    gitlabchecker.run_scheduler()
+
+
+def scan_shard(args):
+    # 多个节点用同一个run_id启动，共同扫完这一轮
+    gitlabchecker = get_checker(args, sync=False)
+    counts = gitlabchecker.scan_shard(args.run_id, kind=args.kind, enqueue=not args.no_enqueue,
+                                      wait=not args.no_wait, load=args.load)
+    return 1 if counts.get('failed') else 0
+
+
+def history_build(args):
+    gitlabchecker = get_checker(args, sync=False)
+    project_ids = args.project_ids or [project.id for project in gitlabchecker.gl.projects.list(all=True)]
+    failed = 0
+    for project_id in project_ids:
+        try:
+            gitlabchecker.build_api_history(project_id)
+        except Exception as e:
+            failed += 1
+            print(f'project {project_id} api历史更新失败: {e}')
+    gitlabchecker.finish_metrics()
+    return 1 if failed else 0
+
+
+def history_query(args):
+    gitlabchecker = get_checker(args, sync=False)
+    df = gitlabchecker.api_history(args.api, args.project_id)
+    if len(df) == 0:
+        print(f'{args.api} 没有记录')
+        return 1
+    for row in df.to_dict('records'):
+        removed = f'{row["removed_at"]} 被 {row["removed_sha"]} 删除' if row['removed_sha'] else \
+            f'至今存在(最后确认于 {row["last_seen_sha"]})'
+        print(f'{row["project_id"]} {row["project_name"]} {row["file"]}: '
+              f'{row["first_seen_at"]} 由 {row["first_seen_sha"]} 加入, {removed}')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='insightsApiSearch')
+    parser.add_argument('--source', choices=['archive', 'mirror'], default=None,
+                        help='代码来源，默认用config.ini里[source]的配置')
+    parser.add_argument('--replay', action='store_true',
+                        help='离线重放: 项目和压缩包都来自archive_cache(每个项目最近缓存的commit)，不访问gitlab，'
+                             '用于开发和benchmark，适用于scan-all、scan-project、load-only')
+    subparsers = parser.add_subparsers(dest='command')
+
+    sub = subparsers.add_parser('scan-all', help='扫描全部项目的api和数据库链接并入库')
+    group = sub.add_mutually_exclusive_group()
+    group.add_argument('--api-only', action='store_true', help='只扫描api')
+    group.add_argument('--database-url-only', action='store_true', help='只扫描数据库链接')
+    sub.set_defaults(func=scan_all)
+
+    sub = subparsers.add_parser('scan-project', help='扫描指定项目，更新这些项目的csv')
+    sub.add_argument('project_ids', type=int, nargs='+', metavar='PROJECT_ID', help='gitlab project id')
+    sub.add_argument('--load', action='store_true', help='扫描完合并全部csv入库')
+    sub.set_defaults(func=scan_project)
+
+    sub = subparsers.add_parser('load-only', help='不扫描，只把已有的csv合并入库')
+    sub.set_defaults(func=load_only)
+
+    sub = subparsers.add_parser('inspect', help='审查项目最新的commit并入库，不指定项目时审查全部项目')
+    sub.add_argument('project_ids', type=int, nargs='*', metavar='PROJECT_ID', help='gitlab project id')
+    sub.add_argument('--processes', type=int, default=None, help='进程数，0为串行，默认用config.ini里[worker]的配置')
+    sub.set_defaults(func=inspect)
+
+    sub = subparsers.add_parser('plot', help='画项目的审查趋势图')
+    sub.add_argument('project_id', type=int, metavar='PROJECT_ID', help='gitlab project id')
+    sub.add_argument('--last-n', type=int, default=20, help='最近多少次审查')
+    sub.add_argument('--all', action='store_true', help='全部审查记录')
+    sub.set_defaults(func=plot)
+
+    sub = subparsers.add_parser('scan-shard', help='多节点分片扫描，从t_scan_job认领项目，崩溃后可由其他节点接管')
+    sub.add_argument('--run-id', default=datetime.date.today().strftime('%Y%m%d'),
+                     help='这一轮扫描的标识，各节点要一致，默认当天日期')
+    sub.add_argument('--kind', choices=['scan', 'inspect'], default='scan',
+                     help='scan: 提取api和数据库链接; inspect: 审查最新commit并入库')
+    sub.add_argument('--no-enqueue', action='store_true', help='不把gitlab上的项目加入这一轮，只认领已有的任务')
+    sub.add_argument('--no-wait', action='store_true', help='认领不到任务就退出，不等其他节点')
+    sub.add_argument('--load', action='store_true', help='这一轮全部完成后合并csv入库(各节点的csv目录需要共享)')
+    sub.set_defaults(func=scan_shard)
+
+    sub = subparsers.add_parser('history-build', help='增量更新api生命周期索引，不指定项目时更新全部项目')
+    sub.add_argument('project_ids', type=int, nargs='*', metavar='PROJECT_ID', help='gitlab project id')
+    sub.set_defaults(func=history_build)
+
+    sub = subparsers.add_parser('history-query', help='查api什么时候出现、什么时候被哪个commit删除')
+    sub.add_argument('api', help='api路径，和提取结果完全一致')
+    sub.add_argument('--project-id', type=int, default=None, help='只查这个项目')
+    sub.set_defaults(func=history_query)
+
+    sub = subparsers.add_parser('daemon', help='常驻模式，按活跃度和push webhook调度扫描')
+    sub.set_defaults(func=daemon)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # 兼容以前不带参数的用法
+        args = parser.parse_args((['--replay'] if args.replay else []) +
+                                 ([] if args.source is None else ['--source', args.source]) + ['scan-all'])
+    return args.func(args) or 0
+
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    sys.exit(main())
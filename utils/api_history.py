@@ -0,0 +1,252 @@
+import os
+import bisect
+from utils.git_mirror import GitTreeExtractor
+from utils.detector import SourceFile
+
+
+class HistoryExtractor(GitTreeExtractor):
+    """
+    随commit增量变化的GitTreeExtractor，按git log的改动增删文件，不用每个commit都ls-tree一遍
+    项目类型用标记文件计数和bin目录下的文件(包括检测器不关心的文件)判断，和Extractor.project_type的结果一致
+    目录和文件按git tree的顺序插入，遍历顺序和GitTreeExtractor一致(ApiFrameworkDetector依赖遍历顺序)
+    """
+
+    def __init__(self, mirror, project_id, max_file_bytes=0):
+        self.mirror = mirror
+        self.project_id = project_id
+        self.sha = None
+        self.module_path = os.path.join(mirror.path(project_id), 'history')
+        self.max_file_bytes = max_file_bytes
+        self.blobs = {}
+        self.tree = {}
+        self.marker_counts = {name: 0 for name in self.MARKER_FILES}
+        self.bin_paths = set()  # bin目录下的文件，blobs里只有检测器关心的文件，不能用来判断
+        self.add_dir('')
+        self.reader = mirror.cat_file(project_id)
+
+    def update(self, path, blob_sha):
+        """
+        :param blob_sha: None表示删除
+        :return: 是否是检测器关心的文件
+        """
+        dir_path, file = os.path.split(path)
+        full_path = os.path.join(self.module_path, path)
+        existed = full_path in self.blobs
+        if 'bin' in dir_path.split('/'):
+            if blob_sha is None:
+                self.bin_paths.discard(path)
+            else:
+                self.bin_paths.add(path)
+        if not self.is_relevant(path):
+            return False
+        if file in self.marker_counts:
+            self.marker_counts[file] += (blob_sha is not None) - existed
+        if blob_sha is None:
+            if existed:
+                del self.blobs[full_path]
+                self.tree[dir_path][1].remove(file)
+            return True
+        if not existed:
+            self.add_dir(dir_path)
+            bisect.insort(self.tree[dir_path][1], file)
+        self.blobs[full_path] = blob_sha
+        return True
+
+    def add_dir(self, dir_path):
+        if dir_path in self.tree:
+            return
+        self.tree[dir_path] = ([], [])
+        if dir_path:
+            parent, name = os.path.split(dir_path)
+            self.add_dir(parent)
+            dirs = self.tree[parent][0]
+            dirs.append(name)
+            # git tree里目录按"名字/"排序
+            dirs.sort(key=lambda d: d + '/')
+
+    @property
+    def project_type(self):
+        if self.marker_counts['package.json']:
+            return 'frontend'
+        elif self.marker_counts['runserver.py']:
+            return 'yard-base' if self.bin_paths else 'api-framework'
+        return 'other'
+
+    def read_bytes(self, filepath):
+        data = super().read_bytes(filepath)
+        if self.max_file_bytes and len(data) > self.max_file_bytes:
+            return b''
+        return data
+
+
+class ApiHistory:
+    """
+    一个项目的api生命周期索引
+    沿first-parent从旧到新遍历commit，只重新提取改动的文件，api在某个commit第一次出现时开始一个区间，
+    在某个commit消失时结束区间(removed_sha就是删掉它的commit)，删掉之后又加回来的api会开始新的区间
+    区间: {api, file, first_seen_sha, first_seen_at, last_seen_sha, last_seen_at, removed_sha, removed_at}
+    """
+
+    def __init__(self, mirror, project_id, max_file_bytes=0, max_line_length=0):
+        self.extractor = HistoryExtractor(mirror, project_id, max_file_bytes)
+        self.extractor.max_line_length = max_line_length
+        self.project_type = None
+        # 文件路径(逐文件的检测器)、(类名, 文件路径)(带符号表的检测器)或者('detector', 类名)(整体重跑的检测器) -> {api: file}
+        self.file_apis = {}
+        self.api_refs = {}  # api -> 有几个file_apis包含它
+        self.api_files = {}  # api -> 引入它的文件
+        self.intervals = {}  # 当前存在的api -> 区间
+        self.tables = {}  # 带符号表的检测器类 -> (符号表, {文件路径: 解析结果})
+        self.closed = []  # 还没保存的已结束区间
+        self.sha = None
+        self.committed_at = None
+        self.commits = 0
+        self.files = 0
+
+    def close(self):
+        self.extractor.close()
+
+    def set_apis(self, key, apis, changed):
+        old = self.file_apis.pop(key, {})
+        if apis:
+            self.file_apis[key] = apis
+        for api in old.keys() - apis.keys():
+            self.api_refs[api] -= 1
+            if self.api_refs[api] == 0:
+                del self.api_refs[api]
+                del self.api_files[api]
+                changed.add(api)
+        for api in apis.keys() - old.keys():
+            self.api_refs[api] = self.api_refs.get(api, 0) + 1
+            if self.api_refs[api] == 1:
+                self.api_files[api] = apis[api]
+                changed.add(api)
+
+    def visit(self, paths, changed):
+        """
+        重新提取paths里的文件，逐文件的检测器只看这些文件，其他检测器在有相关文件改动时整体重跑
+        :param paths: 改动的相对路径，包括删除的文件
+        """
+        extractor = self.extractor
+        detectors = extractor.detectors(['api'])
+        for path in paths:
+            full_path = os.path.join(extractor.module_path, path)
+            root, name = os.path.split(full_path)
+            apis = {}
+            matched = [type(detector) for detector in detectors if detector.file_local
+                       and full_path in extractor.blobs and detector.accepts(root, name)]
+            source = extractor.read_source(root, name) if matched else None
+            if source is not None:
+                self.files += 1
+                for cls in matched:
+                    detector = cls(extractor)
+                    detector.visit(source)
+                    for row in detector.rows:
+                        apis.setdefault(row['api'], row['file'])
+            self.set_apis(path, apis, changed)
+        for detector in detectors:
+            if detector.file_local:
+                continue
+            if detector.symbol_table is not None:
+                self.visit_with_table(detector, paths, changed)
+                continue
+            if not any(detector.accepts(*os.path.split(os.path.join(extractor.module_path, path)))
+                       for path in paths):
+                continue
+            extractor.run_detectors([detector])
+            apis = {}
+            for row in detector.rows:
+                apis.setdefault(row['api'], row['file'])
+            self.set_apis(('detector', type(detector).__name__), apis, changed)
+
+    def visit_with_table(self, detector, paths, changed):
+        """
+        带符号表的检测器: 只重新解析改动的文件并更新符号表，
+        有文件导出的符号变了(会影响其他文件的解析结果)时所有文件重新解析，否则只解析改动的文件
+        """
+        extractor = self.extractor
+        cls = type(detector)
+        if cls not in self.tables:
+            self.tables[cls] = (cls.symbol_table(), {})
+        table, parsed = self.tables[cls]
+        symbols_changed = False
+        for path in paths:
+            full_path = os.path.join(extractor.module_path, path)
+            root, name = os.path.split(full_path)
+            old = parsed.pop(path, None)
+            if old is not None:
+                table.remove(old)
+            new = None
+            if full_path in extractor.blobs and detector.accepts(root, name):
+                new = detector.parse_file(root, name)
+            if new is not None:
+                self.files += 1
+                parsed[path] = new
+                table.add(new)
+            old_signature = old.export_signature() if old is not None else None
+            new_signature = new.export_signature() if new is not None else None
+            symbols_changed = symbols_changed or old_signature != new_signature
+        for path in (list(parsed) if symbols_changed else paths):
+            apis = {}
+            if path in parsed:
+                file = SourceFile.relative_file(extractor.module_path, os.path.join(extractor.module_path, path))
+                for _, api in detector.file_apis(table, parsed[path]):
+                    apis.setdefault(api, file)
+            self.set_apis((cls.__name__, path), apis, changed)
+
+    def apply(self, sha, committed_at, changes, track=True):
+        """
+        处理一个commit的改动
+        :param track: 为False时只更新文件状态，不开始或者结束区间，从上次保存的commit恢复状态时使用
+        """
+        changed = set()
+        paths = [path for status, path, blob_sha in changes if self.extractor.update(path, blob_sha)]
+        project_type = self.extractor.project_type
+        if project_type != self.project_type:
+            # 项目类型变了，适用的检测器也变了，全部重新提取
+            self.project_type = project_type
+            for key in list(self.file_apis):
+                self.set_apis(key, {}, changed)
+            self.tables = {}
+            paths = [os.path.relpath(path, self.extractor.module_path) for path in self.extractor.blobs]
+        if paths:
+            self.visit(paths, changed)
+        self.commits += 1
+        if track:
+            for api in changed:
+                self.update_interval(api, sha, committed_at)
+        self.sha, self.committed_at = sha, committed_at
+
+    def update_interval(self, api, sha, committed_at):
+        present = api in self.api_refs
+        if present and api not in self.intervals:
+            self.intervals[api] = {'api': api, 'file': self.api_files[api], 'first_seen_sha': sha,
+                                   'first_seen_at': committed_at, 'saved': False}
+        elif not present and api in self.intervals:
+            interval = self.intervals.pop(api)
+            interval.update({'last_seen_sha': self.sha, 'last_seen_at': self.committed_at,
+                             'removed_sha': sha, 'removed_at': committed_at})
+            self.closed.append(interval)
+
+    def restore(self, sha, committed_at, entries, intervals):
+        """
+        从上次保存的commit恢复: 用这个commit的完整文件列表重建文件状态，数据库里未结束的区间接着用
+        检测规则改过之后两边可能对不上，对不上的api在这个commit开始或者结束区间
+        :param entries: GitMirror.ls_tree的结果
+        :param intervals: 数据库里未结束的区间
+        """
+        self.apply(sha, committed_at, [('A', path, blob_sha) for path, blob_sha, _ in entries], track=False)
+        self.intervals = {interval['api']: dict(interval, saved=True) for interval in intervals}
+        for api in set(self.api_refs) | set(self.intervals):
+            self.update_interval(api, sha, committed_at)
+
+    def pop_changes(self):
+        """
+        取出还没保存的区间
+        :return: (新开始的区间, 结束了的区间)，结束了的区间里saved为False的是这一批里开始又结束的
+        """
+        opened = [interval for interval in self.intervals.values() if not interval['saved']]
+        for interval in opened:
+            interval['saved'] = True
+        closed, self.closed = self.closed, []
+        return opened, closed
@@ -0,0 +1,285 @@
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+
+# 形如 {id} :id <int:id> ${id} 的路径参数统一替换
+PARAM_REG = re.compile(r'^(\{.*\}|:.+|<.*>|\$\{.*\})$')
+HOST_REG = re.compile(r'^[a-z]+://[^/]+')
+
+
+def normalize_path(api):
+    """
+    统一大小写，去掉协议和域名、?后的参数、多余的/，路径参数替换为*
+    """
+    api = str(api).strip().lower()
+    api = HOST_REG.sub('', api).split('?')[0].split('#')[0]
+    segments = [segment for segment in api.split('/') if segment]
+    segments = ['*' if PARAM_REG.match(segment) else segment for segment in segments]
+    return '/' + '/'.join(segments)
+
+
+def char_masks(word):
+    """
+    每个字符在word中出现位置的位图，给levenshtein复用
+    """
+    masks = {}
+    for i, c in enumerate(word):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+def levenshtein(a, b, masks=None):
+    """
+    编辑距离，Myers/Hyyrö的位并行算法，每个字符只做几次整数位运算，比逐格DP快一个数量级
+    :param masks: char_masks(a)，同一个a和很多b比较时传进来避免重复计算
+    """
+    m = len(a)
+    if m == 0:
+        return len(b)
+    masks = char_masks(a) if masks is None else masks
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv = full
+    mv = 0
+    score = m
+    for c in b:
+        eq = masks.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def one_deletes(word):
+    """
+    word本身和删掉一个字符后的所有字符串
+    """
+    return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def partition(length, parts):
+    """
+    长度为length的词平均切成parts段
+    :return: [(起点, 长度)]
+    """
+    base, extra = divmod(length, parts)
+    spans = []
+    start = 0
+    for i in range(parts):
+        size = base + (1 if i < extra else 0)
+        spans.append((start, size))
+        start += size
+    return spans
+
+
+class PartitionIndex:
+    """
+    查找编辑距离max_distance以内的词(鸽巢原理)
+    词平均切成max_distance+1段，编辑不超过max_distance次时至少有一段原样出现在查询词里，位置最多偏移max_distance，
+    按(词长, 段号, 段的内容)建倒排，查询时枚举可能的词长、段号和偏移取候选，只对候选算编辑距离，
+    查询的代价和词表大小基本无关
+    """
+
+    def __init__(self, words=(), max_distance=2):
+        self.max_distance = max_distance
+        self.parts = {}
+        for word in words:
+            for i, (start, size) in enumerate(partition(len(word), max_distance + 1)):
+                self.parts.setdefault((len(word), i, word[start:start + size]), []).append(word)
+
+    def search(self, word, max_distance):
+        """
+        :return: [(distance, word)]
+        """
+        max_distance = min(max_distance, self.max_distance)
+        candidates = set()
+        for length in range(max(len(word) - max_distance, 1), len(word) + max_distance + 1):
+            for i, (start, size) in enumerate(partition(length, self.max_distance + 1)):
+                for begin in range(max(start - max_distance, 0), min(start + max_distance, len(word) - size) + 1):
+                    candidates.update(self.parts.get((length, i, word[begin:begin + size]), ()))
+        masks = char_masks(word)
+        results = []
+        for candidate in candidates:
+            distance = levenshtein(word, candidate, masks)
+            if distance <= max_distance:
+                results.append((distance, candidate))
+        return results
+
+
+class ApiIndex:
+    """
+    t_base_api的内存索引，每次入库t_base_api之后重建
+    - 前缀补全: 规范化后的路径排序，bisect定位前缀
+    - 模糊查找: 路径按/切成片段，先查片段再通过片段到路径的倒排表找出候选路径打分
+      片段的查找分两层，先查"删一个字符"的倒排(覆盖编辑距离1和相邻字符交换，几乎不花时间)，
+      查不到再用PartitionIndex找编辑距离2以内的片段(两处替换、插入等)，100万条路径时单次查询在10ms以内
+    """
+
+    def __init__(self, records, cache_size=4096):
+        """
+        :param records: 可迭代的(api, git_id, project, file, type)
+        :param cache_size: 缓存多少个片段的查找结果，自动补全时同一个片段会被反复查
+        """
+        self.entries = []
+        path_entries = {}
+        for api, git_id, project, file, type_ in records:
+            entry_id = len(self.entries)
+            self.entries.append((api, git_id, project, file, type_))
+            path_entries.setdefault(normalize_path(api), []).append(entry_id)
+
+        self.paths = sorted(path_entries)
+        self.path_entries = [path_entries[path] for path in self.paths]
+        self.path_segments = [tuple(path.split('/')[1:]) for path in self.paths]
+        self.segment_paths = {}
+        for path_id, segments in enumerate(self.path_segments):
+            for segment in set(segments):
+                self.segment_paths.setdefault(segment, []).append(path_id)
+        words = [segment for segment in self.segment_paths if segment != '*']
+        self.deletes = {}
+        for word in words:
+            for key in one_deletes(word):
+                self.deletes.setdefault(key, []).append(word)
+        self.partitions = PartitionIndex(words)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @classmethod
+    def from_dataframe(cls, df, project_names=None):
+        """
+        :param df: 包含api, git_id, file, type列的DataFrame
+        :param project_names: {git_id: project name}
+        """
+        project_names = project_names or {}
+        types = df['type'] if 'type' in df.columns else [None] * len(df)
+        return cls((api, git_id, project_names.get(git_id), file, type_)
+                   for api, git_id, file, type_ in zip(df['api'], df['git_id'], df['file'], types))
+
+    @classmethod
+    def from_mysql(cls, mysql):
+        with mysql.engine.connect() as con:
+            rows = con.execute('SELECT a.api, a.git_id, p.name, a.file, a.type FROM t_base_api a '
+                               'LEFT JOIN t_base_project p ON a.git_id=p.git_id').fetchall()
+        return cls(tuple(row) for row in rows)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expand(self, path_ids, k, distances=None):
+        results = []
+        for path_id in path_ids:
+            for entry_id in self.path_entries[path_id]:
+                api, git_id, project, file, type_ = self.entries[entry_id]
+                results.append({'api': api, 'git_id': git_id, 'project': project, 'file': file, 'type': type_,
+                                'distance': 0 if distances is None else distances[path_id]})
+                if len(results) >= k:
+                    return results
+        return results
+
+    def prefix(self, query, k=10):
+        """
+        前缀补全，返回前k个结果
+        """
+        query = normalize_path(query) if query.strip() not in ['', '/'] else '/'
+        path_ids = []
+        i = bisect_left(self.paths, query)
+        while i < len(self.paths) and self.paths[i].startswith(query):
+            path_ids.append(i)
+            if len(path_ids) >= k:
+                break
+            i += 1
+        return self.expand(path_ids, k)
+
+    def match_segment(self, segment, max_distance, max_postings):
+        """
+        :return: {片段: 编辑距离}
+        倒排表很长的常见片段(比如api、v1)原样命中时不再找相近的片段
+        """
+        key = (segment, max_distance, max_postings)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if len(self.segment_paths.get(segment, ())) > max_postings or max_distance == 0:
+            found = {segment: 0} if segment in self.segment_paths else {}
+        else:
+            masks = char_masks(segment)
+            found = {}
+            for delete in one_deletes(segment):
+                for word in self.deletes.get(delete, ()):
+                    if word not in found:
+                        distance = levenshtein(segment, word, masks)
+                        if distance <= max_distance:
+                            found[word] = distance
+            if len(found) == 0 and max_distance >= 2:
+                found = {word: distance for distance, word in self.partitions.search(segment, max_distance)}
+        self.cache[key] = found
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return found
+
+    def fuzzy(self, query, k=10, max_distance=None, max_postings=2000):
+        """
+        模糊查找
+        每个片段允许的编辑距离: 长度<=4为1，否则为2
+        倒排表很长的常见片段只参与打分，不用来生成候选
+        """
+        query_segments = [segment for segment in normalize_path(query).split('/')[1:] if segment != '*']
+        if len(query_segments) == 0:
+            return []
+
+        matches = []
+        for segment in query_segments:
+            distance = max_distance if max_distance is not None else (1 if len(segment) <= 4 else 2)
+            found = self.match_segment(segment, distance, max_postings)
+            postings = sum(len(self.segment_paths[word]) for word in found)
+            matches.append((postings, found))
+
+        candidates = set()
+        for postings, found in sorted(matches, key=lambda x: x[0]):
+            if postings > max_postings and candidates:
+                break
+            for word in found:
+                candidates.update(self.segment_paths[word][:max_postings])
+            if len(candidates) >= max_postings:
+                break
+
+        scored = []
+        for path_id in candidates:
+            segments = self.path_segments[path_id]
+            matched = 0
+            distance_sum = 0
+            for _, found in matches:
+                best = min((found[segment] for segment in segments if segment in found), default=None)
+                if best is not None:
+                    matched += 1
+                    distance_sum += best
+            if matched == 0:
+                continue
+            missing = len(query_segments) - matched
+            extra = max(len(segments) - matched, 0)
+            scored.append((missing, distance_sum, extra, path_id))
+        top = sorted(scored)[:k]
+        distances = {path_id: distance_sum + missing for missing, distance_sum, _, path_id in top}
+        return self.expand([path_id for _, _, _, path_id in top], k, distances)
+
+    def search(self, query, k=10):
+        """
+        先前缀匹配，不够k个再用模糊查找补齐
+        """
+        results = self.prefix(query, k)
+        if len(results) < k:
+            seen = {(r['api'], r['git_id'], r['file']) for r in results}
+            for result in self.fuzzy(query, k):
+                if (result['api'], result['git_id'], result['file']) not in seen:
+                    results.append(result)
+                if len(results) >= k:
+                    break
+        return results
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import shutil
+import threading
+
+
+class CachedProject:
+    """
+    离线重放时代替gitlab的project对象，只有扫描流程用到的字段
+    """
+
+    def __init__(self, meta):
+        self.id = meta['project_id']
+        self.name = meta.get('name') or str(self.id)
+        self.path = meta.get('path') or self.name
+        self.sha = meta['sha']
+
+
+class ArchiveCache:
+    """
+    按(project_id, commit sha)存放的压缩包缓存，同一个commit的内容不会变，命中就不用再从gitlab下载
+    - 目录结构: <path>/<project_id>/<sha>.<format>，旁边的<sha>.json记录项目名和缓存时间，离线重放时用来还原项目列表
+    - 总大小超过max_mb时按最近使用时间(文件的mtime，命中时更新)淘汰最久没用的压缩包
+    - 写入先写到同目录的临时文件再改名，多个worker进程共用一个缓存目录也不会读到写了一半的文件
+    """
+
+    def __init__(self, path, max_mb=20480):
+        """
+        :param max_mb: 缓存目录的大小上限，0表示不限制
+        """
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def archive_path(self, project_id, sha, format):
+        return os.path.join(self.path, str(project_id), f'{sha}.{format}')
+
+    def get(self, project_id, sha, format):
+        """
+        :return: 缓存的压缩包路径，没有时返回None
+        """
+        path = self.archive_path(project_id, sha, format)
+        try:
+            # 更新mtime作为最近使用时间
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, project_id, sha, format, archive_path, meta=None):
+        """
+        把下载好的压缩包移进缓存，之后淘汰超出大小上限的旧压缩包
+        :param meta: 项目信息，至少包括name，离线重放时用
+        :return: 缓存里的压缩包路径
+        """
+        path = self.archive_path(project_id, sha, format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta_path = self.meta_path(path)
+        tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(meta or {}, project_id=project_id, sha=sha, format=format, cached_at=time.time()), f,
+                      ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+        # 缓存目录可能在别的磁盘上，先移到同目录的临时文件再改名
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.move(archive_path, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def archives(self):
+        """
+        :return: [(mtime, size, 压缩包路径)]
+        """
+        result = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.json') or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # 其他进程刚好淘汰掉了
+                    continue
+                result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def size(self):
+        return sum(size for _, size, _ in self.archives())
+
+    def evict(self, keep=None):
+        """
+        总大小超过上限时从最久没用的开始删，keep(刚放进去的压缩包)不删
+        :return: 删除的压缩包数
+        """
+        if not self.max_bytes:
+            return 0
+        with self.lock:
+            archives = sorted(self.archives())
+            total = sum(size for _, size, _ in archives)
+            evicted = 0
+            for _, size, path in archives:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                for remove_path in [path, self.meta_path(path)]:
+                    try:
+                        os.remove(remove_path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                evicted += 1
+            self.evictions += evicted
+            return evicted
+
+    @staticmethod
+    def meta_path(archive_path):
+        if archive_path.endswith('.tar.gz'):
+            return archive_path[:-len('.tar.gz')] + '.json'
+        return os.path.splitext(archive_path)[0] + '.json'
+
+    def latest(self, format=None):
+        """
+        离线重放用: 每个项目最近缓存的一个commit
+        :return: [meta]，按project_id排序，meta里有project_id, sha, format, name等
+        """
+        latest = {}
+        for _, _, path in self.archives():
+            if format is not None and not path.endswith(f'.{format}'):
+                continue
+            try:
+                with open(self.meta_path(path)) as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            current = latest.get(meta['project_id'])
+            if current is None or meta['cached_at'] > current['cached_at']:
+                latest[meta['project_id']] = meta
+        return [latest[project_id] for project_id in sorted(latest)]
@@ -0,0 +1,140 @@
+import time
+import threading
+import collections
+import pandas as pd
+
+
+class BatchWriterException(Exception):
+    def __init__(self, error):
+        self.error = error
+
+    def __str__(self):
+        return f'后台入库失败: {self.error!r}'
+
+
+class BatchWriter:
+    """
+    后台入库线程: 扫描线程put一个项目的结果之后接着扫下一个项目，入库线程把攒够batch_rows行(或者等了flush_seconds秒)的数据
+    合并成一个事务批量写入，扫描的网络时间和入库的数据库时间重叠，总耗时接近两者中较大的一个
+    - 队列里积压的行数超过max_rows时put阻塞(背压)，扫描比入库快时不会把结果都堆在内存里
+    - 每个事务从engine的连接池取连接，写完归还，长时间扫描时不会一直占着一个可能被服务端断开的连接
+    - close等队列里的数据全部写完；入库出错后put和close抛BatchWriterException，已经提交的批次不回滚
+    """
+
+    def __init__(self, mysql, max_rows=100000, batch_rows=20000, flush_seconds=5.0, chunksize=1000):
+        """
+        :param max_rows: 队列里最多积压的行数
+        :param batch_rows: 攒够这么多行写一次
+        :param flush_seconds: 没攒够batch_rows时，最多等这么久也写一次
+        :param chunksize: 事务里每次executemany的行数
+        """
+        self.mysql = mysql
+        self.max_rows = max_rows
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.chunksize = chunksize
+        self.items = collections.deque()
+        self.queued_rows = 0
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.stats = {'rows': 0, 'batches': 0, 'blocked': 0.0, 'write': 0.0}
+        self.thread = threading.Thread(target=self.run, name='batch-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, table, df):
+        """
+        :param table: 表名，df的列名即字段名
+        """
+        if len(df) == 0:
+            return
+        start = time.time()
+        with self.cond:
+            # 队列是空的时候不管多少行都放进去，否则超过max_rows的单个结果永远放不进去
+            while self.error is None and self.items and self.queued_rows + len(df) > self.max_rows:
+                self.cond.wait()
+            if self.error is not None:
+                raise BatchWriterException(self.error)
+            self.items.append((table, df))
+            self.queued_rows += len(df)
+            self.stats['blocked'] += time.time() - start
+            self.cond.notify_all()
+
+    def take(self):
+        """
+        等到攒够batch_rows行、过了flush_seconds秒或者close，取出队列里的全部数据
+        :return: [(table, df)]，close之后队列也空了返回None
+        """
+        with self.cond:
+            deadline = None
+            while not self.closed and self.queued_rows < self.batch_rows:
+                if self.items and deadline is None:
+                    # 从第一条数据进队列开始计时
+                    deadline = time.time() + self.flush_seconds
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if not self.items:
+                return None
+            batch = list(self.items)
+            self.items.clear()
+            self.queued_rows = 0
+            # 取走之后队列有空位了，唤醒阻塞在put的扫描线程
+            self.cond.notify_all()
+            return batch
+
+    def write(self, batch):
+        frames = {}
+        for table, df in batch:
+            frames.setdefault(table, []).append(df)
+        start = time.time()
+        rows = 0
+        with self.mysql.engine.begin() as con:
+            for table, dfs in frames.items():
+                rows += self.mysql.insert_rows(con, table, pd.concat(dfs, ignore_index=True),
+                                               chunksize=self.chunksize)
+        self.stats['rows'] += rows
+        self.stats['batches'] += 1
+        self.stats['write'] += time.time() - start
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if batch is None:
+                return
+            try:
+                self.write(batch)
+            except Exception as e:
+                with self.cond:
+                    # 后面的数据不再写入，丢掉队列并唤醒阻塞的put，让扫描线程尽快知道出错了
+                    self.error = e
+                    self.items.clear()
+                    self.queued_rows = 0
+                    self.cond.notify_all()
+                return
+
+    def close(self):
+        """
+        :return: 统计 {rows, batches, blocked(put阻塞的秒数), write(写入的秒数)}
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise BatchWriterException(self.error)
+        return self.stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        # 调用方已经在抛异常了，等后台线程结束但不再抛入库的异常
+        try:
+            self.close()
+        except BatchWriterException as e:
+            print(e)
@@ -0,0 +1,271 @@
+import os
+import re
+import zlib
+import pickle
+import struct
+from array import array
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+SHARD_SUFFIX = '.shard'
+HEADER = struct.Struct('<Q')
+# 检测器用到的源码之外也进索引的文件: 配置类的文件和其他语言的源码，查谁读了某个环境变量、连了某个库时要用到
+INDEX_SUFFIXES = {'.env', '.yaml', '.yml', '.properties', '.ini', '.cfg', '.conf', '.toml', '.json', '.xml',
+                  '.java', '.kt', '.go', '.sh', '.sql'}
+INDEX_FILENAMES = {'.env', 'Dockerfile', 'Makefile'}
+
+
+def is_indexed(filepath):
+    """
+    检测器不需要、但要进代码索引的文件，解压和列git tree时和Extractor.is_relevant一起用
+    """
+    filename = os.path.basename(filepath)
+    # .env.production这种splitext拿到的是.production
+    return (os.path.splitext(filename)[1] in INDEX_SUFFIXES or filename in INDEX_FILENAMES
+            or filename.startswith('.env.'))
+
+
+def trigrams(data):
+    """
+    :param data: 小写后的bytes
+    """
+    return {data[i:i + 3] for i in range(len(data) - 2)}
+
+
+def literal_runs(parsed, runs, current):
+    """
+    从sre_parse的结果里找出匹配时必须出现的连续字面量
+    分支、可以为0次的重复、字符集等位置会打断当前的字面量
+    """
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+            continue
+        if current:
+            runs.append(''.join(current))
+            current.clear()
+        if op is sre_parse.SUBPATTERN:
+            literal_runs(av[-1], runs, current)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            literal_runs(av[2], runs, current)
+            if current:
+                runs.append(''.join(current))
+                current.clear()
+    return runs
+
+
+def required_trigrams(pattern, regex=False):
+    """
+    查询匹配时文件里必须包含的trigram，为空时只能全量扫描
+    """
+    if regex:
+        current = []
+        try:
+            runs = literal_runs(sre_parse.parse(pattern), [], current)
+        except re.error:
+            return set()
+        if current:
+            runs.append(''.join(current))
+    else:
+        runs = [pattern]
+    result = set()
+    for run in runs:
+        # 和建索引时一样只对ascii做小写
+        result |= trigrams(run.encode('utf-8').lower())
+    return result
+
+
+class Shard:
+    """
+    一个项目一个shard文件: [头部长度][zlib(pickle(头部))][逐个zlib压缩的文件内容]
+    头部包含项目信息、文件列表、每个文件内容的偏移和trigram倒排表，
+    查询时只读头部，候选文件才解压内容
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            size, = HEADER.unpack(f.read(HEADER.size))
+            header = pickle.loads(zlib.decompress(f.read(size)))
+        self.data_offset = HEADER.size + size
+        self.project_id = header['project_id']
+        self.project_name = header['project_name']
+        self.sha = header['sha']
+        self.paths = header['paths']
+        self.offsets = header['offsets']
+        self.postings = header['postings']
+
+    def candidates(self, required):
+        """
+        :return: 包含全部required trigram的文件序号
+        """
+        if not required:
+            return list(range(len(self.paths)))
+        lists = []
+        for gram in required:
+            posting = self.postings.get(gram)
+            if posting is None:
+                return []
+            lists.append(posting)
+        lists.sort(key=len)
+        result = set(array('I', lists[0]))
+        for posting in lists[1:]:
+            result &= set(array('I', posting))
+            if not result:
+                return []
+        return sorted(result)
+
+    def read(self, f, file_id):
+        start, length = self.offsets[file_id]
+        f.seek(self.data_offset + start)
+        return zlib.decompress(f.read(length)).decode('utf-8', errors='replace')
+
+    @staticmethod
+    def write(path, project_id, project_name, sha, files):
+        """
+        :param files: 可迭代的(相对路径, bytes)
+        """
+        paths = []
+        offsets = []
+        postings = {}
+        blobs = []
+        position = 0
+        for file_path, data in files:
+            file_id = len(paths)
+            paths.append(file_path)
+            blob = zlib.compress(data)
+            offsets.append((position, len(blob)))
+            blobs.append(blob)
+            position += len(blob)
+            for gram in trigrams(data.lower()):
+                postings.setdefault(gram, array('I')).append(file_id)
+        header = zlib.compress(pickle.dumps({
+            'project_id': project_id,
+            'project_name': project_name,
+            'sha': sha,
+            'paths': paths,
+            'offsets': offsets,
+            'postings': {gram: posting.tobytes() for gram, posting in postings.items()},
+        }, protocol=pickle.HIGHEST_PROTOCOL))
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp_path, path)
+        return len(paths)
+
+
+class CodeIndex:
+    """
+    所有项目最新commit源码的trigram索引(zoekt的思路)
+    - 每个项目一个shard，commit没变的项目不重建
+    - 查询先用字面量/正则里必须出现的trigram求交集得到候选文件，再解压候选文件逐行匹配
+    """
+
+    def __init__(self, root, max_file_bytes=1024 * 1024):
+        """
+        :param root: shard存放目录
+        :param max_file_bytes: 超过这个大小的文件不进索引
+        """
+        self.root = root
+        self.max_file_bytes = max_file_bytes
+        self.shards = {}
+        os.makedirs(root, exist_ok=True)
+
+    def shard_path(self, project_id):
+        return os.path.join(self.root, f'{project_id}{SHARD_SUFFIX}')
+
+    def load(self, project_id):
+        """
+        读取shard头部，文件更新过时重新读取
+        """
+        path = self.shard_path(project_id)
+        if not os.path.exists(path):
+            self.shards.pop(project_id, None)
+            return None
+        shard = self.shards.get(project_id)
+        if shard is None or shard.mtime != os.path.getmtime(path):
+            shard = Shard(path)
+            self.shards[project_id] = shard
+        return shard
+
+    def is_current(self, project_id, sha):
+        """
+        sha为None(不知道commit)时总是重建
+        """
+        if sha is None:
+            return False
+        shard = self.load(project_id)
+        return shard is not None and shard.sha == sha
+
+    def update(self, project_id, project_name, sha, extractor):
+        """
+        用Extractor遍历项目文件建shard，sha和已有的shard一致时跳过
+        检测器已经读过的文件从extractor.read_cache里取，只有检测器不读的文件(配置文件等)在这里读取
+        :return: 写入的文件数，跳过时返回None
+        """
+        if self.is_current(project_id, sha):
+            return None
+
+        def files():
+            for root, dirs, names in extractor.walk(extractor.module_path):
+                for name in names:
+                    file_path = os.path.join(root, name)
+                    data = extractor.cached_bytes(file_path)
+                    if len(data) > self.max_file_bytes or b'\0' in data[:8000]:
+                        # 太大的文件和二进制文件
+                        continue
+                    yield os.path.relpath(file_path, extractor.module_path), data
+
+        return Shard.write(self.shard_path(project_id), project_id, project_name, sha, files())
+
+    def remove(self, project_id):
+        path = self.shard_path(project_id)
+        if os.path.exists(path):
+            os.remove(path)
+        self.shards.pop(project_id, None)
+
+    def project_ids(self):
+        return sorted(int(name[:-len(SHARD_SUFFIX)]) for name in os.listdir(self.root)
+                      if name.endswith(SHARD_SUFFIX) and name[:-len(SHARD_SUFFIX)].isdigit())
+
+    def search(self, pattern, regex=False, ignore_case=True, max_results=100, project_ids=None):
+        """
+        :param pattern: 字面量或者正则
+        :param project_ids: 只查这些项目，None为全部
+        :return: (结果[{project_id, project, sha, file, line, text}], 统计{files, candidates, opened})
+        """
+        flags = re.IGNORECASE if ignore_case else 0
+        matcher = re.compile(pattern if regex else re.escape(pattern), flags)
+        required = required_trigrams(pattern, regex)
+        results = []
+        stats = {'files': 0, 'candidates': 0, 'opened': 0}
+        for project_id in project_ids if project_ids is not None else self.project_ids():
+            shard = self.load(project_id)
+            if shard is None:
+                continue
+            stats['files'] += len(shard.paths)
+            candidates = shard.candidates(required)
+            stats['candidates'] += len(candidates)
+            if not candidates:
+                continue
+            with open(shard.path, 'rb') as f:
+                for file_id in candidates:
+                    stats['opened'] += 1
+                    content = shard.read(f, file_id)
+                    if not matcher.search(content):
+                        continue
+                    for line_no, line in enumerate(content.splitlines(), 1):
+                        if matcher.search(line):
+                            results.append({'project_id': shard.project_id, 'project': shard.project_name,
+                                            'sha': shard.sha, 'file': shard.paths[file_id], 'line': line_no,
+                                            'text': line.strip()[:512]})
+                            if len(results) >= max_results:
+                                return results, stats
+        return results, stats
@@ -0,0 +1,266 @@
+import os
+import re
+import sys
+import time
+import pandas as pd
+from utils.js_constants import JsFile, JsConstantTable, SYMBOL_CACHE, content_key
+
+
+class SourceFile:
+    """
+    一个已经读取并解码的项目文件，所有匹配的Detector共用
+    """
+
+    def __init__(self, module_path, root, name, content, lines):
+        self.root = root
+        self.name = name
+        self.path = os.path.join(root, name)
+        self.file = self.relative_file(module_path, self.path)
+        self.content = content
+        self.lines = lines
+
+    @staticmethod
+    def relative_file(module_path, path):
+        # 和原来各提取方法里的写法保持一致
+        return os.path.abspath(path).replace(module_path, '')
+
+
+class Detector:
+    """
+    Extractor遍历项目时对每个文件调用的检测器
+    - suffixes/filenames: 只接收这些后缀或者文件名的文件，同时决定了解压时要保留哪些文件
+    - project_types: 只在这些类型的项目上运行，None表示所有项目
+    - name: 输出的名字，extract()的返回值按name区分
+    - dedup_keys: 这些字段相同的行只保留第一次出现的行，count记出现次数
+    - file_local: 一个文件的结果只取决于这个文件本身，api历史索引增量更新时只需要重新提取改动的文件
+    - symbol_table: 要用到整个项目的符号表(比如前端的常量表)时设成表的类，一个文件的结果只取决于这个文件和符号表，
+      api历史索引增量更新时只重新解析改动的文件，符号表变了才重新解析全部文件
+    每个实例有自己的输出和计时，只在一个项目上用一次
+    """
+    name = ''
+    suffixes = []
+    filenames = []
+    project_types = None
+    dedup_keys = None
+    file_local = True
+    symbol_table = None
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.rows = []
+        self.row_index = {}
+        self.seconds = 0.0
+        self.files = 0
+
+    def add_row(self, row):
+        """
+        同一个文件里同一个api往往出现很多次，只保留第一行，字符串intern后各行共用一份
+        """
+        if self.dedup_keys is None:
+            self.rows.append(row)
+            return
+        key = tuple(row[k] for k in self.dedup_keys)
+        index = self.row_index.get(key)
+        if index is not None:
+            self.rows[index]['count'] += 1
+            return
+        for k in self.dedup_keys:
+            if isinstance(row[k], str):
+                row[k] = sys.intern(row[k])
+        row['count'] = 1
+        self.row_index[key] = len(self.rows)
+        self.rows.append(row)
+
+    def accepts(self, root, name):
+        return os.path.splitext(name)[1] in self.suffixes or name in self.filenames
+
+    def visit(self, source):
+        raise NotImplementedError
+
+    def visit_cached(self, root, name, key):
+        """
+        key是文件内容的hash(git blob sha)，有这个文件的缓存结果时直接使用，返回True就不用读取这个文件
+        """
+        return False
+
+    def result(self):
+        df = pd.DataFrame(self.rows)
+        df.index = [i for i in range(len(df))]
+        return df
+
+    def stats(self):
+        return {'seconds': self.seconds, 'files': self.files, 'rows': len(self.rows)}
+
+
+class DatabaseUrlDetector(Detector):
+    name = 'database_url'
+    suffixes = ['.py']
+    dedup_keys = ['file', 'database_url']
+
+    def visit(self, source):
+        for idx, line in enumerate(source.lines):
+            database_url = self.extractor.extract_database_url_from_line(line, source.lines)
+            if database_url == None:
+                continue
+            self.add_row({'file': source.file,
+                          'database_url': database_url.replace(re.search('(?<=\/\/).+?(?=\@)', database_url).group(), '账号密码已打码'),  # 这里加密一下密码字段
+                          'line': idx + 1, 'text': line})
+
+
+class FrontendApiDetector(Detector):
+    """
+    前端api: 字符串里的路径，以及用常量拼出来的路径(`${BASE_URL}/order/list`、API_PREFIX + '/user')
+    每个文件解析出常量和拼接的表达式(按内容hash缓存)，遍历完整个项目后用常量表统一解析，
+    常量可以来自本文件，也可以来自其他文件export的常量，解析不了的还是按原来的字符串输出
+    """
+    name = 'api'
+    dedup_keys = ['file', 'api']
+    suffixes = ['.js', '.ts', '.tsx']
+    project_types = ['frontend']
+    # 拼接的url要用其他文件导出的常量解析
+    file_local = False
+    symbol_table = JsConstantTable
+
+    def __init__(self, extractor):
+        super().__init__(extractor)
+        self.js_files = []  # [(file, JsFile)]，遍历顺序
+
+    def accepts(self, root, name):
+        if os.path.join(self.extractor.module_path, 'node_modules') in root:
+            return False
+        return super().accepts(root, name)
+
+    def cache_key(self, key):
+        # 超长行会被清空，解析结果和max_line_length有关
+        return key, self.extractor.max_line_length
+
+    def visit_cached(self, root, name, key):
+        hit, js_file = SYMBOL_CACHE.get(self.cache_key(key))
+        if hit:
+            self.js_files.append((SourceFile.relative_file(self.extractor.module_path, os.path.join(root, name)),
+                                  js_file))
+        return hit
+
+    def parse(self, source):
+        key = self.cache_key(content_key(source.content.encode('utf-8')))
+        hit, js_file = SYMBOL_CACHE.get(key)
+        if not hit:
+            js_file = JsFile.parse(source.lines, self.extractor.extract_api_from_line)
+            SYMBOL_CACHE.put(key, js_file)
+        return js_file
+
+    def parse_file(self, root, name):
+        """
+        :return: JsFile，不是utf-8的文件返回None
+        """
+        key = self.extractor.content_key(os.path.join(root, name))
+        if key is not None:
+            hit, js_file = SYMBOL_CACHE.get(self.cache_key(key))
+            if hit:
+                return js_file
+        source = self.extractor.read_source(root, name)
+        return self.parse(source) if source is not None else None
+
+    def visit(self, source):
+        self.js_files.append((source.file, self.parse(source)))
+
+    def file_apis(self, table, js_file):
+        """
+        拼接的表达式解析成功时用完整的url，替换掉其中字面量单独匹配出来的半截路径
+        :return: [(行号, api)]
+        """
+        rows = []
+        for idx, apis, composed in js_file.lines:
+            apis = list(apis)
+            for parts in composed:
+                value = table.resolve(js_file, parts, partial=True)
+                if value is None:
+                    continue
+                fragments = {api for kind, text in parts if kind == 'str'
+                             for api in self.extractor.extract_api_from_line(f"'{text}'")}
+                apis = [api for api in apis if api not in fragments]
+                for api in self.extractor.extract_api_from_line(f"'{value}'"):
+                    if api not in apis:
+                        apis.append(api)
+            rows.extend((idx + 1, api) for api in apis)
+        return rows
+
+    def result(self):
+        start = time.perf_counter()
+        table = self.symbol_table()
+        for _, js_file in self.js_files:
+            table.add(js_file)
+        for file, js_file in self.js_files:
+            for line, api in self.file_apis(table, js_file):
+                self.add_row({'file': file, 'api': api, 'line': line})
+        self.js_files = []
+        self.seconds += time.perf_counter() - start
+        return super().result()
+
+
+class ApiFrameworkDetector(Detector):
+    name = 'api'
+    dedup_keys = ['file', 'api']
+    filenames = ['__init__.py']
+    project_types = ['api-framework']
+    # 没有Blueprint的文件沿用遍历顺序上前一个文件的Blueprint，不能只看单个文件
+    file_local = False
+
+    def __init__(self, extractor):
+        super().__init__(extractor)
+        # 没有Blueprint的__init__.py沿用上一个文件里的Blueprint名字
+        self.blueprint_name = None
+
+    def visit(self, source):
+        urls = []
+        for line in source.lines:
+            if self.extractor.check_comment(line) == True:
+                continue
+            if 'Blueprint(' in line:
+                reg = '(?<=[\"\'`]).+?(?=[\"\'`])'
+                self.blueprint_name = re.findall(reg, line)[0]
+            if 'add_resource(' in line:
+                reg = '(?<=[\"\'`]).+(?=[\"\'`])'
+                urls.extend(re.findall(reg, line))
+        if len(urls) > 0 and self.blueprint_name is not None:
+            for url in urls:
+                self.add_row({'file': source.file, 'api': '/' + self.blueprint_name + url, 'line': '-'})
+
+
+class YardBaseDetector(Detector):
+    name = 'api'
+    dedup_keys = ['file', 'api']
+    suffixes = ['.py']
+    project_types = ['yard-base']
+
+    def __init__(self, extractor):
+        super().__init__(extractor)
+        self.app_path = os.path.join(extractor.module_path, 'src', 'app')
+
+    def accepts(self, root, name):
+        if root != self.app_path and not root.startswith(self.app_path + os.sep):
+            return False
+        if '__pycache__' in root:
+            return False
+        return super().accepts(root, name)
+
+    @staticmethod
+    def get_default_url_name(cls_name):
+        p = re.compile(r'([a-z]|\d)([A-Z])')
+        return re.sub(p, r'\1-\2', cls_name).lower().replace('.py', '')
+
+    def visit(self, source):
+        for line in source.lines:
+            if 'class' in line and 'AbstractApi' in line and '(' in line and ')' in line:
+                class_name = line.split('class')[1].split('(')[0].replace(' ', '')
+                file_path = os.path.join(source.root.replace(self.app_path, ''), source.name)
+                path1, path2 = os.path.split(file_path)
+                if path1 == '' or path1[0] != '/':
+                    path1 = '/' + path1
+                self.add_row({
+                    'file': source.path.replace(self.extractor.module_path, ''),
+                    'api': os.path.join(path1, self.get_default_url_name(class_name)),
+                    'line': '-'})
+
+
+DETECTORS = [DatabaseUrlDetector, FrontendApiDetector, ApiFrameworkDetector, YardBaseDetector]
@@ -1,6 +1,9 @@
+import io
 import os
 import re
+import time
 import pandas as pd
+from utils.detector import SourceFile, DETECTORS
 
 
 class FilePathException(Exception):
@@ -11,7 +14,35 @@ class FilePathException(Exception):
         return (self.msg)
 
 
+class ResourceLimitException(Exception):
+    """
+    项目超过了扫描的资源限制(解压后大小、文件数、提取耗时等)，只跳过这个项目
+    """
+
+    def __init__(self, project, limit, value, max_value):
+        self.project = project
+        self.limit = limit
+        self.value = value
+        self.max_value = max_value
+
+    def __str__(self):
+        return (f'limit: {self.project} {self.limit} {self.value} exceeds {self.max_value}')
+
+
 class Extractor():
+    # 注册的检测器，以及判断项目类型用到的标记文件，解压时只需要检测器会读取的文件和标记文件
+    DETECTORS = DETECTORS
+    MARKER_FILES = ['package.json', 'runserver.py']
+    # 超过这个长度的行(压缩后的bundle之类)当作空行，0表示不限制
+    max_line_length = 0
+    # 从started_at(time.time())开始超过timeout秒还没提取完时抛ResourceLimitException，0表示不限制
+    timeout = 0
+    started_at = None
+    # 超过资源限制时报告的项目名，没有设置时用module_path
+    project_name = None
+    # 不为None时检测器读过的原始内容按路径留在这里，建代码索引时直接用，不用再读一遍
+    read_cache = None
+
     def __init__(self, filepath):
         if not os.path.exists(filepath):
             raise FilePathException(f'{filepath} 路径不存在')
@@ -48,6 +79,63 @@ class Extractor():
     #                         f.write('')
     #                     break
 
+    @classmethod
+    def manifest(cls):
+        suffixes = set()
+        filenames = set(cls.MARKER_FILES)
+        for detector in cls.DETECTORS:
+            suffixes.update(detector.suffixes)
+            filenames.update(detector.filenames)
+        return suffixes, filenames
+
+    @classmethod
+    def is_relevant(cls, filepath):
+        suffixes, marker_files = cls.manifest()
+        filename = os.path.basename(filepath)
+        return os.path.splitext(filename)[1] in suffixes or filename in marker_files
+
+    def walk(self, top=None, topdown=True):
+        """
+        遍历项目文件，返回值和os.walk一样，GitTreeExtractor里改为遍历git tree
+        """
+        return os.walk(top or self.module_path, topdown=topdown)
+
+    def open_file(self, filepath):
+        """
+        以文本方式打开项目文件，GitTreeExtractor里改为从git对象库读取
+        """
+        return open(filepath, 'r')
+
+    def read_bytes(self, filepath):
+        """
+        读取项目文件的原始内容，建代码索引时使用
+        """
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    def cached_bytes(self, filepath):
+        """
+        检测器已经读过的文件从read_cache里取(取出后释放)，没读过的再读取
+        """
+        if self.read_cache is not None and filepath in self.read_cache:
+            return self.read_cache.pop(filepath)
+        return self.read_bytes(filepath)
+
+    def content_key(self, filepath):
+        """
+        不读文件就能拿到的内容hash，磁盘上的文件没有，GitTreeExtractor里是blob sha
+        """
+        return None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def project_type(self):
         """
@@ -56,7 +144,7 @@ class Extractor():
         """
         all_files = []
         all_dirs = []
-        for root, dirs, files in os.walk(self.module_path, topdown=False):
+        for root, dirs, files in self.walk(self.module_path, topdown=False):
             all_files.extend(files)
             all_dirs.extend(dirs)
         if 'package.json' in all_files:
@@ -102,25 +190,87 @@ class Extractor():
             f_string = f_string.replace('{' + f'{var_name}' + '}', var_dict[var_name])
         return f_string.replace(' ', '')
 
+    def read_source(self, root, name):
+        """
+        读取并解码一个文件，按readlines的规则切行，不是utf-8的文件返回None
+        """
+        path = os.path.join(root, name)
+        data = self.read_bytes(path)
+        if self.read_cache is not None:
+            self.read_cache[path] = data
+        try:
+            content = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        lines = io.StringIO(content, newline=None).readlines()
+        if self.max_line_length:
+            # 保留行号，只把超长的行清空，正则不会在一行几十M的内容上卡住
+            lines = [line if len(line) <= self.max_line_length else '\n' for line in lines]
+        return SourceFile(self.module_path, root, name, content, lines)
+
+    def detectors(self, names=None):
+        """
+        实例化适用于当前项目类型的检测器
+        :param names: 只要这些name的检测器，None为全部
+        """
+        project_type = self.project_type
+        return [detector(self) for detector in self.DETECTORS
+                if (names is None or detector.name in names)
+                and (detector.project_types is None or project_type in detector.project_types)]
+
+    def run_detectors(self, detectors):
+        """
+        遍历一次项目，每个文件只读取解码一次，交给所有接收它的检测器
+        :return: {name: DataFrame}
+        """
+        if self.started_at is None:
+            self.started_at = time.time()
+        self.detector_stats = {'read': {'seconds': 0.0, 'files': 0, 'skipped': 0}}
+        read_stats = self.detector_stats['read']
+        for root, dirs, files in self.walk(self.module_path):
+            for name in files:
+                matched = [detector for detector in detectors if detector.accepts(root, name)]
+                key = self.content_key(os.path.join(root, name)) if matched else None
+                if key is not None:
+                    # 有缓存结果的检测器不用再读这个文件
+                    cached = [detector for detector in matched if detector.visit_cached(root, name, key)]
+                    for detector in cached:
+                        detector.files += 1
+                    matched = [detector for detector in matched if detector not in cached]
+                if len(matched) == 0:
+                    continue
+                if self.timeout and time.time() - self.started_at > self.timeout:
+                    raise ResourceLimitException(self.project_name or self.module_path, 'extract_seconds',
+                                                 round(time.time() - self.started_at), self.timeout)
+                start = time.perf_counter()
+                source = self.read_source(root, name)
+                read_stats['seconds'] += time.perf_counter() - start
+                if source is None:
+                    # 编码不对的文件跳过，不影响同一个项目的其他文件
+                    read_stats['skipped'] += 1
+                    continue
+                read_stats['files'] += 1
+                for detector in matched:
+                    start = time.perf_counter()
+                    detector.visit(source)
+                    detector.seconds += time.perf_counter() - start
+                    detector.files += 1
+        results = {}
+        for detector in detectors:
+            results[detector.name] = detector.result()
+            # 同一个name可能有多个检测器(比如api)，按类名区分
+            self.detector_stats[type(detector).__name__] = detector.stats()
+        return results
+
+    def extract(self, names=None):
+        """
+        一次遍历跑完所有检测器
+        :return: {name: DataFrame}，比如 {'database_url': df, 'api': df}，没有适用检测器的name不在结果里
+        """
+        return self.run_detectors(self.detectors(names))
+
     def extract_database_url(self):
-        datas = []
-        for root, dirs, files in os.walk(self.module_path, topdown=False):
-            for file in files:
-                if os.path.splitext(file)[1] == '.py':
-                    filepath = os.path.join(root, file)
-                    with open(filepath, 'r') as f:
-                        lines = f.readlines()
-                        for idx, line in enumerate(lines):
-                            database_url = self.extract_database_url_from_line(line, lines)
-                            if database_url == None:
-                                continue
-                            data = {'file': os.path.abspath(filepath).replace(self.module_path, ''),
-                                 'database_url': database_url.replace(re.search('(?<=\/\/).+?(?=\@)', database_url).group(), '账号密码已打码'), # 这里加密一下密码字段
-                                 'line': idx + 1, 'text': line}
-                            datas.append(data)
-        df = pd.DataFrame(datas)
-        df.index = [i for i in range(len(df))]
-        return df
+        return self.extract(['database_url']).get('database_url', pd.DataFrame())
 
     def extract_database_url_from_line(self, text, lines):
         # 需要解决这种情况：mysql+pymysql://{username}:{password}@{host}:{port}/{database}?charset=utf8
@@ -144,15 +294,7 @@ class Extractor():
         return database_url
 
     def extract_api(self):
-        if self.project_type == 'yard-base':
-            df = self.extract_api_from_yard_base()
-        elif self.project_type == 'api-framework':
-            df = self.extract_api_from_api_framework()
-        elif self.project_type == 'frontend':
-            df = self.extract_api_from_frontend()
-        else:
-            df = pd.DataFrame()
-        return df
+        return self.extract(['api']).get('api', pd.DataFrame())
 
     def extract_api_from_line(self, text):
         reg_with_port = '(?<=[\"\'`])[http|https].+/.+:[0-9]+.+(?=[\"\'`])'
@@ -168,104 +310,6 @@ class Extractor():
         apis = [api.split('?')[0] for api in apis if len(api) < 100 and len(api) > 4] # ?后的参数要去除
         return apis
 
-    def extract_api_from_yard_base(self):
-        def get_default_url_name(cls_name):
-            p = re.compile(r'([a-z]|\d)([A-Z])')
-            return re.sub(p, r'\1-\2', cls_name).lower().replace('.py', '')
-
-        def get_class_name(file):
-            class_names = []
-            if file.endswith('.py'):
-                with open(file, 'r') as f:
-                    try:
-                        lines = f.readlines()
-                        for line in lines:
-                            if 'class' in line and 'AbstractApi' in line and '(' in line and ')' in line:
-                                class_name = line.split('class')[1].split('(')[0].replace(' ', '')
-                                class_names.append(class_name)
-                        return class_names
-                    except UnicodeDecodeError:
-                        return []
-            return []
-
-        datas = []
-        app_path = os.path.join(self.module_path, 'src', 'app')
-        for dir_path, dir_names, files in os.walk(app_path):
-            for file in files:
-                if '__pycache__' in dir_path:
-                    continue
-                file_full_path = os.path.join(dir_path, file)
-                class_names = get_class_name(file_full_path)
-                if len(class_names) == 0:
-                    continue
-                for class_name in class_names:
-                    file_path = os.path.join(dir_path.replace(app_path, ''), file)
-                    path1, path2 = os.path.split(file_path)
-                    if path1 == '' or path1[0] != '/':
-                        path1 = '/' + path1
-
-                    url = os.path.join(path1, get_default_url_name(class_name))
-                    # url = '/'.join([get_default_url_name(item) for item in file_path.split('/')])
-                    datas.append({
-                        'file': file_full_path.replace(self.module_path, ''),
-                        'api': url,
-                        'line': '-'})
-        df = pd.DataFrame(datas)
-        df.index = [i for i in range(len(df))]
-        return df
-
-    def extract_api_from_api_framework(self):
-        datas = []
-        for dir_path, dir_names, files in os.walk(self.module_path):
-            for file in files:
-                single_file_urls = []
-                if file == '__init__.py':
-                    with open(os.path.join(dir_path, file), 'r') as f:
-                        try:
-                            lines = f.readlines()
-                            for line in lines:
-                                if self.check_comment(line) == True:
-                                    continue
-                                if 'Blueprint(' in line:
-                                    reg = '(?<=[\"\'`]).+?(?=[\"\'`])'
-                                    Blueprint_name = re.findall(reg, line)[0]
-                                if 'add_resource(' in line:
-                                    reg = '(?<=[\"\'`]).+(?=[\"\'`])'
-                                    url = re.findall(reg, line)
-                                    single_file_urls.extend(url)
-                        except UnicodeDecodeError:
-                            continue
-                if len(single_file_urls) > 0:
-                    single_file_urls = ['/' + Blueprint_name + url for url in single_file_urls]
-                    data = [{'file': os.path.abspath(os.path.join(dir_path, file)).replace(self.module_path, ''),
-                             'api': api,
-                             'line': '-'} for api in single_file_urls]
-                    datas.extend(data)
-        df = pd.DataFrame(datas)
-        df.index = [i for i in range(len(df))]
-        return df
-
-    def extract_api_from_frontend(self):
-        datas = []
-        for root, dirs, files in os.walk(self.module_path, topdown=False):
-            if os.path.join(self.module_path, 'node_modules') in root:
-                continue
-            for file in files:
-                if os.path.splitext(file)[1] in ['.js', '.ts', '.tsx']:
-                    filepath = os.path.join(root, file)
-                    with open(filepath, 'r') as f:
-                        lines = f.readlines()
-                        for idx, line in enumerate(lines):
-                            if 'from' in line or 'import' in line:
-                                continue
-                            apis = self.extract_api_from_line(line)
-                            data = [{'file': os.path.abspath(filepath).replace(self.module_path, ''), 'api': api,
-                                     'line': idx + 1} for api in apis]
-                            datas.extend(data)
-        df = pd.DataFrame(datas)
-        df.index = [i for i in range(len(df))]
-        return df
-
 
 """
 由于使用多进程的原因
@@ -0,0 +1,251 @@
+import io
+import os
+import base64
+import shutil
+import subprocess
+from utils.extractor import Extractor
+
+
+class GitMirrorException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return (self.msg)
+
+
+class GitMirror:
+    """
+    在本地为每个项目维护一个bare仓库，第一次clone，之后只做增量的git fetch
+    读取文件时不检出工作区，通过git ls-tree列目录、git cat-file --batch读blob
+    url可以是gitlab的http地址，也可以是file://的本地仓库(测试时不需要网络)
+    """
+
+    def __init__(self, root, token=None):
+        """
+        :param root: 存放bare仓库的目录
+        :param token: gitlab的token，通过GIT_CONFIG_*环境变量设置http.extraHeader传给git，
+        不写进仓库配置，也不出现在命令行参数里(ps能看到命令行)，需要git 2.31以上
+        """
+        self.root = root
+        self.token = token
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, project_id):
+        return os.path.join(self.root, f'{project_id}.git')
+
+    def git(self, *args, cwd=None, auth=False):
+        env = None
+        if auth and self.token:
+            basic = base64.b64encode(f'oauth2:{self.token}'.encode()).decode()
+            env = dict(os.environ, GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='http.extraHeader',
+                       GIT_CONFIG_VALUE_0=f'Authorization: Basic {basic}')
+        result = subprocess.run(['git', *args], cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise GitMirrorException(f'{" ".join(args)} failed: {result.stderr.decode(errors="replace").strip()}')
+        return result.stdout
+
+    def sync(self, project_id, url):
+        """
+        不存在时clone --bare，存在时fetch，只同步分支和tag
+        """
+        path = self.path(project_id)
+        if not os.path.exists(path):
+            tmp_path = f'{path}.tmp'
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            self.git('clone', '--bare', '--quiet', url, tmp_path, auth=True)
+            self.git('config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*', cwd=tmp_path)
+            os.rename(tmp_path, path)
+        else:
+            self.git('fetch', '--prune', '--tags', '--quiet', url, '+refs/heads/*:refs/heads/*', cwd=path,
+                     auth=True)
+        return path
+
+    def resolve(self, project_id, ref='HEAD'):
+        """
+        :return: ref对应的commit sha，仓库为空时返回None
+        """
+        try:
+            return self.git('rev-parse', '--verify', '--quiet', f'{ref}^{{commit}}',
+                            cwd=self.path(project_id)).decode().strip()
+        except GitMirrorException:
+            return None
+
+    def ls_tree(self, project_id, sha):
+        """
+        :return: [(path, blob_sha, size)]，只包含普通文件
+        """
+        output = self.git('ls-tree', '-r', '-z', '--long', sha, cwd=self.path(project_id))
+        entries = []
+        for item in output.split(b'\0'):
+            if not item:
+                continue
+            meta, path = item.split(b'\t', 1)
+            mode, type_, blob_sha, size = meta.split()
+            if type_ != b'blob' or mode == b'120000':
+                # 跳过子模块和软链接
+                continue
+            entries.append((path.decode(errors='surrogateescape'), blob_sha.decode(), int(size)))
+        return entries
+
+    def is_ancestor(self, project_id, ancestor, sha):
+        result = subprocess.run(['git', 'merge-base', '--is-ancestor', ancestor, sha], cwd=self.path(project_id),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return result.returncode == 0
+
+    def log_changes(self, project_id, sha, since=None, chunk_size=1 << 16):
+        """
+        沿first-parent从旧到新遍历commit，每个commit只给出相对第一个父commit改动的文件
+        一个git log进程流式输出，不为每个commit单独调用diff-tree
+        :param since: 从这个commit之后开始，None为从第一个commit开始(第一个commit的改动是全部文件)
+        :return: 生成器 (sha, committed_at, [(status, path, blob_sha)])，status为A/M/D，删除时blob_sha为None
+        """
+        revision = f'{since}..{sha}' if since else sha
+        process = subprocess.Popen(['git', 'log', '--reverse', '--first-parent', '-m', '--raw', '-z', '--no-renames',
+                                    '--no-abbrev', '--format=%x01%H %cI', revision],
+                                   cwd=self.path(project_id), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        buffer = b''
+        try:
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                buffer += chunk
+                records = buffer.split(b'\x01')
+                # 最后一段可能还没读完，留到下一轮
+                buffer = records.pop() if chunk else b''
+                for record in records if chunk else records + [buffer]:
+                    if record:
+                        yield self.parse_log_record(record)
+                if not chunk:
+                    break
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read()
+            process.stderr.close()
+            if process.wait() != 0 and process.returncode != -13:
+                raise GitMirrorException(f'log {revision} failed: {stderr.decode(errors="replace").strip()}')
+
+    @staticmethod
+    def parse_log_record(record):
+        header, _, raw = record.partition(b'\0')
+        commit_sha, committed_at = header.decode().split(' ', 1)
+        items = raw.lstrip(b'\n').split(b'\0')
+        changes = []
+        for meta, path in zip(items[0::2], items[1::2]):
+            _, new_mode, _, blob_sha, status = meta.split()
+            status = status.decode()[0]
+            if status not in ('A', 'D'):
+                # M和T(类型变化)都当作修改
+                status = 'M'
+            if new_mode in (b'160000', b'120000'):
+                # 子模块和软链接当作删除，和ls_tree保持一致
+                status, blob_sha = 'D', None
+            changes.append((status, path.decode(errors='surrogateescape'),
+                            None if status == 'D' else blob_sha.decode()))
+        return commit_sha, committed_at, changes
+
+    def cat_file(self, project_id):
+        return BlobReader(self.path(project_id))
+
+
+class BlobReader:
+    """
+    常驻一个git cat-file --batch进程，按blob sha逐个读取内容
+    """
+
+    def __init__(self, repo_path):
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo_path, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def read(self, blob_sha):
+        self.process.stdin.write(f'{blob_sha}\n'.encode())
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise GitMirrorException(f'{blob_sha} missing')
+        size = int(header[2])
+        data = self.process.stdout.read(size)
+        self.process.stdout.read(1)
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GitTreeExtractor(Extractor):
+    """
+    直接在bare仓库的某个commit上运行Extractor，不解压、不检出工作区
+    module_path是一个虚拟的根路径，文件路径的拼接和替换逻辑和磁盘上的目录保持一致
+    """
+
+    def __init__(self, mirror, project_id, sha, max_file_bytes=0, keep=None):
+        """
+        :param max_file_bytes: 超过这个大小的文件和manifest之外的文件不列出，0表示不限制大小
+        :param keep: manifest之外也要列出的文件，keep(path)为True时保留，比如代码索引要的配置文件
+        """
+        self.mirror = mirror
+        self.project_id = project_id
+        self.sha = sha
+        self.module_path = os.path.join(mirror.path(project_id), sha)
+        self.blobs = {}
+        self.tree = {}
+        entries = mirror.ls_tree(project_id, sha)
+        # 整个tree的文件数和大小，检查资源限制用
+        self.total_files = len(entries)
+        self.total_bytes = sum(size for _, _, size in entries)
+        for path, blob_sha, size in entries:
+            dir_path, file = os.path.split(path)
+            # 跳过的文件也保留所在的文件夹，判断项目类型时要用到
+            self.add_dir(dir_path)
+            if not (self.is_relevant(path) or (keep is not None and keep(path))) or \
+                    (max_file_bytes and size > max_file_bytes):
+                continue
+            self.blobs[os.path.join(self.module_path, path)] = blob_sha
+            self.tree[dir_path][1].append(file)
+        self.add_dir('')
+        self.reader = mirror.cat_file(project_id)
+
+    def add_dir(self, dir_path):
+        if dir_path in self.tree:
+            return
+        self.tree[dir_path] = ([], [])
+        if dir_path:
+            parent, name = os.path.split(dir_path)
+            self.add_dir(parent)
+            self.tree[parent][0].append(name)
+
+    def walk(self, top=None, topdown=True):
+        top = top or self.module_path
+        relative = os.path.relpath(top, self.module_path)
+        relative = '' if relative == '.' else relative
+        if relative not in self.tree:
+            return
+        dirs, files = self.tree[relative]
+        root = os.path.join(self.module_path, relative) if relative else self.module_path
+        if topdown:
+            yield root, list(dirs), list(files)
+        for name in dirs:
+            yield from self.walk(os.path.join(root, name), topdown=topdown)
+        if not topdown:
+            yield root, list(dirs), list(files)
+
+    def open_file(self, filepath):
+        data = self.reader.read(self.blobs[filepath])
+        return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+    def read_bytes(self, filepath):
+        return self.reader.read(self.blobs[filepath])
+
+    def content_key(self, filepath):
+        return self.blobs.get(filepath)
+
+    def close(self):
+        self.reader.close()
@@ -0,0 +1,216 @@
+import time
+import random
+import threading
+import email.utils
+import multiprocessing as mp
+import requests
+
+# 这些状态码说明gitlab过载或者暂时不可用，退避之后重试
+RETRY_STATUS = [429, 500, 502, 503, 504]
+# 这些状态码说明gitlab在限流，需要降低并发
+THROTTLE_STATUS = [429, 503]
+
+
+class TokenBucket:
+    """
+    令牌桶限速，每秒补充rate个令牌，最多攒burst个
+    state是spawn上下文的共享数组[令牌数, 上次补充时间]，传给进程池的worker之后多个进程共用一个桶
+    """
+
+    def __init__(self, rate, burst=None, state=None):
+        """
+        :param rate: 每秒请求数，0表示不限速
+        :param burst: 桶的容量，默认等于rate
+        :param state: TokenBucket.shared_state()创建的共享状态，None时新建
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.state = state if state is not None else self.shared_state(self.burst)
+
+    @staticmethod
+    def shared_state(burst):
+        return mp.get_context('spawn').Array('d', [float(burst), time.time()])
+
+    def take(self):
+        """
+        取一个令牌，没有时睡到下一个令牌补充出来
+        :return: 等待的秒数
+        """
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.state.get_lock():
+                now = time.time()
+                tokens = min(self.burst, self.state[0] + (now - self.state[1]) * self.rate)
+                self.state[1] = now
+                if tokens >= 1:
+                    self.state[0] = tokens - 1
+                    return waited
+                self.state[0] = tokens
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """
+        Retry-After: 把令牌数降为负数，所有共用这个桶的进程都会等到这段时间之后
+        """
+        if not self.rate or seconds <= 0:
+            return
+        with self.state.get_lock():
+            now = time.time()
+            tokens = min(self.burst, self.state[0] + (now - self.state[1]) * self.rate)
+            self.state[0] = min(tokens, -seconds * self.rate)
+            self.state[1] = now
+
+
+class AdaptiveLimiter:
+    """
+    AIMD并发控制: 每个成功的请求让并发上限增加1/limit(大约每一轮增加1)，
+    遇到限流或者过载时并发上限减半，不低于min_limit
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=16):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.increases = 0
+        self.decreases = 0
+        # 运行期间降到过的最低并发上限
+        self.lowest = self.limit
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.lowest = min(self.lowest, self.limit)
+                self.decreases += 1
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.increases += 1
+            self.cond.notify_all()
+
+
+def retry_after_seconds(response):
+    """
+    Retry-After可以是秒数，也可以是HTTP日期
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class GitLabSession(requests.Session):
+    """
+    GitLabChecker所有gitlab请求共用的session，python-gitlab通过session参数使用它，成员接口直接用它发请求
+    每个请求: AIMD并发控制 -> 令牌桶限速 -> 发送，429/5xx和连接错误按Retry-After或者指数退避重试
+    stream=True的请求(下载压缩包)在响应体读完或者close之后才释放并发名额
+    """
+
+    def __init__(self, bucket=None, limiter=None, max_retries=5, backoff_base=1.0, backoff_max=60.0):
+        super().__init__()
+        self.bucket = bucket or TokenBucket(0)
+        self.limiter = limiter or AdaptiveLimiter()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'errors': 0, 'waited': 0.0}
+
+    def count(self, key, value=1):
+        with self.stats_lock:
+            self.stats[key] += value
+
+    def backoff(self, attempt, response=None):
+        seconds = retry_after_seconds(response) if response is not None else None
+        if seconds is not None:
+            # 服务端指定了等待时间，其他线程和进程也一起等
+            self.bucket.pause(seconds)
+            return min(seconds, self.backoff_max)
+        return min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    def release_on_close(self, response, throttled):
+        """
+        流式响应的body还没读，读完(urllib3归还连接)或者close之前一直占着并发名额，只释放一次
+        """
+        lock = threading.Lock()
+        released = False
+
+        def release():
+            nonlocal released
+            with lock:
+                if released:
+                    return
+                released = True
+            self.limiter.release(throttled=throttled)
+
+        raw_release_conn = getattr(response.raw, 'release_conn', None)
+        if raw_release_conn is not None:
+            def release_conn():
+                try:
+                    raw_release_conn()
+                finally:
+                    release()
+
+            response.raw.release_conn = release_conn
+        close = response.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+
+        response.close = close_and_release
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                self.count('waited', self.bucket.take())
+                self.count('requests')
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.release(throttled=True)
+                self.count('errors')
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                self.count('retries')
+                continue
+            throttled = response.status_code in THROTTLE_STATUS
+            overloaded = throttled or response.status_code in RETRY_STATUS
+            if throttled:
+                self.count('throttled')
+            if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                if kwargs.get('stream'):
+                    self.release_on_close(response, overloaded)
+                else:
+                    self.limiter.release(throttled=overloaded)
+                return response
+            self.limiter.release(throttled=overloaded)
+            seconds = self.backoff(attempt, response)
+            response.close()
+            time.sleep(seconds)
+            attempt += 1
+            self.count('retries')
@@ -0,0 +1,211 @@
+import re
+import hashlib
+from utils.query_cache import QueryCache
+
+# 按行切出字符串、模板字符串、标识符和+号，其他字符逐个作为other
+TOKEN = re.compile(r"""(?P<str>'[^'\\\n]*(?:\\.[^'\\\n]*)*'|"[^"\\\n]*(?:\\.[^"\\\n]*)*")"""
+                   r"""|(?P<tpl>`[^`\\]*(?:\\.[^`\\]*)*`)"""
+                   r"""|(?P<name>[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*)"""
+                   r"""|(?P<plus>\+)|(?P<space>\s+)|(?P<other>.)""")
+OPERANDS = ['str', 'tpl', 'name']
+PLACEHOLDER = re.compile(r'\$\{([^}]*)\}')
+IDENTIFIER = re.compile(r'[A-Za-z_$][\w$]*$')
+# const/let/var声明，TS的类型标注跳过
+DECLARATION = re.compile(r'^\s*(export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*(?::[^=]+)?=(?!=)(.*)$')
+EXPORT_LIST = re.compile(r'^\s*export\s*\{([^}]*)\}\s*;?\s*$')
+# import语句、export ... from、多行import的最后一行和require/动态import
+IMPORT_LINE = re.compile(r'''^\s*import[\s{*'"]|^\s*export\b.*\bfrom\s*['"]|^\s*\}\s*from\s*['"]'''
+                         r'''|\brequire\s*\(|\bimport\s*\(''')
+# 常量引用常量最多展开这么多层
+MAX_DEPTH = 8
+
+
+def is_import_line(line):
+    return IMPORT_LINE.search(line) is not None
+
+
+def template_parts(text):
+    """
+    模板字符串拆成 [('str', 文本) | ('name', 标识符) | ('expr', 表达式)]
+    """
+    parts = []
+    last = 0
+    for match in PLACEHOLDER.finditer(text):
+        if match.start() > last:
+            parts.append(('str', text[last:match.start()]))
+        expr = match.group(1).strip()
+        parts.append(('name', expr) if IDENTIFIER.match(expr) else ('expr', expr))
+        last = match.end()
+    if last < len(text):
+        parts.append(('str', text[last:]))
+    return parts
+
+
+def operand_parts(kind, text):
+    if kind == 'str':
+        return [('str', text[1:-1])]
+    if kind == 'tpl':
+        return template_parts(text[1:-1])
+    return [('name', text)]
+
+
+def find_chains(line):
+    """
+    找出一行里用+连起来的操作数序列，比如 BASE_URL + '/order/' + id
+    :return: [(parts, 序列后面的下一个token, 是否是取属性或者调用函数)]
+    """
+    tokens = [(match.lastgroup, match.group()) for match in TOKEN.finditer(line) if match.lastgroup != 'space']
+    chains = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i][0] not in OPERANDS:
+            i += 1
+            continue
+        operands = [tokens[i]]
+        j = i + 1
+        while j + 1 < len(tokens) and tokens[j][0] == 'plus' and tokens[j + 1][0] in OPERANDS:
+            operands.append(tokens[j + 1])
+            j += 2
+        parts = [part for kind, text in operands for part in operand_parts(kind, text)]
+        after = tokens[j][1] if j < len(tokens) else None
+        # obj.BASE + '/x'、BASE + getPath()这种取属性或者调用函数的不是常量拼接
+        attribute = (i > 0 and tokens[i - 1][1] == '.') or (operands[-1][0] == 'name' and after in ['(', '.', '['])
+        chains.append((parts, after, attribute))
+        i = j
+    return chains
+
+
+def parse_expression(text):
+    """
+    常量声明等号右边的表达式，只支持字符串、模板字符串、标识符用+连接
+    :return: parts，不支持的表达式返回None
+    """
+    chains = find_chains(text)
+    if len(chains) != 1:
+        return None
+    parts, after, attribute = chains[0]
+    if attribute or after not in [None, ';']:
+        return None
+    # 前面不能有别的token(比如函数调用、对象字面量)
+    first = TOKEN.match(text.strip())
+    if first is None or first.lastgroup not in OPERANDS:
+        return None
+    return parts
+
+
+def is_composed(parts):
+    """
+    拼接出来的url: 至少一个标识符，并且字面量部分带/
+    """
+    return any(kind != 'str' for kind, _ in parts) and any(kind == 'str' and '/' in text for kind, text in parts)
+
+
+def content_key(data):
+    """
+    文件内容的hash，和git的blob sha一致，GitTreeExtractor不用读文件就能拿到
+    """
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+class JsFile:
+    """
+    一个js/ts文件解析出来的常量和拼接的url，只取决于文件内容，按内容hash缓存
+    - constants: {常量名: parts}
+    - exported: {导出名: 文件里的常量名}
+    - lines: [(行号, 这一行原来的api, [拼接的parts])]，只保留有api或者有拼接的行
+    """
+
+    def __init__(self, constants, exported, lines):
+        self.constants = constants
+        self.exported = exported
+        self.lines = lines
+
+    def export_signature(self):
+        """
+        影响其他文件解析结果的部分: 有导出常量时是导出和全部常量(导出的常量可能引用本文件的其他常量)
+        """
+        exported = {name: local_name for name, local_name in self.exported.items() if local_name in self.constants}
+        return (exported, self.constants) if exported else None
+
+    @classmethod
+    def parse(cls, lines, extract_api_from_line):
+        constants = {}
+        exported = {}
+        records = []
+        for idx, line in enumerate(lines):
+            if is_import_line(line):
+                continue
+            declaration = DECLARATION.match(line)
+            if declaration is not None:
+                parts = parse_expression(declaration.group(3))
+                if parts is not None:
+                    constants[declaration.group(2)] = parts
+                    if declaration.group(1):
+                        exported[declaration.group(2)] = declaration.group(2)
+            export_list = EXPORT_LIST.match(line)
+            if export_list is not None:
+                for item in export_list.group(1).split(','):
+                    names = item.split(' as ')
+                    if IDENTIFIER.match(names[0].strip()):
+                        exported[names[-1].strip()] = names[0].strip()
+            composed = [parts for parts, _, attribute in find_chains(line) if not attribute and is_composed(parts)]
+            apis = extract_api_from_line(line)
+            if apis or composed:
+                records.append((idx, apis, composed))
+        return cls(constants, exported, records)
+
+
+class JsConstantTable:
+    """
+    一个项目的常量表: 先在本文件的常量里找，找不到再找其他文件导出的常量，
+    多个文件导出了同名但值不同的常量时不解析；可以增删单个文件，api历史索引随commit增量维护
+    """
+
+    def __init__(self):
+        self.exported = {}  # 导出名 -> [(JsFile, 常量名)]
+
+    def add(self, js_file):
+        for name, local_name in js_file.exported.items():
+            if local_name in js_file.constants:
+                self.exported.setdefault(name, []).append((js_file, local_name))
+
+    def remove(self, js_file):
+        for name in js_file.exported:
+            definers = self.exported.get(name, [])
+            for i, (definer, _) in enumerate(definers):
+                if definer is js_file:
+                    del definers[i]
+                    break
+            if not definers:
+                self.exported.pop(name, None)
+
+    def lookup(self, js_file, name, depth):
+        if name in js_file.constants:
+            return self.resolve(js_file, js_file.constants[name], depth=depth + 1)
+        values = {self.resolve(definer, definer.constants[local_name], depth=depth + 1)
+                  for definer, local_name in self.exported.get(name, [])}
+        return values.pop() if len(values) == 1 else None
+
+    def resolve(self, js_file, parts, partial=False, depth=0):
+        """
+        把parts里的标识符换成常量的值
+        :param partial: 为True时第一个部分解析出来就行，后面解析不了的标识符保留成${name}
+        :return: 字符串，解析不了时返回None
+        """
+        if depth > MAX_DEPTH:
+            return None
+        values = []
+        for i, (kind, text) in enumerate(parts):
+            value = text if kind == 'str' else None
+            if kind == 'name':
+                value = self.lookup(js_file, text, depth)
+            if value is None:
+                if not partial or i == 0:
+                    return None
+                value = '${' + text + '}'
+            values.append(value)
+        return ''.join(values)
+
+
+# 文件内容没变就不用重新解析，内容hash作为key不会过期，只按LRU淘汰
+SYMBOL_CACHE = QueryCache(max_size=20000, ttl=float('inf'))
@@ -0,0 +1,230 @@
+import os
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+# 不属于某个项目的阶段(比如合并csv入库)记在这个project_id下
+RUN_PROJECT_ID = 0
+# 子阶段的名字是 父阶段/子阶段，比如extract/read、extract/FrontendApi，耗时已经包含在父阶段里，
+# 算项目总耗时、列最慢的(项目, 阶段)时不计入
+SUB_STAGE_SEP = '/'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class ScanMetrics:
+    """
+    记录一次扫描里每个项目每个阶段(list/download/unzip/extract/load)的耗时，
+    以及下载字节数、文件数、入库行数，跳过的项目记录原因
+    多线程扫描时共用一个实例
+    """
+
+    def __init__(self, run_kind):
+        self.run_kind = run_kind
+        self.run_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        self.started_at = time.time()
+        self.projects = {}
+        self.lock = threading.Lock()
+
+    def project(self, project_id, project_name=''):
+        if project_id not in self.projects:
+            self.projects[project_id] = {'name': project_name, 'stages': {}, 'bytes': {}, 'files': {}, 'rows': {},
+                                         'status': 'ok'}
+        elif project_name:
+            self.projects[project_id]['name'] = project_name
+        return self.projects[project_id]
+
+    @contextmanager
+    def stage(self, project_id, stage, project_name=''):
+        """
+        with metrics.stage(project.id, 'download', project.name):
+            ...
+        同一个阶段多次进入时耗时累加
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                stages = self.project(project_id, project_name)['stages']
+                stages[stage] = stages.get(stage, 0) + seconds
+
+    def add(self, project_id, stage, bytes=0, files=0, rows=0, seconds=0):
+        """
+        累加计数，seconds用于不方便用stage()包起来的耗时(比如Extractor里各检测器自己统计的耗时)
+        """
+        with self.lock:
+            record = self.project(project_id)
+            if seconds:
+                record['stages'][stage] = record['stages'].get(stage, 0) + seconds
+            for key, value in [('bytes', bytes), ('files', files), ('rows', rows)]:
+                if value:
+                    record[key][stage] = record[key].get(stage, 0) + int(value)
+
+    def add_sub_stage(self, project_id, parent, name, bytes=0, files=0, rows=0, seconds=0):
+        """
+        记录父阶段里的一部分耗时，比如extract里读文件和各检测器的耗时
+        """
+        self.add(project_id, f'{parent}{SUB_STAGE_SEP}{name}', bytes=bytes, files=files, rows=rows, seconds=seconds)
+
+    def skip(self, project_id, reason, project_name=''):
+        with self.lock:
+            self.project(project_id, project_name)['status'] = f'skipped: {reason}'[:255]
+
+    def to_dataframe(self):
+        now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        datas = []
+        with self.lock:
+            for project_id, record in self.projects.items():
+                stages = set(record['stages']) | set(record['bytes']) | set(record['files']) | set(record['rows'])
+                if len(stages) == 0:
+                    stages = {'-'}
+                for stage in sorted(stages):
+                    datas.append({
+                        'created_at': now_str,
+                        'updated_at': now_str,
+                        'run_id': self.run_id,
+                        'run_kind': self.run_kind,
+                        'project_id': project_id,
+                        'project_name': record['name'][:64],
+                        'stage': stage,
+                        'seconds': round(record['stages'].get(stage, 0), 4),
+                        'bytes': record['bytes'].get(stage, 0),
+                        'files': record['files'].get(stage, 0),
+                        'row_count': record['rows'].get(stage, 0),
+                        'status': record['status']
+                    })
+        return pd.DataFrame(datas, columns=['created_at', 'updated_at', 'run_id', 'run_kind', 'project_id',
+                                            'project_name', 'stage', 'seconds', 'bytes', 'files', 'row_count', 'status'])
+
+    def write_prometheus(self, path, top_n=10):
+        """
+        写成node_exporter textfile collector可以读取的格式，先写临时文件再替换
+        """
+        df = self.to_dataframe()
+        kind = escape_label(self.run_kind)
+        lines = [
+            '# HELP insights_scan_run_seconds Wall time of the whole scan run.',
+            '# TYPE insights_scan_run_seconds gauge',
+            f'insights_scan_run_seconds{{run_kind="{kind}"}} {time.time() - self.started_at:.3f}',
+            '# HELP insights_scan_run_timestamp_seconds Unix time the scan run finished.',
+            '# TYPE insights_scan_run_timestamp_seconds gauge',
+            f'insights_scan_run_timestamp_seconds{{run_kind="{kind}"}} {time.time():.0f}',
+        ]
+        projects = df[df['project_id'] != RUN_PROJECT_ID].drop_duplicates('project_id')
+        skipped = projects[projects['status'] != 'ok']
+        lines += [
+            '# HELP insights_scan_projects Number of projects in the scan run by status.',
+            '# TYPE insights_scan_projects gauge',
+            f'insights_scan_projects{{run_kind="{kind}",status="ok"}} {len(projects) - len(skipped)}',
+            f'insights_scan_projects{{run_kind="{kind}",status="skipped"}} {len(skipped)}',
+        ]
+        stage_df = df.groupby('stage')[['seconds', 'bytes', 'files', 'row_count']].sum()
+        for metric, column, help_text in [
+            ('insights_scan_stage_seconds', 'seconds', 'Total wall time per stage.'),
+            ('insights_scan_stage_bytes', 'bytes', 'Total bytes per stage.'),
+            ('insights_scan_stage_files', 'files', 'Total files per stage.'),
+            ('insights_scan_stage_rows', 'row_count', 'Total rows per stage.'),
+        ]:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge']
+            for stage, value in stage_df[column].items():
+                lines.append(f'{metric}{{run_kind="{kind}",stage="{escape_label(stage)}"}} {value}')
+        lines += ['# HELP insights_scan_slowest_project_seconds Wall time of the slowest projects.',
+                  '# TYPE insights_scan_slowest_project_seconds gauge']
+        for _, row in self.slowest_projects(df, top_n).iterrows():
+            lines.append(f'insights_scan_slowest_project_seconds{{run_kind="{kind}",'
+                         f'project_id="{row["project_id"]}",project="{escape_label(row["project_name"])}"}} '
+                         f'{row["seconds"]:.3f}')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def top_stages(df):
+        """
+        去掉子阶段，剩下的各阶段耗时互不重叠，可以相加
+        """
+        return df[~df['stage'].str.contains(SUB_STAGE_SEP, regex=False)]
+
+    @classmethod
+    def slowest_projects(cls, df, top_n=10):
+        df = cls.top_stages(df)
+        df = df[df['project_id'] != RUN_PROJECT_ID]
+        return df.groupby(['project_id', 'project_name'])['seconds'].sum().reset_index() \
+            .sort_values('seconds', ascending=False).head(top_n)
+
+    def summary(self, top_n=10):
+        df = self.to_dataframe()
+        print(f'===== {self.run_kind} {self.run_id} 耗时 {time.time() - self.started_at:.1f}s =====')
+        print('各阶段总耗时:')
+        stage_df = df.groupby('stage')[['seconds', 'bytes', 'files', 'row_count']].sum() \
+            .sort_values('seconds', ascending=False)
+        print(stage_df.to_string())
+        top_df = self.top_stages(df)
+        print(f'最慢的{top_n}个项目:')
+        for _, row in self.slowest_projects(df, top_n).iterrows():
+            stages = top_df[top_df['project_id'] == row['project_id']].sort_values('seconds', ascending=False)
+            detail = ', '.join(f'{s}={v:.1f}s' for s, v in zip(stages['stage'], stages['seconds']))
+            print(f'  {row["project_name"]}({row["project_id"]}) {row["seconds"]:.1f}s [{detail}]')
+        print(f'最慢的{top_n}个(项目, 阶段):')
+        for _, row in top_df.sort_values('seconds', ascending=False).head(top_n).iterrows():
+            print(f'  {row["project_name"]}({row["project_id"]}) {row["stage"]} {row["seconds"]:.1f}s')
+        skipped = df[df['status'] != 'ok'].drop_duplicates('project_id')
+        if len(skipped) > 0:
+            print(f'跳过的项目{len(skipped)}个:')
+            for _, row in skipped.iterrows():
+                print(f'  {row["project_name"]}({row["project_id"]}) {row["status"]}')
+        return df
+
+    def compare(self, previous_df, threshold=0.3, min_seconds=5):
+        """
+        和上一次同类扫描对比，阶段总耗时或者单个项目耗时增加超过threshold(且超过min_seconds秒)的标记为回退
+        :return: 回退项的列表
+        """
+        if previous_df is None or len(previous_df) == 0:
+            print('没有上一次的扫描记录，不做对比')
+            return []
+        df = self.to_dataframe()
+        regressions = []
+        old_stage = previous_df.groupby('stage')['seconds'].sum()
+        new_stage = df.groupby('stage')['seconds'].sum()
+        for stage, seconds in new_stage.items():
+            old = old_stage.get(stage)
+            if old is not None and seconds - old > min_seconds and seconds > old * (1 + threshold):
+                regressions.append(f'阶段 {stage}: {old:.1f}s -> {seconds:.1f}s')
+        # 项目耗时只加父阶段，子阶段已经算在里面了
+        previous_df = self.top_stages(previous_df)
+        df = self.top_stages(df)
+        old_project = previous_df[previous_df['project_id'] != RUN_PROJECT_ID].groupby('project_id')['seconds'].sum()
+        new_project = df[df['project_id'] != RUN_PROJECT_ID].groupby(['project_id', 'project_name'])['seconds'].sum()
+        for (project_id, project_name), seconds in new_project.items():
+            old = old_project.get(project_id)
+            if old is not None and seconds - old > min_seconds and seconds > old * (1 + threshold):
+                regressions.append(f'项目 {project_name}({project_id}): {old:.1f}s -> {seconds:.1f}s')
+        if regressions:
+            print(f'和上一次扫描({previous_df["run_id"].iloc[0]})相比变慢:')
+            for regression in regressions:
+                print(f'  {regression}')
+        else:
+            print(f'和上一次扫描({previous_df["run_id"].iloc[0]})相比没有明显变慢')
+        return regressions
+
+    def merge(self, projects):
+        """
+        合并worker进程里记录的数据(ScanMetrics.projects)
+        """
+        with self.lock:
+            for project_id, other in projects.items():
+                record = self.project(project_id, other['name'])
+                for key in ['stages', 'bytes', 'files', 'rows']:
+                    for stage, value in other[key].items():
+                        record[key][stage] = record[key].get(stage, 0) + value
+                if other['status'] != 'ok':
+                    record['status'] = other['status']
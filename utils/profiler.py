@@ -0,0 +1,190 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+from contextlib import contextmanager
+
+
+class StackSampler:
+    """
+    采样线程: 每interval秒从sys._current_frames()取一次目标线程的调用栈，
+    不需要提前挂profiler，项目扫到一半发现慢了再开始采样
+    """
+
+    def __init__(self, thread_id, interval=0.01, max_depth=128):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = {}  # (栈底...栈顶的函数) -> 次数
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    @staticmethod
+    def function_name(code):
+        return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})'
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            stack.append(self.function_name(frame.f_code))
+            frame = frame.f_back
+        if stack:
+            key = tuple(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def folded(self):
+        """
+        flamegraph.pl / speedscope能直接读的折叠栈格式
+        """
+        return ''.join(f'{";".join(stack)} {count}\n' for stack, count in
+                       sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+    def hottest(self, top_n=20):
+        """
+        :return: ([(函数, 自身采样数)], [(函数, 包含子调用的采样数)])，都按采样数从大到小
+        """
+        own = {}
+        total = {}
+        for stack, count in self.stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            # 递归调用只算一次
+            for name in set(stack):
+                total[name] = total.get(name, 0) + count
+        return (sorted(own.items(), key=lambda item: -item[1])[:top_n],
+                sorted(total.items(), key=lambda item: -item[1])[:top_n])
+
+
+class ProjectProfiler:
+    """
+    扫描单个项目时的性能剖析，结果写到path下，每个项目一份剖析文件和一份最热函数的摘要，
+    summary.txt汇总这一轮所有被剖析的项目
+    - project_ids里的项目: 从头到尾用cProfile，.prof可以用pstats/snakeviz打开
+    - 其他项目: 超过slow_seconds还没扫完时开始对扫描线程采样，.folded是折叠栈，可以画火焰图
+    """
+
+    def __init__(self, path, slow_seconds=300, interval=0.01, project_ids=None, top_n=20):
+        """
+        :param slow_seconds: 项目扫描超过这么多秒开始采样，0表示不自动采样
+        :param interval: 采样间隔秒数
+        :param project_ids: 始终用cProfile剖析的项目
+        """
+        self.path = path
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.project_ids = set(project_ids or [])
+        self.top_n = top_n
+        self.lock = threading.Lock()
+        self.profiled = []  # [(project_id, stage, 摘要文件路径)]
+
+    def run_path(self, run):
+        return os.path.join(self.path, run) if run else self.path
+
+    def artifact_path(self, run, project_id, stage, suffix):
+        path = self.run_path(run)
+        os.makedirs(path, exist_ok=True)
+        now = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        return os.path.join(path, f'{project_id}-{stage}-{now}.{suffix}')
+
+    @contextmanager
+    def profile(self, project_id, project_name='', stage='scan', run=None):
+        """
+        with profiler.profile(project.id, project.name, 'extract_api', run='extract_api-20240101'):
+            ...
+        :param run: 剖析结果放在path/run下，同一轮扫描的项目放在一起
+        """
+        if project_id in self.project_ids:
+            with self.cprofile(project_id, project_name, stage, run):
+                yield
+            return
+        if not self.slow_seconds:
+            yield
+            return
+        sampler = StackSampler(threading.get_ident(), self.interval)
+        # 超过slow_seconds才启动采样线程，快的项目没有额外开销
+        timer = threading.Timer(self.slow_seconds, sampler.start)
+        timer.daemon = True
+        started_at = time.time()
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+            sampler.stop()
+            if sampler.samples:
+                self.write_samples(run, project_id, project_name, stage, sampler, time.time() - started_at)
+
+    @contextmanager
+    def cprofile(self, project_id, project_name, stage, run=None):
+        profiler = cProfile.Profile()
+        started_at = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            prof_path = self.artifact_path(run, project_id, stage, 'prof')
+            profiler.dump_stats(prof_path)
+            out = io.StringIO()
+            stats = pstats.Stats(profiler, stream=out)
+            stats.sort_stats('tottime').print_stats(self.top_n)
+            stats.sort_stats('cumulative').print_stats(self.top_n)
+            header = f'{project_name}({project_id}) {stage} {time.time() - started_at:.1f}s cProfile {prof_path}'
+            self.write_summary(run, project_id, stage, header, out.getvalue(), self.cprofile_brief(stats))
+
+    def cprofile_brief(self, stats, top_n=5):
+        """
+        summary.txt里的摘要直接从stats.stats取自身耗时最多的函数，不截print_stats输出的开头(那里是表头)
+        """
+        items = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:top_n]
+        lines = ['自身耗时最多的函数(自身耗时 包含子调用的耗时 调用次数):']
+        for (filename, line, name), (_, calls, own, total, _) in items:
+            function = name if filename == '~' else f'{os.path.basename(filename)}:{line}({name})'
+            lines.append(f'  {own:8.3f}s {total:8.3f}s {calls:>8} {function}')
+        return '\n'.join(lines)
+
+    def write_samples(self, run, project_id, project_name, stage, sampler, seconds):
+        folded_path = self.artifact_path(run, project_id, stage, 'folded')
+        with open(folded_path, 'w') as f:
+            f.write(sampler.folded())
+        own, total = sampler.hottest(self.top_n)
+        lines = ['自身耗时最多的函数:']
+        lines += [f'  {count / sampler.samples:6.1%} {name}' for name, count in own]
+        lines += ['包含子调用耗时最多的函数:']
+        lines += [f'  {count / sampler.samples:6.1%} {name}' for name, count in total]
+        header = (f'{project_name}({project_id}) {stage} {seconds:.1f}s, 超过{self.slow_seconds}s后采样'
+                  f'{sampler.samples}次 {folded_path}')
+        self.write_summary(run, project_id, stage, header, '\n'.join(lines) + '\n',
+                           '\n'.join(lines[:min(len(own), 5) + 1]))
+
+    def write_summary(self, run, project_id, stage, header, body, brief):
+        """
+        :param body: 完整的剖析结果，写到这个项目的摘要文件
+        :param brief: 最热的几个函数，追加到summary.txt
+        """
+        txt_path = self.artifact_path(run, project_id, stage, 'txt')
+        with open(txt_path, 'w') as f:
+            f.write(f'{header}\n{body}')
+        with self.lock:
+            with open(os.path.join(self.run_path(run), 'summary.txt'), 'a') as f:
+                f.write(f'{header}\n{brief}\n\n')
+            self.profiled.append((project_id, stage, txt_path))
+        print(f'性能剖析: {header}')
@@ -0,0 +1,83 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    查询结果的LRU+TTL缓存
+    key里带上相关表的generation，表重新入库后generation变化，旧的结果不会再被命中，
+    之后随LRU淘汰或者过期清掉
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        """
+        :param max_size: 最多缓存多少条结果，0表示不缓存
+        :param ttl: 结果的有效秒数
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()  # key: (expire_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        :return: (是否命中, value)
+        """
+        now = time.time()
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return False, None
+            expire_at, value = item
+            if expire_at <= now:
+                del self.items[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.items[key] = (time.time() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, load):
+        """
+        未命中时调用load()并缓存结果
+        """
+        hit, value = self.get(key)
+        if hit:
+            return value
+        value = load()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
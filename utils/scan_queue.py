@@ -0,0 +1,167 @@
+import os
+import time
+import uuid
+import socket
+import threading
+
+
+class LeaseLostException(Exception):
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+    def __str__(self):
+        return f'project {self.project_id} 的租约已被其他节点接管'
+
+
+class Heartbeat:
+    """
+    扫描期间后台线程定时续约，续约失败(租约已过期被别人认领)时lost置位
+    """
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.queue.heartbeat_seconds):
+            try:
+                renewed = self.queue.mysql.renew_t_scan_job(self.job['id'], self.job['token'],
+                                                            self.queue.lease_seconds)
+            except Exception as e:
+                # 数据库暂时连不上，下次再试，真的超过租约时间会被别人接管
+                print(f'project {self.job["project_id"]} 续约失败: {e}')
+                continue
+            if not renewed:
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+class ScanJobQueue:
+    """
+    基于t_scan_job的分布式扫描队列，多个节点(或者同一台机器上的多个进程)用同一个run_id共同完成一轮扫描
+    - enqueue: 把项目加入这一轮，重复加入会跳过，每个节点启动时都可以调用
+    - claim: 用带条件的UPDATE抢一个任务并拿到租约，租约由心跳线程续期
+    - 节点崩溃后租约过期，任务被其他节点重新认领，最多尝试max_attempts次
+    - 完成时校验租约还在自己手里，被接管的任务结果不会覆盖别人的状态
+    - 心跳续约失败时handler不会被打断，有副作用的handler在写入前调用check_lease，
+      租约已经丢了就抛LeaseLostException放弃写入；只覆盖本项目结果的写入(比如各项目的csv)重复执行也没关系
+    """
+
+    def __init__(self, mysql, run_id, kind, domain, owner=None, lease_seconds=300, heartbeat_seconds=60,
+                 max_attempts=3, poll_seconds=30):
+        """
+        :param run_id: 这一轮扫描的标识，同一轮的节点用同一个run_id
+        :param kind: scan(提取api和数据库链接) / inspect(审查入库)
+        :param domain: gitlab地址，多个gitlab实例的任务互不干扰
+        :param lease_seconds: 租约时长，节点崩溃后最多这么久任务被重新认领
+        :param heartbeat_seconds: 续约间隔，要明显小于lease_seconds
+        :param poll_seconds: 没有可认领的任务、但还有别的节点在扫描时，等待多久再查一次
+        """
+        self.mysql = mysql
+        self.run_id = run_id
+        self.kind = kind
+        self.domain = domain
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.heartbeat = None
+
+    def enqueue(self, project_ids):
+        return self.mysql.insert_t_scan_job(self.run_id, self.kind, self.domain, project_ids)
+
+    def claim(self):
+        """
+        :return: {id, project_id, attempts, token}，没有可认领的任务时返回None
+        """
+        token = uuid.uuid4().hex
+        job = self.mysql.claim_t_scan_job(self.run_id, self.kind, self.domain, self.owner, token,
+                                          self.lease_seconds, self.max_attempts)
+        if job is None:
+            return None
+        job_id, project_id, attempts = job
+        return {'id': job_id, 'project_id': project_id, 'attempts': attempts, 'token': token}
+
+    def finish(self, job, error=None, retry=True):
+        """
+        :param error: None表示成功
+        :param retry: 失败时是否放回队列，次数用完后标记为failed
+        """
+        if error is None:
+            status = 'done'
+        elif retry and job['attempts'] < self.max_attempts:
+            status = 'pending'
+        else:
+            status = 'failed'
+        finished = self.mysql.finish_t_scan_job(job['id'], job['token'], status, error)
+        if not finished:
+            print(f'project {job["project_id"]} 的租约已被其他节点接管，本次结果不记录')
+        return status if finished else None
+
+    def check_lease(self):
+        """
+        handler在写入结果之前调用，同步续约一次确认租约还在自己手里，不在时抛LeaseLostException
+        """
+        heartbeat = self.heartbeat
+        if heartbeat is None:
+            return
+        job = heartbeat.job
+        if heartbeat.lost.is_set() or not self.mysql.renew_t_scan_job(job['id'], job['token'], self.lease_seconds):
+            heartbeat.lost.set()
+            raise LeaseLostException(job['project_id'])
+
+    def progress(self):
+        return self.mysql.select_t_scan_job_progress(self.run_id, self.kind, self.domain)
+
+    def is_finished(self):
+        progress = self.progress()
+        return progress.get('pending', 0) == 0 and progress.get('running', 0) == 0 \
+            and progress.get('expired', 0) == 0
+
+    def run(self, handler, retryable=None, wait=True):
+        """
+        循环认领并执行任务，直到这一轮没有待扫描的任务
+        :param handler: handler(project_id)，抛异常表示失败，写入结果之前可以调用check_lease
+        :param retryable: retryable(exception)为False的异常直接标记为failed，默认都重试
+        :param wait: 为True时还有其他节点在扫描就等着，以便接管崩溃节点的任务；为False时认领不到就返回
+        :return: 本节点处理的{status: 任务数}
+        """
+        counts = {}
+        while True:
+            self.mysql.expire_t_scan_job(self.run_id, self.kind, self.domain, self.max_attempts)
+            job = self.claim()
+            if job is None:
+                if not wait or self.is_finished():
+                    return counts
+                time.sleep(self.poll_seconds)
+                continue
+            error = None
+            retry = True
+            with Heartbeat(self, job) as heartbeat:
+                self.heartbeat = heartbeat
+                try:
+                    handler(job['project_id'])
+                except Exception as e:
+                    error = repr(e)
+                    retry = retryable is None or retryable(e)
+                finally:
+                    self.heartbeat = None
+            if heartbeat.lost.is_set():
+                # 任务已经归接管的节点，这里不再记录结果
+                print(f'project {job["project_id"]} 扫描期间续约失败，租约已被其他节点接管')
+                counts['lost'] = counts.get('lost', 0) + 1
+                continue
+            status = self.finish(job, error, retry)
+            counts[status] = counts.get(status, 0) + 1
@@ -0,0 +1,246 @@
+import json
+import math
+import time
+import heapq
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def activity_score(last_activity_at, half_life_hours=168):
+    """
+    根据gitlab project的last_activity_at算一个活跃度，越近越接近1，每过half_life_hours减半
+    :param last_activity_at: 形如 2022-04-12T09:34:10.000+08:00 的字符串
+    """
+    if not last_activity_at:
+        return 0.0
+    try:
+        last = datetime.datetime.fromisoformat(last_activity_at.replace('Z', '+00:00'))
+    except ValueError:
+        return 0.0
+    if last.tzinfo is None:
+        last = last.replace(tzinfo=datetime.timezone.utc)
+    age_hours = (datetime.datetime.now(datetime.timezone.utc) - last).total_seconds() / 3600
+    return math.pow(0.5, max(age_hours, 0) / half_life_hours)
+
+
+class ScanScheduler:
+    """
+    常驻的扫描调度器
+    - 定时器堆按到期时间排序，到期的项目进入就绪堆，就绪堆按活跃度排序，活跃的项目先扫
+    - push事件到达后，项目在debounce秒后重新扫描，连续的push会往后推，但最多推迟max_delay秒
+    - 同时扫描的项目数不超过max_concurrent，同一个项目不会同时扫两次，扫描中收到的push在扫完后再补扫
+    - 没有push的项目按sweep_interval慢慢轮询一遍
+    - 有项目扫描完之后，最多每reload_interval秒调用一次reload_func入库，
+      到时间后先不开始新的扫描，等正在扫描的项目都扫完再调用，reload_func不会和扫描同时执行
+    """
+
+    def __init__(self, scan_func, reload_func=None, debounce=60, max_delay=300, max_concurrent=2,
+                 sweep_interval=86400, reload_interval=300, half_life_hours=168):
+        self.scan_func = scan_func
+        self.reload_func = reload_func
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_concurrent = max(1, max_concurrent)
+        self.sweep_interval = sweep_interval
+        self.reload_interval = reload_interval
+        self.half_life_hours = half_life_hours
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent)
+        self.cond = threading.Condition()
+        self.timers = []  # (due, seq, project_id, version)
+        self.ready = []  # (-activity, seq, project_id)
+        self.states = {}
+        self.seq = 0
+        self.running = 0
+        self.scanned_since_reload = 0
+        self.last_reload = time.time()
+        self.stopped = False
+
+    def add_projects(self, projects):
+        """
+        :param projects: [(project_id, activity)]，按活跃度从高到低把首轮扫描均匀铺开在sweep_interval里
+        """
+        projects = sorted(projects, key=lambda x: -x[1])
+        now = time.time()
+        with self.cond:
+            for i, (project_id, activity) in enumerate(projects):
+                state = self.state(project_id)
+                state['activity'] = activity
+                state['updated'] = now
+                self.schedule(project_id, now + self.sweep_interval * i / max(len(projects), 1))
+            self.cond.notify_all()
+
+    def state(self, project_id):
+        if project_id not in self.states:
+            self.states[project_id] = {'activity': 0.0, 'updated': time.time(), 'version': 0, 'due': None,
+                                       'first_push': None, 'running': False, 'queued': False, 'dirty': False,
+                                       'scans': 0}
+        return self.states[project_id]
+
+    def decayed_activity(self, state, now):
+        hours = (now - state['updated']) / 3600
+        return state['activity'] * math.pow(0.5, hours / self.half_life_hours)
+
+    def schedule(self, project_id, due):
+        """需要在self.cond内调用，之前的定时作废"""
+        state = self.state(project_id)
+        state['version'] += 1
+        state['due'] = due
+        self.seq += 1
+        heapq.heappush(self.timers, (due, self.seq, project_id, state['version']))
+
+    def push(self, project_id):
+        """收到push事件"""
+        now = time.time()
+        with self.cond:
+            state = self.state(project_id)
+            state['activity'] = self.decayed_activity(state, now) + 1
+            state['updated'] = now
+            if state['running']:
+                state['dirty'] = True
+                return
+            if state['queued']:
+                # 已经在就绪堆里等着扫，还没开始扫，扫描时拿到的就是最新的commit
+                return
+            if state['first_push'] is None:
+                state['first_push'] = now
+            due = min(now + self.debounce, state['first_push'] + self.max_delay)
+            self.schedule(project_id, due)
+            self.cond.notify_all()
+
+    def pop_due(self, now):
+        """把到期的定时移到就绪堆"""
+        while self.timers and self.timers[0][0] <= now:
+            due, _, project_id, version = heapq.heappop(self.timers)
+            state = self.states[project_id]
+            if version != state['version']:
+                continue
+            if state['running']:
+                # 扫描中到期，扫完再补扫
+                state['dirty'] = True
+                continue
+            if state['queued']:
+                # 已经在就绪堆里，不重复放，否则会同时扫两次
+                continue
+            state['due'] = None
+            state['queued'] = True
+            self.seq += 1
+            heapq.heappush(self.ready, (-self.decayed_activity(state, now), self.seq, project_id))
+
+    def run_scan(self, project_id):
+        start = time.time()
+        try:
+            self.scan_func(project_id)
+            print(f'project {project_id} 扫描完成, 耗时 {time.time() - start:.1f}s')
+        except Exception as e:
+            print(f'project {project_id} 扫描失败: {e}')
+        finally:
+            now = time.time()
+            with self.cond:
+                state = self.states[project_id]
+                state['running'] = False
+                state['scans'] += 1
+                self.running -= 1
+                self.scanned_since_reload += 1
+                if state['dirty']:
+                    # 扫描期间又有push
+                    state['dirty'] = False
+                    state['first_push'] = now
+                    self.schedule(project_id, now + self.debounce)
+                elif state['due'] is None:
+                    self.schedule(project_id, now + self.sweep_interval)
+                self.cond.notify_all()
+
+    def reload_due(self, now):
+        return self.reload_func is not None and self.scanned_since_reload > 0 \
+            and now - self.last_reload >= self.reload_interval
+
+    def reload(self, now):
+        """需要在self.cond内、没有正在扫描的项目时调用"""
+        self.scanned_since_reload = 0
+        self.last_reload = now
+        self.cond.release()
+        try:
+            self.reload_func()
+        except Exception as e:
+            print(f'reload失败: {e}')
+        finally:
+            self.cond.acquire()
+
+    def run(self):
+        with self.cond:
+            while not self.stopped:
+                now = time.time()
+                self.pop_due(now)
+                reloading = self.reload_due(now)
+                while not reloading and self.ready and self.running < self.max_concurrent:
+                    _, _, project_id = heapq.heappop(self.ready)
+                    state = self.states[project_id]
+                    state['queued'] = False
+                    state['running'] = True
+                    state['first_push'] = None
+                    self.running += 1
+                    self.executor.submit(self.run_scan, project_id)
+                if reloading and self.running == 0:
+                    self.reload(now)
+                timeout = self.reload_interval
+                if self.timers:
+                    timeout = min(timeout, max(self.timers[0][0] - time.time(), 0))
+                self.cond.wait(timeout=max(timeout, 0.1))
+        self.executor.shutdown(wait=True)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    接收gitlab的push webhook，POST任意路径都可以，
+    secret不为空时校验X-Gitlab-Token
+    """
+
+    def __init__(self, scheduler, host='127.0.0.1', port=8787, secret=''):
+        self.scheduler = scheduler
+        self.secret = secret
+        super().__init__((host, port), WebhookHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.server.secret and self.headers.get('X-Gitlab-Token') != self.server.secret:
+            self.reply(403, 'invalid token')
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            event = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.reply(400, 'invalid json')
+            return
+        if event.get('object_kind') not in ['push', 'tag_push']:
+            self.reply(202, 'ignored')
+            return
+        project_id = event.get('project_id') or (event.get('project') or {}).get('id')
+        if project_id is None:
+            self.reply(400, 'no project id')
+            return
+        self.server.scheduler.push(int(project_id))
+        self.reply(202, 'accepted')
+
+    def reply(self, code, msg):
+        body = json.dumps({'msg': msg}).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,157 @@
+import os
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+
+def _worker_main(worker_id, initializer, initargs, task_func, conn, max_tasks, max_rss_mb):
+    """
+    子进程主循环：初始化一次，然后逐个处理supervisor派发的任务，
+    处理数量达到max_tasks或者常驻内存超过max_rss_mb就主动退出，由supervisor拉起新进程
+    """
+    import psutil
+
+    process = psutil.Process(os.getpid())
+    state = initializer(*initargs) if initializer is not None else None
+    done = 0
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        try:
+            result = task_func(state, task)
+            status = 'done'
+        except Exception as e:
+            result = repr(e)
+            status = 'error'
+        done += 1
+        rss_mb = process.memory_info().rss / 1024 / 1024
+        retire = bool((max_tasks and done >= max_tasks) or (max_rss_mb and rss_mb > max_rss_mb))
+        conn.send((status, task, result, rss_mb, retire))
+        if retire:
+            break
+    conn.close()
+
+
+class SupervisedPool:
+    """
+    带内存预算的进程池
+    每个worker处理max_tasks个任务，或常驻内存(RSS, 用psutil测量)超过max_rss_mb之后被回收重建，
+    worker被kill(OOM等)时，它手上的任务会重新入队，最多重试max_retries次
+    supervisor一次只给一个worker派发一个任务，所以总是知道每个任务在哪个worker上；
+    每个worker单独一条Pipe，不用共享的Queue，一个worker被kill不会把锁带走卡住其他worker
+    """
+
+    def __init__(self, task_func, initializer=None, initargs=(), processes=4, max_tasks=50, max_rss_mb=2048,
+                 max_retries=2):
+        """
+        :param task_func: task_func(state, task)，必须是模块级函数，spawn出来的进程需要能pickle
+        :param initializer: 每个worker启动时调用一次，返回值作为state传给task_func
+        :param processes: worker数量
+        :param max_tasks: 每个worker最多处理的任务数，0表示不限制
+        :param max_rss_mb: 每个worker的内存预算(MB)，0表示不限制
+        :param max_retries: worker异常退出时任务最多重新入队的次数
+        """
+        self.task_func = task_func
+        self.initializer = initializer
+        self.initargs = initargs
+        self.processes = max(1, processes)
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        self.max_retries = max_retries
+        self.ctx = mp.get_context('spawn')
+        self.workers = {}
+        self.next_worker_id = 0
+        self.recycled = 0
+        self.killed = 0
+
+    def spawn(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=_worker_main,
+                                   args=(worker_id, self.initializer, self.initargs, self.task_func, child_conn,
+                                         self.max_tasks, self.max_rss_mb),
+                                   daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[worker_id] = {'process': process, 'conn': parent_conn, 'task': None}
+        return worker_id
+
+    def retire(self, worker_id):
+        worker = self.workers.pop(worker_id)
+        worker['process'].join(timeout=10)
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+            worker['process'].join()
+        worker['conn'].close()
+
+    def map(self, tasks, callback=None):
+        """
+        执行所有任务，返回 {task: (status, result)}
+        status: done / error / killed
+        :param callback: 每个任务结束时调用 callback(task, status, result)
+        """
+        pending = list(tasks)[::-1]
+        retries = {}
+        results = {}
+
+        def finish(task, status, result):
+            results[task] = (status, result)
+            if callback is not None:
+                callback(task, status, result)
+
+        try:
+            while pending or any(w['task'] is not None for w in self.workers.values()):
+                # 补齐worker并给空闲的worker派发任务
+                busy = sum(w['task'] is not None for w in self.workers.values())
+                while len(self.workers) < min(self.processes, busy + len(pending)):
+                    self.spawn()
+                for worker in self.workers.values():
+                    if worker['task'] is None and pending:
+                        worker['task'] = pending.pop()
+                        worker['conn'].send(worker['task'])
+
+                # 同时等待结果和进程退出
+                waitables = {}
+                for worker_id, worker in self.workers.items():
+                    if worker['task'] is not None:
+                        waitables[worker['conn']] = worker_id
+                        waitables[worker['process'].sentinel] = worker_id
+                for ready in wait(list(waitables)):
+                    worker_id = waitables[ready]
+                    worker = self.workers.get(worker_id)
+                    if worker is None or worker['task'] is None:
+                        continue
+                    try:
+                        status, task, result, rss_mb, retire = worker['conn'].recv()
+                    except (EOFError, OSError):
+                        # 进程没回结果就退出了，任务重新入队
+                        task = worker['task']
+                        self.killed += 1
+                        print(f'worker {worker_id} 异常退出(exitcode={worker["process"].exitcode})，任务: {task}')
+                        self.retire(worker_id)
+                        retries[task] = retries.get(task, 0) + 1
+                        if retries[task] <= self.max_retries:
+                            pending.append(task)
+                        else:
+                            finish(task, 'killed', None)
+                        continue
+
+                    worker['task'] = None
+                    finish(task, status, result)
+                    if retire:
+                        print(f'worker {worker_id} 回收, 当前内存: {rss_mb:.1f} M')
+                        self.recycled += 1
+                        self.retire(worker_id)
+        finally:
+            self.close()
+        return results
+
+    def close(self):
+        for worker_id, worker in list(self.workers.items()):
+            if worker['process'].is_alive():
+                try:
+                    worker['conn'].send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            self.retire(worker_id)